@@ -1,18 +1,64 @@
+"""
+QuickPad: a single-page notepad with attachments, served by Flask.
+
+POST /notes/batch applies several writes in one batch. It takes
+{"ops": [...]}, each {"op": "add", "note", "attachment"}, {"op": "edit",
+"id", "new_text"} or {"op": "delete", "id"}; edits and deletes may name the
+note by "timestamp" instead. Every op is checked before the batch runs, and
+the valid ones are applied in order. They are appended to the notes log with
+one write (and one fsync) and indexed for search in one transaction. The
+answer carries the revision after the batch and one result per op, in
+order: {"status": "success", "note": {...}} ({"status": "success", "id"} for
+deletes) or {"status": "error", "message"}. A failed op does not stop the
+rest.
+
+POST /import is the inverse of /export. The file comes as the 'file' field
+of a form, or as the raw request body with `?format=` (txt, csv, xlsx, jsonl
+or ndjson.gz). It is parsed while it streams in and committed
+IMPORT_CHUNK_NOTES notes per write batch, so neither the file nor its notes
+are held in memory (xlsx is spooled to a temp file first). Notes from a
+jsonl export keep their ids, so importing the same export again skips them.
+They also keep attachments whose file is still stored for this user. The
+answer counts the notes imported, skipped as duplicates, and skipped as
+unreadable or empty.
+"""
 import os
+import hmac
 import shutil
 import csv
-import io
 import json
-import uuid
+import zlib
 import math
+import mimetypes
+import time
+import itertools
+import threading
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
+from urllib.parse import quote as url_quote
 
 # Third-party imports
 from flask import (Flask, render_template, request, jsonify, session,
-                   redirect, url_for, send_from_directory, send_file)
+                   redirect, url_for, send_file, g,
+                   stream_with_context, before_render_template, template_rendered)
 from markupsafe import Markup
 from openpyxl import Workbook
+from werkzeug.utils import secure_filename
+
+from notes_store import create_note_store
+from note_ids import is_note_id, new_note_id, note_id_floor, note_id_for
+from note_import import FORMATS as IMPORT_FORMATS, ImportFormatError, format_for, read_notes
+from user_store import UserStore
+from write_coordinator import WriteCoordinator
+from search_index import SearchIndex
+from storage_utils import atomic_write
+from metrics import Metrics, SlowRequestProfiler, default_metrics_dir
+from cooperative import is_patched, offload, offload_iter
+from attachment_store import AttachmentStore, UploadError, is_safe_name
+from thumbnails import ThumbnailCache, is_thumbnailable, probe_image
 
 # --- Application Setup ---
 app = Flask(__name__)
@@ -23,18 +69,93 @@ app = Flask(__name__)
 DATA_DIR = os.environ.get('RENDER_DATA_DIR', '.') # Use /data on Render, local dir otherwise
 
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a-very-secret-key-for-dev')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB per request (single uploads and chunks)
+# Chunked uploads: size of each PUT and the largest file they may assemble
+app.config['UPLOAD_CHUNK_SIZE'] = 4 * 1024 * 1024
+app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('MAX_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))
+# Downloads: '' streams from Python; 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd)
+# hands the file to the front proxy. With x-accel, an internal location must map
+# DOWNLOAD_ACCEL_PREFIX to UPLOADS_DIR.
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('DOWNLOAD_OFFLOAD', '')
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-uploads')
+app.use_x_sendfile = app.config['DOWNLOAD_OFFLOAD'] == 'x-sendfile'
+# Accounts live in USERS_DB; the legacy plaintext USERS_FILE is imported into it once.
+# PASSWORD_HASH_METHOD is any werkzeug method, e.g. 'scrypt' or 'pbkdf2:sha256:1000000'.
 app.config['USERS_FILE'] = os.path.join(DATA_DIR, "users.txt")
+app.config['USERS_DB'] = os.path.join(DATA_DIR, "users.sqlite3")
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
 app.config['NOTES_DIR'] = os.path.join(DATA_DIR, "user_notes")
 app.config['UPLOADS_DIR'] = os.path.join(DATA_DIR, "user_uploads")
+# Image previews: resized derivatives of attachments, evicted least recently used
+# past THUMB_CACHE_BYTES. Requested widths snap to THUMB_WIDTHS; a preview not
+# ready within THUMB_WAIT seconds is answered with the original image.
+app.config['THUMBS_DIR'] = os.path.join(DATA_DIR, "user_thumbs")
+app.config['THUMB_CACHE_BYTES'] = int(os.environ.get('THUMB_CACHE_BYTES', 512 * 1024 * 1024))
+app.config['THUMB_WIDTHS'] = (160, 320, 640, 1280)
+app.config['THUMB_FORMAT'] = os.environ.get('THUMB_FORMAT', 'WEBP')  # or 'JPEG'
+app.config['THUMB_WAIT'] = 10
+# Notes backend: 'jsonl' (one file per user) or 'sqlite' (see migrate_notes.py)
+app.config['NOTES_BACKEND'] = os.environ.get('NOTES_BACKEND', 'jsonl')
+app.config['NOTES_DB'] = os.path.join(app.config['NOTES_DIR'], "notes.sqlite3")
+# jsonl backend: compact a log once this share of its lines are superseded edits or tombstones
+app.config['NOTES_COMPACT_RATIO'] = float(os.environ.get('NOTES_COMPACT_RATIO', 0.5))
+# jsonl backend: memory each worker may spend on parsed logs (about 3.5x their size on disk)
+app.config['NOTES_CACHE_BYTES'] = int(os.environ.get('NOTES_CACHE_BYTES', 256 * 1024 * 1024))
+# jsonl backend: fsync each batch of appended notes before answering
+app.config['NOTES_FSYNC'] = os.environ.get('NOTES_FSYNC', '') == '1'
+# Concurrent writes for one user are committed together, up to this many per batch (1 disables batching)
+app.config['WRITE_BATCH_LIMIT'] = int(os.environ.get('WRITE_BATCH_LIMIT', 64))
+# /notes/batch: most operations one request may carry
+app.config['BATCH_MAX_OPS'] = 1000
+# /import: largest file accepted, and how many notes each write batch commits
+app.config['IMPORT_MAX_SIZE'] = int(os.environ.get('IMPORT_MAX_SIZE', 1024 * 1024 * 1024))
+app.config['IMPORT_CHUNK_NOTES'] = 500
+# How many delete events to remember for delta sync; older cursors get a full reset
+app.config['DELETED_HISTORY_LIMIT'] = 1000
+# Live updates: how often workers check for changes made by other workers,
+# how often idle streams send a keep-alive, and when a stream is recycled
+app.config['CHANGE_POLL_INTERVAL'] = 0.25
+app.config['STREAM_HEARTBEAT'] = 15
+app.config['STREAM_MAX_DURATION'] = 300
+# Notes rendered with the page (and sent on a sync reset); older ones load on scroll
+app.config['NOTES_PAGE_SIZE'] = 50
+# xlsx exports are built in memory up to this size, then spill to a temp file
+app.config['EXPORT_SPOOL_BYTES'] = 8 * 1024 * 1024
+# /metrics: each worker writes its counters to METRICS_DIR at most every METRICS_FLUSH_INTERVAL
+# seconds, and /metrics adds up every worker's. Scrapers must send METRICS_TOKEN as a bearer
+# token; without one configured the endpoint does not exist.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR') or default_metrics_dir()
+app.config['METRICS_FLUSH_INTERVAL'] = 1.0
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Opt-in profiler: requests slower than SLOW_REQUEST_PROFILE_MS (0 disables) log the
+# hottest of the stacks sampled every SLOW_REQUEST_SAMPLE_INTERVAL seconds while they ran
+app.config['SLOW_REQUEST_PROFILE_MS'] = int(os.environ.get('SLOW_REQUEST_PROFILE_MS', 0))
+app.config['SLOW_REQUEST_SAMPLE_INTERVAL'] = 0.005
+app.config['SLOW_REQUEST_PROFILE_STACKS'] = 10
 
 # --- Directory Initialization ---
 # Ensure necessary directories exist on startup
-for directory_key in ['NOTES_DIR', 'UPLOADS_DIR']:
+for directory_key in ['NOTES_DIR', 'UPLOADS_DIR', 'THUMBS_DIR']:
     dir_path = app.config[directory_key]
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
 
+# gunicorn's on_starting hook imports the legacy users.txt before any worker boots; otherwise
+# the first login imports it, hashing every password in that one request
+users = UserStore(app.config['USERS_DB'], app.config['PASSWORD_HASH_METHOD'], legacy_file=app.config['USERS_FILE'])
+if os.path.exists(app.config['USERS_FILE']) and not users.imported_from(app.config['USERS_FILE']):
+    app.logger.warning("%s has not been imported; the first login will, or run migrate_users.py",
+                       app.config['USERS_FILE'])
+note_store = create_note_store(app.config['NOTES_BACKEND'], app.config['NOTES_DIR'], app.config['NOTES_DB'],
+                               compact_ratio=app.config['NOTES_COMPACT_RATIO'],
+                               cache_bytes=app.config['NOTES_CACHE_BYTES'],
+                               fsync=app.config['NOTES_FSYNC'])
+search_index = SearchIndex(app.config['NOTES_DIR'])
+attachments = AttachmentStore(app.config['UPLOADS_DIR'], app.config['UPLOAD_CHUNK_SIZE'],
+                              app.config['MAX_UPLOAD_SIZE'], offload=offload)
+thumbnails = ThumbnailCache(app.config['THUMBS_DIR'], app.config['THUMB_CACHE_BYTES'],
+                            app.config['THUMB_WIDTHS'], app.config['THUMB_FORMAT'], offload=offload)
+
 # --- Jinja Filters for Frontend Rendering ---
 
 @app.template_filter('format_bytes')
@@ -71,56 +192,372 @@ def get_file_icon_svg_filter(filename):
 
 # --- Internal Helper Functions ---
 
-def _get_user_notes_path(username):
-    """Returns the full path to a user's notes file."""
-    return os.path.join(app.config['NOTES_DIR'], f"{username}.jsonl")
-
 def _get_user_uploads_path(username):
     """Returns the full path to a user's upload directory."""
     return os.path.join(app.config['UPLOADS_DIR'], username)
 
-def _load_all_users():
-    """Reads all users from the users file into a dict."""
-    # NOTE: Storing passwords in plain text is insecure.
-    # For a real application, use a secure password hashing library like Werkzeug or Passlib.
-    creds = {}
-    users_file = app.config['USERS_FILE']
-    if not os.path.exists(users_file):
-        return {}
-    with open(users_file, 'r') as f:
-        for line in f:
-            if ':' in line:
-                user, pwd = line.strip().split(':', 1)
-                creds[user] = pwd
-    return creds
-
-def _save_new_user(username, password):
-    """Saves a new user to the users file."""
-    with open(app.config['USERS_FILE'], 'a') as f:
-        f.write(f"{username}:{password}\n")
+def _get_user_revision_path(username):
+    """Returns the full path to a user's revision record (sidecar of the notes file)."""
+    return os.path.join(app.config['NOTES_DIR'], f"{username}.rev.json")
+
+def _user_write_lock(username):
+    """Exclusive lock for changing a user's notes and revision together."""
+    return writes.lock(username, exclusive=True)
+
+def _user_read_lock(username):
+    """Shared lock for reading a user's notes consistently with their revision."""
+    return writes.lock(username, exclusive=False)
+
+def get_revision_state(username):
+    """
+    Reads a user's revision record without touching the notes file.
+
+    'revision' is a per-user counter bumped on every add, edit, delete and clear.
+    'reset' is the revision of the last clear; 'deleted' holds recent
+    [revision, note id] delete events (older records hold timestamps) and
+    'history_start' the oldest revision they still cover.
+    """
+    state = {"revision": 0, "reset": 0, "history_start": 0, "deleted": []}
+    try:
+        with open(_get_user_revision_path(username), 'r') as f:
+            state.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return state
+
+def _write_revision_state(username, state):
+    """Atomically replaces a user's revision record."""
+    with atomic_write(_get_user_revision_path(username)) as f:
+        json.dump(state, f)
+    notifier.notify(username)
+
+class RevisionBatch:
+    """
+    A write batch's view of a user's revision record.
+
+    Every write in the batch takes its revision from next_revision(); the
+    record is written once, after the batch's notes, when the batch ends.
+    """
+
+    def __init__(self, username):
+        self.username = username
+        self.state = None
+
+    def next_revision(self, deleted=None, reset=False):
+        """Bumps and returns the user's revision, recording a delete or clear with it."""
+        if self.state is None:
+            self.state = get_revision_state(self.username)
+        state = self.state
+        state['revision'] += 1
+        revision = state['revision']
+        if reset:
+            state['reset'] = revision
+            state['deleted'] = []
+        if deleted is not None:
+            state['deleted'].append([revision, deleted])
+            limit = app.config['DELETED_HISTORY_LIMIT']
+            if len(state['deleted']) > limit:
+                dropped = state['deleted'][:-limit]
+                state['deleted'] = state['deleted'][-limit:]
+                state['history_start'] = dropped[-1][0]
+        return revision
+
+    @property
+    def revision(self):
+        """The user's latest revision, including those handed out by this batch."""
+        return self.state['revision'] if self.state is not None else get_revision_state(self.username)['revision']
+
+@contextmanager
+def _open_write_batch(username):
+    """Opens a group commit for WriteCoordinator: notes are flushed first, then the revision record."""
+    batch = RevisionBatch(username)
+    try:
+        with note_store.group(username):
+            yield batch
+    finally:
+        if batch.state is not None:
+            _write_revision_state(username, batch.state)
+
+writes = WriteCoordinator(app.config['NOTES_DIR'], _open_write_batch,
+                          batch_limit=app.config['WRITE_BATCH_LIMIT'], offload=offload)
+
+def get_changes_since(username, since):
+    """
+    Returns the notes added or edited and the ids of notes deleted after revision `since`.
+
+    The notes file is only opened when the revision has moved past the cursor.
+    Cursors older than the last clear or the retained delete history get a
+    'reset' with the latest page of notes (and 'has_more') instead of a delta.
+    """
+    state = get_revision_state(username)
+    revision = state['revision']
+    changes = {"revision": revision, "reset": False, "notes": [], "deleted": []}
+    if since >= revision:
+        return changes
+    with _user_read_lock(username):
+        # Re-read under the lock so the revision never runs ahead of the notes file
+        state = get_revision_state(username)
+        changes['revision'] = state['revision']
+        if since < state['reset'] or since < state['history_start']:
+            changes['reset'] = True
+            changes['notes'], changes['has_more'] = note_store.page(username, app.config['NOTES_PAGE_SIZE'])
+            return changes
+        changes['notes'] = note_store.changed_since(username, since)
+        changes['deleted'] = [note_id_for(key) for rev, key in state['deleted'] if rev > since]
+    return changes
+
+class ChangeNotifier:
+    """
+    Wakes requests waiting on a user's notes when their revision changes.
+
+    Writes in this process notify directly. Writes from other gunicorn workers
+    are picked up by one watcher thread that stats the revision files of users
+    with open streams, so idle streams cost a stat per poll interval.
+    """
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._waiters = {}   # username -> number of waiting requests
+        self._sequence = {}  # username -> change counter seen by this process
+        self._stats = {}     # username -> last observed revision file stat
+        self._thread = None
+
+    def notify(self, username):
+        with self._cond:
+            self._sequence[username] = self._sequence.get(username, 0) + 1
+            self._cond.notify_all()
+
+    def wait_for_change(self, username, since, timeout):
+        """Blocks until the user's revision passes `since` or `timeout` expires; returns it."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._waiters[username] = self._waiters.get(username, 0) + 1
+            # Take the baseline before reading the revision so no change can slip in between
+            self._stats.setdefault(username, self._stat_revision_file(username))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name='change-notifier', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        try:
+            while True:
+                with self._cond:
+                    seen = self._sequence.get(username, 0)
+                revision = get_revision_state(username)['revision']
+                remaining = deadline - time.monotonic()
+                if revision > since or remaining <= 0:
+                    return revision
+                with self._cond:
+                    self._cond.wait_for(lambda: self._sequence.get(username, 0) != seen, remaining)
+        finally:
+            with self._cond:
+                self._waiters[username] -= 1
+                if not self._waiters[username]:
+                    del self._waiters[username]
+                    self._stats.pop(username, None)
+
+    @staticmethod
+    def _stat_revision_file(username):
+        try:
+            st = os.stat(_get_user_revision_path(username))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _watch(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._waiters)
+                usernames = list(self._waiters)
+            for username in usernames:
+                current = self._stat_revision_file(username)
+                with self._cond:
+                    if username in self._stats and self._stats[username] != current:
+                        self._sequence[username] = self._sequence.get(username, 0) + 1
+                        self._cond.notify_all()
+                    if username in self._waiters:
+                        self._stats[username] = current
+            time.sleep(self.poll_interval)
+
+notifier = ChangeNotifier(app.config['CHANGE_POLL_INTERVAL'])
 
 def get_notes_for_user(username):
     """Reads and sorts all notes for a given user."""
-    notes_file = _get_user_notes_path(username)
-    if not os.path.exists(notes_file):
-        return []
-    notes = []
-    with open(notes_file, 'r') as f:
-        for line in f:
-            try:
-                notes.append(json.loads(line))
-            except json.JSONDecodeError:
-                # Silently skip corrupted lines to prevent app crashes
-                continue
-    notes.sort(key=lambda x: x['timestamp'])
-    return notes
-
-def write_all_notes_for_user(username, notes):
-    """Rewrites the entire notes file for a user (for edit/delete operations)."""
-    notes_file = _get_user_notes_path(username)
-    with open(notes_file, 'w') as f:
-        for note in notes:
-            f.write(json.dumps(note) + '\n')
+    return note_store.list_notes(username)
+
+def _requested_note_id(username, data):
+    """
+    The id of the note an edit or delete request refers to, or None.
+
+    Requests name notes by 'id'; pages loaded before notes had ids still send
+    the note's 'timestamp', which is looked up instead.
+    """
+    if data.get('id') and isinstance(data['id'], str):
+        return data['id']
+    if data.get('timestamp') and isinstance(data['timestamp'], str):
+        return note_store.find_id(username, data['timestamp'])
+    return None
+
+def _note_error(note_text, attachment_data):
+    """Why a new note's text and attachment cannot be stored, or None if they can."""
+    if not isinstance(note_text, str):
+        return "Note text must be a string"
+    if attachment_data is not None:
+        if not isinstance(attachment_data, dict):
+            return "Attachment must be an object"
+        stored_name = attachment_data.get('stored_name')
+        if not isinstance(stored_name, str) or not is_safe_name(stored_name):
+            return "Invalid attachment"
+        if not isinstance(attachment_data.get('original_name', ''), str):
+            return "Invalid attachment"
+    if not note_text and not attachment_data:
+        return "Note cannot be empty"
+    return None
+
+def _batch_op_error(op):
+    """Why a /notes/batch operation is malformed, or None; checked before the batch runs."""
+    if not isinstance(op, dict):
+        return "Operation must be an object"
+    kind = op.get('op')
+    if kind == 'add':
+        return _note_error(op.get('note', ''), op.get('attachment'))
+    if kind not in ('edit', 'delete'):
+        return "Unknown operation"
+    if not isinstance(op.get('id'), str) and not isinstance(op.get('timestamp'), str):
+        return "Operation needs a note id"
+    if kind == 'edit' and not isinstance(op.get('new_text'), str):
+        return "new_text must be a string"
+    return None
+
+def _apply_add(batch, username, note_text, attachment_data):
+    """Stores a new note (checked with _note_error) as part of a write batch; returns it."""
+    # Claimed first, so the blob is never unreferenced while a note points at it
+    if attachment_data:
+        attachments.claim(username, attachment_data['stored_name'])
+    timestamp = datetime.utcnow().isoformat() + "Z" # UTC 'Z' for standard
+    new_note = {
+        "id": new_note_id(timestamp),
+        "text": note_text,
+        "timestamp": timestamp,
+        "attachment": attachment_data,
+        "rev": batch.next_revision()
+    }
+    note_store.add_note(username, new_note)
+    return new_note
+
+def _apply_edit(batch, username, data):
+    """Replaces a note's text as part of a write batch; returns the note, or None if it does not exist."""
+    note_id = _requested_note_id(username, data)
+    # Looked up first, so an edit of a missing note does not bump the revision
+    if note_id is None or not note_store.existing_ids(username, [note_id]):
+        return None
+    return note_store.update_note(username, note_id, {"text": data.get('new_text'), "rev": batch.next_revision()})
+
+def _apply_delete(batch, username, data):
+    """Deletes a note as part of a write batch; returns the deleted note, or None if it does not exist."""
+    note_id = _requested_note_id(username, data)
+    note_to_delete = note_store.delete_note(username, note_id) if note_id else None
+    if not note_to_delete:
+        return None
+
+    batch.next_revision(deleted=note_id)
+
+    # Delete the associated physical file once no other note uses it
+    if note_to_delete.get('attachment'):
+        stored_name = note_to_delete['attachment'].get('stored_name')
+        if stored_name and attachments.release(username, stored_name):
+            thumbnails.discard(username, stored_name)
+    return note_to_delete
+
+# --- Request Metrics ---
+
+metrics = Metrics(app.config['METRICS_DIR'], flush_interval=app.config['METRICS_FLUSH_INTERVAL'])
+metrics.describe('requests_total', 'counter', "Requests answered, by route, method and status.")
+metrics.describe('request_duration_seconds', 'histogram',
+                 "Time from the start of a request until its response body was sent.")
+metrics.describe('response_bytes_total', 'counter', "Body bytes of responses whose length was known up front.")
+metrics.describe('template_render_seconds', 'histogram', "Time spent rendering a template, filters included.")
+metrics.describe('slow_requests_total', 'counter', "Requests the slow-request profiler reported.")
+metrics.describe('notes_parsed_total', 'counter', "Note records decoded from the notes store.")
+metrics.describe('notes_read_bytes_total', 'counter', "Bytes of note records read from the notes store.")
+metrics.describe('notes_written_bytes_total', 'counter', "Bytes of note records written to the notes store.")
+metrics.describe('notes_rewrites_total', 'counter', "Notes logs rewritten in full (compactions and migrations).")
+metrics.describe('notes_cache_lookups_total', 'counter', "Notes cache lookups by result: hit, extend or miss.")
+metrics.describe('notes_cache_evictions_total', 'counter', "Folded notes logs evicted from the notes caches.")
+metrics.describe('notes_cache_bytes', 'gauge', "Estimated memory held by the notes caches of all workers.")
+metrics.describe('write_batches_total', 'counter', "Group commits of note writes.")
+metrics.describe('writes_total', 'counter', "Note writes committed by those batches.")
+metrics.describe('upload_written_bytes_total', 'counter', "Uploaded bytes written to disk.")
+
+def _store_metrics():
+    """Collector for the counters the stores and the write coordinator keep themselves."""
+    io = note_store.io_stats()
+    yield 'notes_parsed_total', {}, io['notes_parsed']
+    yield 'notes_read_bytes_total', {}, io['bytes_read']
+    yield 'notes_written_bytes_total', {}, io['bytes_written']
+    yield 'notes_rewrites_total', {}, io['rewrites']
+    cache = note_store.cache_stats()
+    if cache:
+        for result, key in (('hit', 'hits'), ('extend', 'extends'), ('miss', 'misses')):
+            yield 'notes_cache_lookups_total', {"result": result}, cache[key]
+        yield 'notes_cache_evictions_total', {}, cache['evictions']
+        yield 'notes_cache_bytes', {}, cache['bytes']
+    yield 'write_batches_total', {}, writes.batches
+    yield 'writes_total', {}, writes.writes
+    yield 'upload_written_bytes_total', {}, attachments.bytes_written
+
+metrics.add_collector(_store_metrics)
+
+def _report_slow_request(duration, samples, method, route):
+    metrics.inc('slow_requests_total', route=route)
+    hottest = '\n'.join(f"  {count:6d} {stack}"
+                        for stack, count in samples.most_common(app.config['SLOW_REQUEST_PROFILE_STACKS']))
+    app.logger.warning("Slow request %s %s took %.0f ms; hottest of %d stacks sampled every %.0f ms:\n%s",
+                       method, route, duration * 1000, sum(samples.values()),
+                       app.config['SLOW_REQUEST_SAMPLE_INTERVAL'] * 1000, hottest)
+
+profiler = None
+if app.config['SLOW_REQUEST_PROFILE_MS'] > 0 and is_patched():
+    # It samples native threads' stacks, and gevent workers run every request on one thread
+    app.logger.warning("SLOW_REQUEST_PROFILE_MS is ignored with gevent workers; use SERVER_MODE=threads to profile")
+elif app.config['SLOW_REQUEST_PROFILE_MS'] > 0:
+    profiler = SlowRequestProfiler(app.config['SLOW_REQUEST_PROFILE_MS'] / 1000, _report_slow_request,
+                                   interval=app.config['SLOW_REQUEST_SAMPLE_INTERVAL'])
+
+def _finish_request(route, method, status, length, started):
+    duration = time.perf_counter() - started
+    metrics.observe('request_duration_seconds', duration, route=route, method=method)
+    metrics.inc('requests_total', route=route, method=method, status=status)
+    if length:
+        metrics.inc('response_bytes_total', length, route=route)
+    if profiler is not None:
+        profiler.end(duration, method, route)
+    metrics.flush()
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    if profiler is not None:
+        profiler.begin()
+
+@app.after_request
+def _time_request(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        # Recorded when the server closes the response, so streamed bodies are timed in full
+        response.call_on_close(partial(_finish_request, route, request.method, response.status_code,
+                                       response.content_length, g.request_started))
+    return response
+
+@before_render_template.connect_via(app)
+def _start_template_timer(sender, template, context, **extra):
+    g.template_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _time_template(sender, template, context, **extra):
+    started = g.pop('template_started', None)
+    if started is not None:
+        metrics.observe('template_render_seconds', time.perf_counter() - started, template=template.name)
 
 # --- Decorator for Authentication ---
 
@@ -140,20 +577,13 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        users = _load_all_users()
 
-        if username in users:
-            # Existing user login
-            if users[username] == password:
-                session['username'] = username
-                return redirect(url_for('index'))
-            else:
-                return render_template('login.html', error='Invalid password.')
-        else:
-            # New user registration on first login
-            _save_new_user(username, password)
+        # Existing users are checked; an unknown username is registered on first login
+        if offload(users.login_or_register, username, password):
             session['username'] = username
             return redirect(url_for('index'))
+        else:
+            return render_template('login.html', error='Invalid password.')
 
     return render_template('login.html')
 
@@ -164,6 +594,29 @@ def logout():
 
 # --- File Handling Routes ---
 
+def _store_blob(username, tmp_path, sha256, extension):
+    # Same lock as note writes, so a blob cannot be released between being reused and being held
+    with _user_write_lock(username):
+        return attachments.commit(username, tmp_path, sha256, extension)
+
+def _commit_upload(username, tmp_path, sha256, size, original_filename):
+    """Stores a hashed upload as a content-addressed blob and builds the attachment response."""
+    file_extension = os.path.splitext(original_filename)[1]
+    stored_name = offload(_store_blob, username, tmp_path, sha256, file_extension)
+    attachment = {
+        "status": "success",
+        "original_name": original_filename,
+        "stored_name": stored_name,
+        "size": size
+    }
+    # Image dimensions let the page reserve space for the preview before it loads
+    if is_thumbnailable(stored_name):
+        dimensions = offload(probe_image, os.path.join(_get_user_uploads_path(username), stored_name))
+        if dimensions:
+            attachment["width"], attachment["height"] = dimensions
+            attachment["thumb"] = url_for('thumbnail', username=username, stored_name=stored_name)
+    return jsonify(attachment)
+
 @app.route('/upload_file', methods=['POST'])
 @login_required
 def upload_file():
@@ -172,22 +625,57 @@ def upload_file():
 
     file = request.files['file']
     original_filename = secure_filename(file.filename)
-    file_extension = os.path.splitext(original_filename)[1]
-    unique_filename = f"{uuid.uuid4().hex}{file_extension}"
+    username = session['username']
+    # The form parser has already spooled the file, so this only touches local disk
+    tmp_path, sha256, size = offload(attachments.save_stream, username, file.stream)
+    return _commit_upload(username, tmp_path, sha256, size, original_filename)
 
-    user_upload_path = _get_user_uploads_path(session['username'])
-    os.makedirs(user_upload_path, exist_ok=True) # Ensure directory exists
+@app.errorhandler(UploadError)
+def handle_upload_error(error):
+    body = {"status": "error", "message": str(error)}
+    if error.received is not None:
+        body["received"] = error.received
+    return jsonify(body), error.status
 
-    filepath = os.path.join(user_upload_path, unique_filename)
-    file.save(filepath)
-    file_size = os.path.getsize(filepath)
+@app.route('/uploads', methods=['POST'])
+@login_required
+def begin_upload():
+    """
+    Starts a resumable chunked upload: JSON {"filename", "size"} in, upload state out.
 
-    return jsonify({
-        "status": "success",
-        "original_name": original_filename,
-        "stored_name": unique_filename,
-        "size": file_size
-    })
+    The client then PUTs `chunk_size` pieces to /uploads/<id>?offset=<n>
+    (optionally with X-Chunk-SHA256), can GET /uploads/<id> to learn how much
+    arrived after a dropped connection, and POSTs /uploads/<id>/finalize to
+    get the same attachment JSON as /upload_file.
+    """
+    data = request.json or {}
+    original_filename = secure_filename(data.get('filename') or '')
+    if not original_filename:
+        return jsonify({"status": "error", "message": "No file selected"}), 400
+    state = attachments.begin_upload(session['username'], original_filename, data.get('size'))
+    return jsonify(dict(state, status="success"))
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    return jsonify(dict(attachments.upload_status(session['username'], upload_id), status="success"))
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({"status": "error", "message": "Chunk offset is required"}), 400
+    received = attachments.write_chunk(session['username'], upload_id, offset, request.stream,
+                                       request.headers.get('X-Chunk-SHA256'))
+    return jsonify({"status": "success", "received": received})
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    username = session['username']
+    tmp_path, sha256, size, original_filename = offload(attachments.finish_upload, username, upload_id)
+    return _commit_upload(username, tmp_path, sha256, size, original_filename)
 
 @app.route('/files/<username>/<filename>')
 @login_required
@@ -196,114 +684,318 @@ def download_file(username, filename):
     if username != session['username']:
         return "Forbidden", 403
 
-    user_upload_path = _get_user_uploads_path(username)
-    return send_from_directory(user_upload_path, filename, as_attachment=True)
+    file_path = os.path.join(_get_user_uploads_path(username), filename)
+    if not is_safe_name(filename) or not os.path.isfile(file_path):
+        return "Not Found", 404
+
+    # Content-addressed (sha256) and uuid names never change content, so their
+    # stem is a stable strong ETag and browsers may cache them forever.
+    stem = os.path.splitext(filename)[0]
+    immutable = len(stem) in (32, 64) and all(c in '0123456789abcdef' for c in stem)
+    as_attachment = not request.args.get('inline')
+
+    if app.config['DOWNLOAD_OFFLOAD'] == 'x-accel':
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = (f"{app.config['DOWNLOAD_ACCEL_PREFIX']}/"
+                                                f"{url_quote(username)}/{url_quote(filename)}")
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                             filename=filename)
+        if immutable:
+            response.set_etag(stem)
+    else:
+        # conditional=True answers If-None-Match with 304 and Range with 206
+        response = send_file(file_path, as_attachment=as_attachment, conditional=True,
+                             etag=stem if immutable else True)
+    if immutable:
+        response.cache_control.no_cache = False
+        response.cache_control.private = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    return response
+
+@app.route('/thumb/<username>/<stored_name>')
+@login_required
+def thumbnail(username, stored_name):
+    """
+    Serves a resized preview of an image attachment, `?w=` pixels wide.
+
+    Previews are rendered once per width and cached. If one cannot be made
+    (no Pillow, not a raster image, or it takes too long) the client is
+    redirected to the original file instead.
+    """
+    if username != session['username']:
+        return "Forbidden", 403
+
+    source_path = os.path.join(_get_user_uploads_path(username), stored_name)
+    if not is_safe_name(stored_name) or not os.path.isfile(source_path):
+        return "Not Found", 404
+
+    thumb_path = None
+    if is_thumbnailable(stored_name):
+        width = thumbnails.snap_width(request.args.get('w', 320, type=int))
+        thumb_path = thumbnails.get(username, source_path, stored_name, width, app.config['THUMB_WAIT'])
+    if thumb_path is None:
+        return redirect(url_for('download_file', username=username, filename=stored_name, inline=1))
+
+    # Blob names are content hashes, so a derivative's name never changes content either
+    response = send_file(thumb_path, conditional=True, etag=os.path.splitext(os.path.basename(thumb_path))[0])
+    response.cache_control.no_cache = False
+    response.cache_control.private = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
 
 # --- Main Application Routes ---
 
+def _read_page(username, limit, before_id=None):
+    """Returns (revision, notes, has_more) for a page of notes read under the user's read lock."""
+    with _user_read_lock(username):
+        revision = get_revision_state(username)['revision']
+        notes, has_more = note_store.page(username, limit, before_id)
+    return revision, notes, has_more
+
 @app.route('/')
 @login_required
 def index():
-    notes = get_notes_for_user(session['username'])
-    return render_template('index.html', username=session['username'], notes=notes)
+    username = session['username']
+    revision, notes, has_more = offload(_read_page, username, app.config['NOTES_PAGE_SIZE'])
+    return render_template('index.html', username=username, notes=notes, has_more=has_more,
+                           revision=revision)
 
 @app.route('/get_notes')
 @login_required
 def get_notes_api():
-    """API endpoint to fetch notes, useful for dynamic frontend updates."""
-    notes = get_notes_for_user(session['username'])
-    return jsonify(notes)
+    """
+    API endpoint to fetch notes, useful for dynamic frontend updates.
+
+    Without arguments it returns every note. With `?since=<revision>` it returns
+    only the changes after that cursor. With `?limit=<n>[&before_id=<note id>]`
+    it returns a page of the newest notes below the cursor, oldest first, plus
+    'has_more' and the 'before_id' cursor of the next page (an older
+    `before=<timestamp>` cursor is still accepted). All forms carry the
+    revision as an ETag, so an unchanged If-None-Match gets a 304 without
+    opening the notes file.
+    """
+    username = session['username']
+    since = request.args.get('since', type=int)
+    limit = request.args.get('limit', type=int)
+    revision = get_revision_state(username)['revision']
+    query = request.query_string.decode()
+    etag = f"{revision}?{query}" if query else f"{revision}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif since is not None:
+        response = jsonify(offload(get_changes_since, username, since))
+    elif limit is not None:
+        limit = max(1, min(limit, 500))
+        before_id = request.args.get('before_id') or None
+        if before_id is None and request.args.get('before'):
+            before_id = note_id_floor(request.args['before'])
+        if before_id is not None and not is_note_id(before_id):
+            return jsonify({"status": "error", "message": "Invalid before_id cursor"}), 400
+        revision, notes, has_more = offload(_read_page, username, limit, before_id)
+        response = jsonify({"revision": revision, "notes": notes, "has_more": has_more,
+                            "before_id": notes[0]['id'] if notes else None})
+    else:
+        response = jsonify(offload(get_notes_for_user, username))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    """Reports this worker's notes cache and write batching counters (each gunicorn worker has its own)."""
+    return jsonify({"pid": os.getpid(), "notes_cache": note_store.cache_stats(),
+                    "write_batches": {"batches": writes.batches, "writes": writes.writes}})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Request and hot-path metrics of all workers, in the Prometheus text format."""
+    token = app.config['METRICS_TOKEN']
+    # Per-route traffic is not for everyone, so there is no open default
+    if not token:
+        return "Not Found", 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return "Unauthorized", 401
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/stream_notes')
+@login_required
+def stream_notes():
+    """
+    Server-Sent Events stream of note changes, the push counterpart of /get_notes?since=.
+
+    Each event carries the same payload as a delta response and uses the
+    revision as its id, so a reconnecting EventSource resumes via Last-Event-ID.
+    Streams end after STREAM_MAX_DURATION to let workers recycle connections.
+    """
+    username = session['username']
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    heartbeat = app.config['STREAM_HEARTBEAT']
+    ends_at = time.monotonic() + app.config['STREAM_MAX_DURATION']
+
+    def generate(cursor):
+        yield 'retry: 2000\n\n'
+        while time.monotonic() < ends_at:
+            revision = notifier.wait_for_change(username, cursor, heartbeat)
+            if revision > cursor:
+                changes = offload(get_changes_since, username, cursor)
+                cursor = changes['revision']
+                yield f"id: {cursor}\nevent: changes\ndata: {json.dumps(changes)}\n\n"
+            else:
+                yield ': keep-alive\n\n'
+
+    return app.response_class(stream_with_context(generate(since)), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _refresh_search_index(username):
+    """Rebuilds the user's search index from the notes store unless it caught up meanwhile."""
+    with _user_write_lock(username):
+        revision = get_revision_state(username)['revision']
+        if search_index.indexed_revision(username) != revision:
+            search_index.rebuild(username, note_store.iter_notes(username), revision)
+
+@app.route('/search')
+@login_required
+def search():
+    """
+    Full-text search over note text and attachment names, best matches first.
+
+    Takes `q`, `limit` and `offset`. The user's index is (re)built from the
+    notes store on first use or whenever it lags their revision.
+    """
+    username = session['username']
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"status": "error", "message": "Search query cannot be empty"}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    if search_index.indexed_revision(username) != get_revision_state(username)['revision']:
+        offload(_refresh_search_index, username)
+
+    results, has_more = offload(search_index.search, username, query, limit, offset)
+    return jsonify({"results": results, "has_more": has_more,
+                    "next_offset": offset + len(results) if has_more else None})
 
 @app.route('/add_note', methods=['POST'])
 @login_required
 def add_note():
-    data = request.json
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Expected a JSON object"}), 400
     note_text = data.get('note', '')
     attachment_data = data.get('attachment')
 
-    if not note_text and not attachment_data:
-        return jsonify({"status": "error", "message": "Note cannot be empty"}), 400
+    error = _note_error(note_text, attachment_data)
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
 
-    new_note = {
-        "text": note_text,
-        "timestamp": datetime.utcnow().isoformat() + "Z", # UTC 'Z' for standard
-        "attachment": attachment_data
-    }
+    username = session['username']
 
-    notes_file = _get_user_notes_path(session['username'])
-    with open(notes_file, 'a') as f:
-        f.write(json.dumps(new_note) + '\n')
+    def add(batch):
+        new_note = _apply_add(batch, username, note_text, attachment_data)
+        search_index.update_notes(username, new_note['rev'], added=[new_note])
+        return new_note
 
+    new_note = writes.submit(username, add)
     return jsonify({"status": "success", "note": new_note})
 
 @app.route('/edit_note', methods=['POST'])
 @login_required
 def edit_note():
     data = request.json
-    timestamp_to_edit = data.get('timestamp')
-    new_text = data.get('new_text')
     username = session['username']
 
-    notes = get_notes_for_user(username)
-    note_found = False
-    for note in notes:
-        if note['timestamp'] == timestamp_to_edit:
-            note['text'] = new_text
-            note_found = True
-            break
+    def edit(batch):
+        note = _apply_edit(batch, username, data)
+        if note is not None:
+            search_index.index_note(username, note, note['rev'])
+        return note
 
-    if note_found:
-        write_all_notes_for_user(username, notes)
-        return jsonify({"status": "success"})
-    return jsonify({"status": "error", "message": "Note not found"}), 404
+    if writes.submit(username, edit) is None:
+        return jsonify({"status": "error", "message": "Note not found"}), 404
+    return jsonify({"status": "success"})
 
 @app.route('/delete_note', methods=['POST'])
 @login_required
 def delete_note():
-    timestamp_to_delete = request.json.get('timestamp')
+    data = request.json
     username = session['username']
-    notes = get_notes_for_user(username)
 
-    note_to_delete = next((n for n in notes if n['timestamp'] == timestamp_to_delete), None)
+    def delete(batch):
+        note_to_delete = _apply_delete(batch, username, data)
+        if note_to_delete:
+            search_index.remove_note(username, note_to_delete['id'], batch.revision)
+        return note_to_delete
 
-    if not note_to_delete:
+    if not writes.submit(username, delete):
         return jsonify({"status": "error", "message": "Note not found"}), 404
+    return jsonify({"status": "success"})
 
-    # Delete the associated physical file if it exists
-    if note_to_delete.get('attachment'):
-        stored_name = note_to_delete['attachment'].get('stored_name')
-        if stored_name:
-            file_path = os.path.join(_get_user_uploads_path(username), stored_name)
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except OSError as e:
-                    # The file couldn't be deleted, but we still proceed to delete
-                    # the note record. Log this for debugging.
-                    print(f"Error deleting file {file_path}: {e}")
-
-    # Remove the note record and rewrite the file
-    notes_after_deletion = [n for n in notes if n['timestamp'] != timestamp_to_delete]
-    write_all_notes_for_user(username, notes_after_deletion)
+@app.route('/notes/batch', methods=['POST'])
+@login_required
+def notes_batch():
+    """Applies a list of add, edit and delete operations in one write batch (see the module docstring)."""
+    data = request.get_json(silent=True)
+    ops = data.get('ops') if isinstance(data, dict) else None
+    if not isinstance(ops, list) or not ops:
+        return jsonify({"status": "error", "message": "Expected a non-empty list of ops"}), 400
+    if len(ops) > app.config['BATCH_MAX_OPS']:
+        return jsonify({"status": "error",
+                        "message": f"At most {app.config['BATCH_MAX_OPS']} operations per batch"}), 413
+    username = session['username']
+    errors = [_batch_op_error(op) for op in ops]
 
-    return jsonify({"status": "success"})
+    def apply(batch):
+        results, added, changed, removed = [], [], [], []
+        for op, error in zip(ops, errors):
+            if error is not None:
+                results.append({"status": "error", "message": error})
+            elif op['op'] == 'add':
+                note = _apply_add(batch, username, op.get('note', ''), op.get('attachment'))
+                added.append(note)
+                results.append({"status": "success", "note": note})
+            else:
+                kind = op['op']
+                note = _apply_edit(batch, username, op) if kind == 'edit' else _apply_delete(batch, username, op)
+                if note is None:
+                    results.append({"status": "error", "message": "Note not found"})
+                elif kind == 'edit':
+                    changed.append(note)
+                    results.append({"status": "success", "note": note})
+                else:
+                    removed.append(note['id'])
+                    results.append({"status": "success", "id": note['id']})
+        if added or changed or removed:
+            search_index.update_notes(username, batch.revision, added, changed, removed)
+        return results, batch.revision
+
+    results, revision = writes.submit(username, apply)
+    return jsonify({"status": "success", "revision": revision, "results": results})
 
 @app.route('/clear_notes', methods=['POST'])
 @login_required
 def clear_notes():
     password = request.json.get('password')
-    users = _load_all_users()
     username = session['username']
 
     # Verify password before destructive action
-    if users.get(username) == password:
-        notes_file = _get_user_notes_path(username)
-        if os.path.exists(notes_file):
-            os.remove(notes_file)
+    if offload(users.verify, username, password):
+        def clear(batch):
+            batch.next_revision(reset=True)
+            note_store.clear(username)
+            search_index.drop(username)
+            thumbnails.clear(username)
+
+        writes.submit(username, clear)
 
         user_upload_dir = _get_user_uploads_path(username)
         if os.path.exists(user_upload_dir):
-            shutil.rmtree(user_upload_dir)
+            offload(shutil.rmtree, user_upload_dir)
 
         return jsonify({"status": "success"})
     else:
@@ -312,8 +1004,7 @@ def clear_notes():
 # --- Export Routes ---
 
 def _format_notes_for_export(notes_data):
-    """Helper to consistently format notes for various export types."""
-    formatted_notes = []
+    """Helper to consistently format notes for various export types; yields one line per note."""
     for note in notes_data:
         try:
             dt_object = datetime.fromisoformat(note['timestamp'].replace('Z', '+00:00'))
@@ -321,53 +1012,163 @@ def _format_notes_for_export(notes_data):
             note_text = f"{timestamp_prefix} - {note['text']}"
             if note.get('attachment'):
                 note_text += f" [Attachment: {note['attachment']['original_name']}]"
-            formatted_notes.append(note_text)
+            yield note_text
         except (ValueError, KeyError):
             # Skip malformed notes
             continue
-    return formatted_notes
+
+def _in_chunks(pieces, chunk_size=64 * 1024):
+    """Joins streamed strings into ~chunk_size byte chunks so each WSGI write carries real data."""
+    buffer, size = [], 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+def _gzipped(chunks):
+    """Gzip-compresses a stream of byte chunks on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def _streamed_download(chunks, mimetype, download_name):
+    """Builds an attachment response that streams `chunks` instead of buffering the file."""
+    # Reading and encoding the notes is blocking work; only sending the chunks is cooperative
+    response = app.response_class(offload_iter(chunks), mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return response
+
+class _CsvLine:
+    """File-like stand-in that hands each csv.writer row back instead of storing it."""
+    def write(self, line):
+        return line
+
+def _csv_rows(formatted_notes):
+    writer = csv.writer(_CsvLine())
+    yield writer.writerow(['Note'])
+    for note in formatted_notes:
+        yield writer.writerow([note])
+
+def _txt_blocks(formatted_notes):
+    for i, note in enumerate(formatted_notes):
+        yield note if i == 0 else '\n\n' + note
+
+def _xlsx_file(notes_data):
+    """Writes the notes as a one-column workbook into a spooled temp file, rewound for reading."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Notes")
+    ws.append(['Note'])
+    for note in _format_notes_for_export(notes_data):
+        ws.append([note])
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=app.config['EXPORT_SPOOL_BYTES'])
+    wb.save(spooled_file)
+    spooled_file.seek(0)
+    return spooled_file
 
 @app.route('/export/<filetype>')
 @login_required
 def export(filetype):
-    """Dispatcher route for exporting notes to different file formats."""
-    notes_data = get_notes_for_user(session['username'])
-    formatted_notes = _format_notes_for_export(notes_data)
+    """
+    Dispatcher route for exporting notes to different file formats.
+
+    txt, csv, jsonl and ndjson.gz are streamed note by note from the store;
+    xlsx is written row by row by openpyxl's write-only mode into a spooled
+    temp file. Memory use stays flat however many notes a user has.
+    """
     username = session['username']
-    
+    notes_data = note_store.iter_notes(username)
+
     if filetype == 'txt':
-        output = '\n\n'.join(formatted_notes)
-        return send_file(io.BytesIO(output.encode('utf-8')),
-                         mimetype='text/plain', as_attachment=True,
-                         download_name=f'{username}_notes.txt')
+        return _streamed_download(_in_chunks(_txt_blocks(_format_notes_for_export(notes_data))),
+                                  'text/plain', f'{username}_notes.txt')
 
     elif filetype == 'csv':
-        mem_file = io.StringIO()
-        writer = csv.writer(mem_file)
-        writer.writerow(['Note'])
-        for note in formatted_notes:
-            writer.writerow([note])
-        mem_file.seek(0)
-        return send_file(io.BytesIO(mem_file.read().encode('utf-8')),
-                         mimetype='text/csv', as_attachment=True,
-                         download_name=f'{username}_notes.csv')
+        return _streamed_download(_in_chunks(_csv_rows(_format_notes_for_export(notes_data))),
+                                  'text/csv', f'{username}_notes.csv')
+
+    elif filetype == 'jsonl':
+        return _streamed_download(_in_chunks(json.dumps(note) + '\n' for note in notes_data),
+                                  'application/x-ndjson', f'{username}_notes.jsonl')
+
+    elif filetype == 'ndjson.gz':
+        return _streamed_download(_gzipped(_in_chunks(json.dumps(note) + '\n' for note in notes_data)),
+                                  'application/gzip', f'{username}_notes.ndjson.gz')
 
     elif filetype == 'xlsx':
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Notes"
-        ws.append(['Note'])
-        for note in formatted_notes:
-            ws.append([note])
-        mem_file = io.BytesIO()
-        wb.save(mem_file)
-        mem_file.seek(0)
-        return send_file(mem_file,
+        spooled_file = offload(_xlsx_file, notes_data)
+        return send_file(spooled_file,
                          mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
                          as_attachment=True, download_name=f'{username}_notes.xlsx')
 
     return "Invalid file type", 400
 
+# --- Import Route ---
+
+def _chunked(items, size):
+    """Groups an iterable into lists of up to `size` items without reading ahead further."""
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+def _import_chunk(batch, username, notes, stats):
+    """Stores one chunk of imported notes as part of a write batch, skipping ids the user already has."""
+    existing = note_store.existing_ids(username, [note['id'] for note in notes if 'id' in note])
+    added = []
+    for note in notes:
+        if note.get('id') in existing:
+            stats['duplicates'] += 1
+            continue
+        attachment = note.get('attachment')
+        if attachment and not attachments.has_blob(username, attachment.get('stored_name')):
+            attachment = None  # the file it pointed to is not stored for this user
+        if not note['text'] and not attachment:
+            stats['skipped'] += 1
+            continue
+        note_id = note.get('id') or new_note_id(note['timestamp'])
+        existing.add(note_id)
+        added.append({"id": note_id, "text": note['text'], "timestamp": note['timestamp'],
+                      "attachment": attachment})
+    if not added:
+        return
+    # Imported notes land among older ones, so open pages reload instead of appending them
+    revision = batch.next_revision(reset=True)
+    for note in added:
+        note['rev'] = revision
+    note_store.add_notes(username, added)
+    for stored_name, count in Counter(n['attachment']['stored_name'] for n in added if n['attachment']).items():
+        attachments.retain(username, stored_name, count)
+    search_index.update_notes(username, revision, added=added)
+    stats['imported'] += len(added)
+
+@app.route('/import', methods=['POST'])
+@login_required
+def import_notes():
+    """Imports notes from a file in any of the /export formats (see the module docstring)."""
+    request.max_content_length = app.config['IMPORT_MAX_SIZE']
+    username = session['username']
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or format_for(upload.filename if upload else None)
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({"status": "error",
+                        "message": f"Unknown import format; use one of: {', '.join(IMPORT_FORMATS)}"}), 400
+
+    stats = {"imported": 0, "duplicates": 0, "skipped": 0}
+    notes = read_notes(fmt, upload.stream if upload else request.stream, stats)
+    try:
+        for chunk in _chunked(notes, app.config['IMPORT_CHUNK_NOTES']):
+            writes.submit(username, partial(_import_chunk, username=username, notes=chunk, stats=stats))
+    except ImportFormatError as e:
+        return jsonify(dict(stats, status="error", message=str(e))), 400
+    return jsonify(dict(stats, status="success"))
+
 # The if __name__ == '__main__': block is not needed for PythonAnywhere deployment,
 # as it uses a different method to run the app. You can either remove it entirely
 # or leave it as-is for local testing. It will not be executed on the server.
@@ -0,0 +1,320 @@
+"""
+Content-addressed storage for note attachments.
+
+Blobs live in `<uploads_dir>/<username>/` named `<sha256><ext>`, so a file
+uploaded twice by the same user is stored once. `.refs.json` in the same
+directory counts the notes that use each blob; a blob is removed when its
+last note is deleted. Blobs from before content addressing (uuid names) have
+no count and are treated as used by exactly one note.
+
+Uploads arrive either in one request (save_stream) or as a resumable
+sequence of chunks (begin_upload / write_chunk / finish_upload) staged in
+`.partial/`. commit() counts the upload itself as a use of its blob (a
+hold, listed under the refs file's '.held' key) until the note created for
+it claims the hold, so a blob an upload reuses cannot be removed by a
+delete in between. Holds no note claims expire after `partial_ttl`, like
+staged uploads. Callers in app.py hold the user's write lock around commit,
+claim, retain and release, so counts and blob removal never race.
+
+`offload(func, *args)`, if given, runs write_chunk's wait for the chunk
+lock; app.py passes cooperative.offload so that, under gevent, a chunk
+queued behind a retry of itself does not stall the worker's event loop.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import tempfile
+
+from storage_utils import atomic_write
+
+COPY_BUFFER_SIZE = 64 * 1024
+HELD_KEY = '.held'  # refs file key of {stored_name: [hold times]}; blob names never start with a dot
+
+
+class UploadError(Exception):
+    """A chunked-upload request the client must fix; carries the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, received=None):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+
+def is_safe_name(name):
+    """True if `name` is a plain file name that cannot escape the user's directory."""
+    return bool(name) and os.path.basename(name) == name and not name.startswith('.')
+
+
+class AttachmentStore:
+    """Stores, deduplicates and reference-counts each user's attachment blobs."""
+
+    def __init__(self, uploads_dir, chunk_size, max_upload_size, partial_ttl=24 * 3600, offload=None):
+        self.uploads_dir = uploads_dir
+        self.chunk_size = chunk_size
+        self.max_upload_size = max_upload_size
+        self.partial_ttl = partial_ttl
+        self.offload = offload or (lambda func, *args: func(*args))
+        self.bytes_written = 0  # upload bytes this process wrote to disk
+
+    def user_dir(self, username):
+        path = os.path.join(self.uploads_dir, username)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _partial_dir(self, username):
+        path = os.path.join(self.user_dir(username), '.partial')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # --- Blobs and reference counts ---
+
+    def save_stream(self, username, stream):
+        """
+        Streams `stream` to a temp file while hashing it.
+
+        Returns (temp path, sha256 hex, size); pass the result to commit().
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.user_dir(username), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    data = stream.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    size += len(data)
+                    f.write(data)
+                    self.bytes_written += len(data)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest(), size
+
+    def commit(self, username, tmp_path, sha256, extension):
+        """
+        Moves a hashed temp file into place as a blob, or drops it if the blob already exists.
+
+        The blob is held for the upload until claim() or expiry, so it counts as used by one more note.
+        """
+        stored_name = f"{sha256}{extension.lower()}"
+        blob_path = os.path.join(self.user_dir(username), stored_name)
+        refs = self._load_refs(username)
+        self._expire_holds(username, refs)
+        if os.path.exists(blob_path):
+            os.unlink(tmp_path)
+            refs[stored_name] = self._count(username, refs, stored_name) + 1
+        else:
+            os.replace(tmp_path, blob_path)
+            refs[stored_name] = 1
+        refs.setdefault(HELD_KEY, {}).setdefault(stored_name, []).append(time.time())
+        self._save_refs(username, refs)
+        return stored_name
+
+    def _refs_path(self, username):
+        return os.path.join(self.user_dir(username), '.refs.json')
+
+    def _load_refs(self, username):
+        try:
+            with open(self._refs_path(username), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_refs(self, username, refs):
+        with atomic_write(self._refs_path(username), prefix='.refs-') as f:
+            json.dump(refs, f)
+
+    def _count(self, username, refs, stored_name):
+        """The notes using a blob; one for a blob stored before counting (no entry), none for a missing one."""
+        if stored_name in refs:
+            return refs[stored_name]
+        return 1 if os.path.isfile(os.path.join(self.user_dir(username), stored_name)) else 0
+
+    def has_blob(self, username, stored_name):
+        return (isinstance(stored_name, str) and is_safe_name(stored_name)
+                and os.path.isfile(os.path.join(self.user_dir(username), stored_name)))
+
+    def _expire_holds(self, username, refs):
+        """Drops holds older than partial_ttl from `refs`, removing blobs no note uses any more."""
+        held = refs.get(HELD_KEY, {})
+        cutoff = time.time() - self.partial_ttl
+        for stored_name in list(held):
+            expired = sum(1 for held_at in held[stored_name] if held_at < cutoff)
+            if not expired:
+                continue
+            held[stored_name] = [held_at for held_at in held[stored_name] if held_at >= cutoff]
+            if not held[stored_name]:
+                del held[stored_name]
+            remaining = refs.pop(stored_name, expired) - expired
+            if remaining > 0:
+                refs[stored_name] = remaining
+            else:
+                self._remove_blob(username, stored_name)
+
+    def claim(self, username, stored_name):
+        """Records a new note using the blob, taking over the hold of the upload it came from if there is one."""
+        if not is_safe_name(stored_name):
+            return
+        refs = self._load_refs(username)
+        self._expire_holds(username, refs)
+        held = refs.get(HELD_KEY, {})
+        if held.get(stored_name):
+            # The upload's hold already counts this note
+            held[stored_name].pop(0)
+            if not held[stored_name]:
+                del held[stored_name]
+        else:
+            refs[stored_name] = self._count(username, refs, stored_name) + 1
+        self._save_refs(username, refs)
+
+    def retain(self, username, stored_name, count=1):
+        """Records `count` more notes using the blob."""
+        if not is_safe_name(stored_name):
+            return
+        refs = self._load_refs(username)
+        refs[stored_name] = self._count(username, refs, stored_name) + count
+        self._save_refs(username, refs)
+
+    def release(self, username, stored_name):
+        """Records one note fewer using the blob, deleting it when no note is left; True if it was deleted."""
+        if not is_safe_name(stored_name):
+            return False
+        refs = self._load_refs(username)
+        remaining = refs.pop(stored_name, 1) - 1
+        if remaining > 0:
+            refs[stored_name] = remaining
+        self._save_refs(username, refs)
+        if remaining > 0:
+            return False
+        self._remove_blob(username, stored_name)
+        return True
+
+    def _remove_blob(self, username, stored_name):
+        file_path = os.path.join(self.user_dir(username), stored_name)
+        if os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                # The file couldn't be deleted, but the note record is already gone.
+                # Log this for debugging.
+                print(f"Error deleting file {file_path}: {e}")
+
+    # --- Chunked uploads ---
+
+    def _upload_paths(self, username, upload_id):
+        if not (len(upload_id) == 32 and all(c in '0123456789abcdef' for c in upload_id)):
+            raise UploadError("Unknown upload", status=404)
+        base = os.path.join(self._partial_dir(username), upload_id)
+        return f"{base}.json", f"{base}.part"
+
+    def _expire_partials(self, username):
+        """
+        Removes staged uploads nobody has touched for partial_ttl seconds.
+
+        Chunks only touch `<id>.part`, so it dates the upload and its `<id>.json` goes with it.
+        """
+        partial_dir = self._partial_dir(username)
+        cutoff = time.time() - self.partial_ttl
+        for upload_id in {os.path.splitext(name)[0] for name in os.listdir(partial_dir)}:
+            base = os.path.join(partial_dir, upload_id)
+            try:
+                touched = os.path.getmtime(f"{base}.part")
+            except OSError:
+                try:
+                    touched = os.path.getmtime(f"{base}.json")
+                except OSError:
+                    continue
+            if touched >= cutoff:
+                continue
+            for path in (f"{base}.json", f"{base}.part"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def begin_upload(self, username, filename, size):
+        """Starts a chunked upload; returns its state (upload_id, chunk_size, received)."""
+        if not isinstance(size, int) or size < 0:
+            raise UploadError("A non-negative file size is required")
+        if size > self.max_upload_size:
+            raise UploadError("File is too large", status=413)
+        self._expire_partials(username)
+        upload_id = uuid.uuid4().hex
+        state_path, part_path = self._upload_paths(username, upload_id)
+        open(part_path, 'wb').close()
+        with open(state_path, 'w') as f:
+            json.dump({"filename": filename, "size": size}, f)
+        return {"upload_id": upload_id, "chunk_size": self.chunk_size, "received": 0, "size": size}
+
+    def upload_status(self, username, upload_id):
+        state = self._load_upload(username, upload_id)
+        _, part_path = self._upload_paths(username, upload_id)
+        return {"upload_id": upload_id, "chunk_size": self.chunk_size,
+                "received": os.path.getsize(part_path), "size": state['size']}
+
+    def _load_upload(self, username, upload_id):
+        state_path, _ = self._upload_paths(username, upload_id)
+        try:
+            with open(state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise UploadError("Unknown upload", status=404)
+
+    def write_chunk(self, username, upload_id, offset, stream, expected_sha256=None):
+        """
+        Appends one chunk at `offset`, which must equal the bytes received so far.
+
+        The chunk is streamed to disk while hashed; if `expected_sha256` is given
+        and does not match, the chunk is discarded. Returns the bytes received.
+        """
+        state = self._load_upload(username, upload_id)
+        _, part_path = self._upload_paths(username, upload_id)
+        with open(part_path, 'r+b') as f:
+            # Serializes retries of the same chunk arriving at different workers
+            self.offload(fcntl.flock, f, fcntl.LOCK_EX)
+            received = os.fstat(f.fileno()).st_size
+            if offset != received:
+                raise UploadError("Chunk offset does not match received bytes", status=409, received=received)
+            f.seek(received)
+            digest = hashlib.sha256()
+            written = 0
+            while True:
+                data = stream.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                written += len(data)
+                if written > self.chunk_size or received + written > state['size']:
+                    f.truncate(received)
+                    raise UploadError("Chunk is larger than allowed", status=413, received=received)
+                digest.update(data)
+                f.write(data)
+                self.bytes_written += len(data)
+            if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+                f.truncate(received)
+                raise UploadError("Chunk checksum mismatch", received=received)
+            f.flush()
+            return received + written
+
+    def finish_upload(self, username, upload_id):
+        """
+        Hashes a fully received upload and stages it for commit().
+
+        Returns (temp path, sha256 hex, size, original filename).
+        """
+        state = self._load_upload(username, upload_id)
+        state_path, part_path = self._upload_paths(username, upload_id)
+        received = os.path.getsize(part_path)
+        if received != state['size']:
+            raise UploadError("Upload is incomplete", status=409, received=received)
+        # Chunks may have reached different workers, so the whole-file digest is taken here
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for data in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                digest.update(data)
+        os.remove(state_path)
+        return part_path, digest.hexdigest(), received, state['filename']
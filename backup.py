@@ -1,166 +1,483 @@
 import os
-import requests
 import datetime
 import shutil
 import json
 import sys
-from typing import List, Optional
-
-# --- IMPORTS NEEDED FOR THE SSL FIX ---
-import ssl
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.poolmanager import PoolManager
-
-# --- Custom Adapter to handle SSL/TLS incompatibility ---
-class TlsAdapter(HTTPAdapter):
-    """A custom requests adapter to handle servers with older SSL/TLS protocols."""
-    def init_poolmanager(self, connections, maxsize, block=False):
-        """Create a pool manager with a custom, more compatible SSL context."""
-        ctx = ssl.create_default_context()
-        ctx.set_ciphers('DEFAULT@SECLEVEL=1') # Use a more compatible security level
-        self.poolmanager = PoolManager(
-            num_pools=connections,
-            maxsize=maxsize,
-            block=block,
-            ssl_context=ctx
-        )
+import io
+import argparse
+import hashlib
+import sqlite3
+import tarfile
+import tempfile
+import fnmatch
+from typing import Dict, List, Optional, Tuple
+
+from backup_codecs import ParallelCompressor, available_codecs, copy_decompressed, default_codec
+from backup_targets import DrimeTarget, LocalDirectoryTarget, PartUploader, S3Target
+from storage_utils import atomic_write
+from user_store import UserStore
 
 # --- Configuration ---
 # The directory where THIS script is running (ephemeral filesystem on Render)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Scratch space for archives while they are written and uploaded
+BASE_DIR = os.environ.get('BACKUP_WORK_DIR', SCRIPT_DIR)
 
 # The directory where user data is stored (the persistent disk on Render)
 # This will be '/data' on Render, or the local directory '.' for testing.
 DATA_DIR = os.environ.get('RENDER_DATA_DIR', '.')
 
+# The manifest of the last backup must survive restarts, so it lives on the data disk
+BACKUP_STATE_DIR = os.path.join(DATA_DIR, '.backup')
+MANIFEST_PATH = os.path.join(BACKUP_STATE_DIR, 'manifest.json')
+# Name of the manifest inside every archive; restore starts from it
+ARCHIVE_MANIFEST = 'MANIFEST.json'
+ARCHIVE_PREFIX = 'quickpad_backup_'
+# After this many incremental backups the next one is a full backup again,
+# which bounds the number of archives a restore needs
+FULL_BACKUP_EVERY = int(os.environ.get('BACKUP_FULL_EVERY', 30))
+
+# Where archives go: 's3' (BACKUP_S3_BUCKET / BACKUP_S3_PREFIX), 'local'
+# (BACKUP_LOCAL_DIR, no network) or 'drime'. Archives are uploaded in parts of
+# BACKUP_PART_SIZE bytes, BACKUP_UPLOAD_WORKERS at a time, while still being
+# written. Drime.Cloud takes a file only in one request, so its parts are
+# spooled locally and sent (and retried) as a whole. The default is S3 once a
+# bucket is set, else Drime as before; the local directory is only used when
+# asked for, since on Render it does not outlive the instance. It keeps the
+# archives of the newest BACKUP_LOCAL_KEEP_FULL full backups and their
+# incrementals, and removes older chains after each successful backup.
+BACKUP_S3_BUCKET = os.environ.get('BACKUP_S3_BUCKET', '')
+BACKUP_TARGET = os.environ.get('BACKUP_TARGET', 's3' if BACKUP_S3_BUCKET else 'drime')
+BACKUP_S3_PREFIX = os.environ.get('BACKUP_S3_PREFIX', 'quickpad/')
+BACKUP_LOCAL_DIR = os.environ.get('BACKUP_LOCAL_DIR', BASE_DIR)
+BACKUP_LOCAL_KEEP_FULL = int(os.environ.get('BACKUP_LOCAL_KEEP_FULL', 2))
+BACKUP_PART_SIZE = int(os.environ.get('BACKUP_PART_SIZE', 16 * 1024 * 1024))
+BACKUP_UPLOAD_WORKERS = int(os.environ.get('BACKUP_UPLOAD_WORKERS', 4))
+# Compression: each file is compressed on its own with BACKUP_CODEC ('zstd',
+# 'deflate' or 'store') across BACKUP_COMPRESS_WORKERS processes
+BACKUP_CODEC = os.environ.get('BACKUP_CODEC', default_codec())
+BACKUP_LEVEL = int(os.environ['BACKUP_LEVEL']) if os.environ.get('BACKUP_LEVEL') else None
+BACKUP_COMPRESS_WORKERS = int(os.environ.get('BACKUP_COMPRESS_WORKERS', os.cpu_count() or 1))
+
 DRIME_API_URL = "https://app.drime.cloud/api/v1"
-# It is strongly recommended to set this as an Environment Variable on Render
+# It is strongly recommended to set this as an Environment Variable on Render; deployments
+# that never did rely on this built-in key, which is why Drime stays the default target
 DRIME_API_KEY = os.environ.get('DRIME_API_KEY', "3449|CvNDnkwSz1nVbpfx1WLqAmTVg7N0haSwZb6R8xjgdbfed638")
 
 SOURCES_TO_BACKUP: List[str] = [
     'users.txt',
+    'users.sqlite3',
     'user_notes',
     'user_uploads'
 ]
 
+# Lock files, SQLite side files, in-progress uploads and the search indexes
+# (rebuilt from the notes on demand) are not worth backing up
+EXCLUDE_PATTERNS: List[str] = [
+    '*.lock', '*-wal', '*-shm', '*-journal', '*.search.sqlite3', '*.rebuild-*',
+    '.upload-*', '.refs-*', '.partial',
+]
+
+# The plaintext legacy accounts file is only backed up until users.sqlite3 has imported it
+LEGACY_USERS_FILE = 'users.txt'
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
 # --- Helper Functions ---
 
-def create_backup_archive() -> Optional[str]:
+def _is_excluded(name: str) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in EXCLUDE_PATTERNS)
+
+def _legacy_users_imported() -> bool:
+    db_path = os.path.join(DATA_DIR, 'users.sqlite3')
+    return os.path.exists(db_path) and UserStore(db_path).imported_from(os.path.join(DATA_DIR, LEGACY_USERS_FILE))
+
+def iter_source_files():
+    """
+    Yields (relative path, absolute path) for every file to back up.
+
+    Relative paths use '/' and are relative to DATA_DIR, so they double as
+    archive member names.
     """
-    Creates a timestamped ZIP archive of specified sources and returns its full path.
+    for src_name in SOURCES_TO_BACKUP:
+        if src_name == LEGACY_USERS_FILE and _legacy_users_imported():
+            continue
+        source_path = os.path.join(DATA_DIR, src_name)
+        if os.path.isfile(source_path):
+            yield src_name, source_path
+        elif os.path.isdir(source_path):
+            for root, dirs, files in os.walk(source_path):
+                dirs[:] = sorted(d for d in dirs if not _is_excluded(d))
+                for name in sorted(files):
+                    if not _is_excluded(name):
+                        path = os.path.join(root, name)
+                        yield os.path.relpath(path, DATA_DIR).replace(os.sep, '/'), path
+        else:
+            print(f"  - WARNING: Source '{src_name}' not found, skipping.")
 
-    A temporary directory is used to assemble the files before zipping, which
-    is cleaned up automatically.
+def _hash_open_file(f, size: int) -> str:
+    """Hashes the first `size` bytes of an open file, then rewinds it."""
+    digest = hashlib.sha256()
+    remaining = size
+    while remaining > 0:
+        data = f.read(min(HASH_BUFFER_SIZE, remaining))
+        if not data:
+            break
+        digest.update(data)
+        remaining -= len(data)
+    f.seek(0)
+    return digest.hexdigest()
+
+def _snapshot_sqlite(path: str, work_dir: str) -> str:
+    """Copies a live SQLite database with the online backup API, so the copy is consistent."""
+    fd, snapshot_path = tempfile.mkstemp(dir=work_dir, prefix='.snapshot-', suffix='.sqlite3')
+    os.close(fd)
+    source = sqlite3.connect(path, timeout=30)
+    target = sqlite3.connect(snapshot_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return snapshot_path
+
+def load_manifest(path: str = MANIFEST_PATH) -> Optional[dict]:
+    """Returns the manifest of the last successful backup, or None if there was none."""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(manifest: dict, path: str = MANIFEST_PATH) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, prefix='.manifest-') as f:
+        json.dump(manifest, f)
+
+def next_archive(full: bool = False) -> Tuple[str, Optional[dict]]:
+    """
+    Names the next archive and loads the manifest it builds on.
+
+    Args:
+        full (bool): Ignore the previous manifest and take a full backup.
 
     Returns:
-        Optional[str]: The full path to the created .zip archive, or None if creation fails.
+        Tuple[str, Optional[dict]]: The archive name and the previous manifest (None for a full backup).
     """
+    previous = None if full else load_manifest()
+    if previous and previous.get('sequence', 0) >= FULL_BACKUP_EVERY:
+        print(f"  - {FULL_BACKUP_EVERY} incremental backups since the last full one; taking a full backup.")
+        previous = None
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    archive_name = f'quickpad_backup_{timestamp}'
-    archive_path_without_ext = os.path.join(BASE_DIR, archive_name)
-    temp_archive_dir = os.path.join(BASE_DIR, f"temp_backup_{timestamp}")
+    suffix = f"incremental-{previous.get('sequence', 0) + 1}" if previous else 'full'
+    return f'{ARCHIVE_PREFIX}{timestamp}_{suffix}.tar', previous
 
-    print("Starting backup process...")
-    print(f"Creating archive: {archive_name}.zip")
-    os.makedirs(temp_archive_dir, exist_ok=True)
+def prune_local_archives(directory: str, keep_full: int) -> List[str]:
+    """
+    Removes archives older than the newest `keep_full` full backups from a local target directory.
 
-    try:
-        for src_name in SOURCES_TO_BACKUP:
-            source_path = os.path.join(DATA_DIR, src_name)
-            if os.path.exists(source_path):
-                dest_path = os.path.join(temp_archive_dir, src_name)
-                if os.path.isdir(source_path):
-                    shutil.copytree(source_path, dest_path)
-                else:
-                    shutil.copy2(source_path, dest_path)
-                print(f"  - Added '{src_name}' to be archived.")
-            else:
-                print(f"  - WARNING: Source '{src_name}' not found, skipping.")
-
-        final_archive_path = shutil.make_archive(
-            base_name=archive_path_without_ext,
-            format='zip',
-            root_dir=temp_archive_dir
-        )
-        print("Archive created successfully.")
-        return final_archive_path
-    except Exception as e:
-        print(f"ERROR: Failed to create archive: {e}")
-        return None
-    finally:
-        if os.path.exists(temp_archive_dir):
-            shutil.rmtree(temp_archive_dir)
-        
-def upload_to_drime_root(token: str, file_path: str) -> Optional[int]:
+    Every archive of a chain (a full backup and the incrementals after it)
+    is kept together, since restoring any of them needs the whole chain.
+
+    Args:
+        directory (str): The LocalDirectoryTarget directory.
+        keep_full (int): Full backups to keep, with their incrementals; 0 keeps everything.
+
+    Returns:
+        List[str]: The names of the removed archives.
+    """
+    if keep_full <= 0:
+        return []
+    # Timestamps in the names sort chronologically
+    archives = sorted(name for name in os.listdir(directory)
+                      if name.startswith(ARCHIVE_PREFIX) and name.endswith('.tar'))
+    fulls = [i for i, name in enumerate(archives) if name.endswith('_full.tar')]
+    if len(fulls) <= keep_full:
+        return []
+    removed = archives[:fulls[-keep_full]]
+    for name in removed:
+        os.remove(os.path.join(directory, name))
+    print(f"  - Removed {len(removed)} archives older than the last {keep_full} full backups.")
+    return removed
+
+def write_backup_archive(out, archive_name: str, previous: Optional[dict],
+                         codec: str, level: Optional[int], workers: int) -> dict:
     """
-    Uploads a file to the Drime.Cloud root directory.
+    Streams a .tar of everything changed since `previous` into `out`.
+
+    Each file is compared with the previous manifest by size and mtime, and
+    by SHA-256 when those differ, so only changed notes files and new upload
+    blobs are packed. Content already stored in an earlier archive of the
+    chain (the same blob under another name, say) is referenced rather than
+    packed again. The new manifest lists every file of the snapshot with the
+    archive and member holding its content; it is written into the archive
+    as MANIFEST.json and only becomes the local baseline once the caller
+    calls save_manifest() after a successful upload.
+
+    Members are compressed one file at a time on a process pool (see
+    backup_codecs); the manifest records each file's codec for restore.
 
     Args:
-        token (str): The API authorization bearer token.
-        file_path (str): The local path to the file to upload.
+        out: A writable binary stream, e.g. a PartUploader.
+        archive_name (str): The name the archive is stored under.
+        previous (Optional[dict]): The manifest to diff against, or None for a full backup.
+        codec (str): 'zstd', 'deflate' or 'store'.
+        level (Optional[int]): Compression level, or None for the codec's default.
+        workers (int): Compression processes.
 
     Returns:
-        Optional[int]: The HTTP status code of the upload request, or None on a connection error.
+        dict: The new manifest.
     """
-    filename = os.path.basename(file_path)
-    print(f"Uploading '{filename}' to Drime.Cloud root directory...")
-    
-    main_url = f"{DRIME_API_URL}/uploads"
-    headers = {"Authorization": f"Bearer {token}"}
+    kind = 'incremental' if previous else 'full'
+    print(f"Creating {kind} archive: {archive_name}")
 
-    session = requests.Session()
-    session.mount('https://', TlsAdapter())
+    previous_files: Dict[str, dict] = previous['files'] if previous else {}
+    # Content already stored somewhere in the chain: sha256 -> the manifest entry that stored it
+    known_content = {entry['sha256']: entry for entry in previous_files.values()}
+    manifest = {
+        "archive": archive_name,
+        "kind": kind,
+        "created": datetime.datetime.now().isoformat(),
+        "base": previous['base'] if previous else archive_name,
+        "sequence": previous.get('sequence', 0) + 1 if previous else 0,
+        "codec": codec,
+        "files": {},
+    }
+    packed = reused = 0
 
-    try:
-        with open(file_path, 'rb') as f:
-            files_payload = {'file': (filename, f, 'application/zip')}
-            response = session.post(main_url, headers=headers, files=files_payload, timeout=600)
-            response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
-
-        print(f"Upload successful with status code: {response.status_code}")
-        return response.status_code
-    except requests.exceptions.HTTPError as http_err:
-        print(f"ERROR: HTTP error during upload: {http_err}")
-        print(f"Server response: {http_err.response.text}")
-        return http_err.response.status_code
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR: A network error occurred during upload: {e}")
-        return None
+    # Stream mode ('w|') only ever appends to `out`, so it can feed an upload directly
+    with tarfile.open(fileobj=out, mode='w|') as tar:
+        packer = ParallelCompressor(tar, codec, level, workers, spool_dir=BASE_DIR)
+        try:
+            for rel_path, path in iter_source_files():
+                snapshot_path = None
+                try:
+                    if path.endswith('.sqlite3'):
+                        snapshot_path = _snapshot_sqlite(path, BASE_DIR)
+                        read_path = snapshot_path
+                    else:
+                        read_path = path
+                    with open(read_path, 'rb') as f:
+                        st = os.fstat(f.fileno())
+                        size, mtime = st.st_size, os.stat(path).st_mtime
+                        old = previous_files.get(rel_path)
+                        if old and snapshot_path is None and old['size'] == size and old['mtime'] == mtime:
+                            # Unchanged since the last backup; trust the recorded hash
+                            manifest['files'][rel_path] = old
+                            reused += 1
+                            continue
+                        entry = {"size": size, "mtime": mtime, "sha256": _hash_open_file(f, size)}
+                        origin = known_content.get(entry['sha256'])
+                        if origin:
+                            entry.update(archive=origin['archive'], member=origin['member'], origin=origin)
+                            reused += 1
+                        else:
+                            entry.update(archive=archive_name, member=rel_path)
+                            packer.add(entry, rel_path, f, size, mtime)
+                            known_content[entry['sha256']] = entry
+                            packed += 1
+                except FileNotFoundError:
+                    # Removed while the backup ran (compaction, a deleted blob)
+                    continue
+                finally:
+                    if snapshot_path:
+                        os.remove(snapshot_path)
+                manifest['files'][rel_path] = entry
+            packer.finish()
+        finally:
+            packer.close()
 
-def main() -> None:
-    """Main function to run the entire backup process."""
-    print(f"\n--- Starting QuickPad Backup on {datetime.datetime.now()} ---")
-    
-    if not DRIME_API_KEY:
-        print("FATAL ERROR: DRIME_API_KEY is not set. Exiting.");
-        sys.exit(1)
+        # Copies share their origin's codec, which is only known once the origin is written
+        for entry in manifest['files'].values():
+            origin = entry.pop('origin', None)
+            if origin is not None:
+                entry['codec'] = origin.get('codec', 'store')
 
-    archive_path = None
-    try:
-        # Step 1: Create the local backup archive
-        archive_path = create_backup_archive()
-        if not archive_path:
-            print("ERROR: Backup archive creation failed. Aborting process.")
-            sys.exit(1)
+        manifest_bytes = json.dumps(manifest, indent=1).encode('utf-8')
+        info = tarfile.TarInfo(ARCHIVE_MANIFEST)
+        info.size = len(manifest_bytes)
+        info.mtime = int(datetime.datetime.now().timestamp())
+        tar.addfile(info, io.BytesIO(manifest_bytes))
+
+    print(f"  - Packed {packed} files ({packer.raw_bytes} bytes, {packer.packed_bytes} after {codec}); "
+          f"{reused} unchanged or already stored.")
+    return manifest
+
+def make_target(name: str):
+    """
+    Builds the upload target named on the command line or in BACKUP_TARGET.
 
-        # Step 2: Upload the archive to the cloud
-        upload_status = upload_to_drime_root(DRIME_API_KEY, archive_path)
-        # A successful upload returns a status code (e.g., 200 or 201), which is a "truthy" value.
-        # A failed upload returns None or a 4xx/5xx code. We only check for None here,
-        # as raise_for_status() handles HTTP errors.
-        if upload_status is None:
-            print("ERROR: Drime.Cloud upload failed due to a connection or request error.")
+    Args:
+        name (str): 's3', 'local' or 'drime'.
+
+    Returns:
+        BackupTarget: The configured target.
+    """
+    if name == 'drime':
+        if not DRIME_API_KEY:
+            print("FATAL ERROR: DRIME_API_KEY is not set. Exiting.");
+            sys.exit(1)
+        return DrimeTarget(DRIME_API_URL, DRIME_API_KEY, BASE_DIR, part_size=BACKUP_PART_SIZE)
+    if name == 's3':
+        if not BACKUP_S3_BUCKET:
+            print("FATAL ERROR: BACKUP_S3_BUCKET is not set. Exiting.");
             sys.exit(1)
+        return S3Target(BACKUP_S3_BUCKET, BACKUP_S3_PREFIX, part_size=BACKUP_PART_SIZE)
+    if name == 'local':
+        return LocalDirectoryTarget(BACKUP_LOCAL_DIR, part_size=BACKUP_PART_SIZE)
+    print(f"FATAL ERROR: Unknown backup target '{name}'. Exiting.")
+    sys.exit(1)
+
+# --- Restore ---
+
+def read_archive_manifest(archive_path: str) -> dict:
+    """Returns the MANIFEST.json stored in a backup archive."""
+    with tarfile.open(archive_path, 'r:*') as tar:
+        member = tar.getmember(ARCHIVE_MANIFEST)
+        return json.load(tar.extractfile(member))
+
+class _HashingWriter:
+    """Passes writes through to a file while hashing them."""
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.digest.update(data)
+        return self.f.write(data)
+
+def restore_snapshot(archive_dir: str, snapshot: str, dest_dir: str) -> int:
+    """
+    Rebuilds the data directory as it was when `snapshot` was taken.
+
+    The snapshot's manifest names, for every file, the archive (the snapshot
+    itself, an earlier incremental or the full base) holding its content.
+    Each needed archive is read once, sequentially, and every extracted file
+    is decompressed with its recorded codec and checked against its SHA-256.
+
+    Args:
+        archive_dir (str): Directory holding the downloaded archives of the chain.
+        snapshot (str): File name of the archive to restore to.
+        dest_dir (str): Where to write the restored files; it should be empty.
+
+    Returns:
+        int: The number of files restored.
+    """
+    manifest = read_archive_manifest(os.path.join(archive_dir, snapshot))
+    print(f"Restoring {manifest['kind']} snapshot '{snapshot}' taken {manifest['created']} "
+          f"({len(manifest['files'])} files, base '{manifest['base']}')")
+
+    # archive -> member -> [(relative path, manifest entry)]; one member may back several paths
+    needed: Dict[str, Dict[str, list]] = {}
+    for rel_path, entry in manifest['files'].items():
+        needed.setdefault(entry['archive'], {}).setdefault(entry['member'], []).append((rel_path, entry))
+
+    missing = [name for name in needed if not os.path.exists(os.path.join(archive_dir, name))]
+    if missing:
+        raise FileNotFoundError(f"Archives needed for this snapshot are missing: {', '.join(sorted(missing))}")
+
+    restored = 0
+    for archive_name, members in needed.items():
+        print(f"  - Reading {len(members)} files from '{archive_name}'")
+        # Stream mode: the archive is decompressed once, front to back
+        with tarfile.open(os.path.join(archive_dir, archive_name), 'r|*') as tar:
+            for member in tar:
+                targets = members.pop(member.name, None)
+                if not targets:
+                    continue
+                source = tar.extractfile(member)
+                first_path = None
+                for rel_path, entry in targets:
+                    dest_path = os.path.join(dest_dir, *rel_path.split('/'))
+                    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                    if first_path is None:
+                        with open(dest_path, 'wb') as f:
+                            out = _HashingWriter(f)
+                            # Archives from before per-file compression hold members as they are
+                            copy_decompressed(entry.get('codec', 'store'), source, out)
+                        if out.digest.hexdigest() != entry['sha256']:
+                            raise ValueError(f"Checksum mismatch for '{rel_path}' in '{archive_name}'")
+                        first_path = dest_path
+                    else:
+                        shutil.copyfile(first_path, dest_path)
+                    os.utime(dest_path, (entry['mtime'], entry['mtime']))
+                    restored += 1
+        if members:
+            raise ValueError(f"'{archive_name}' lacks members: {', '.join(sorted(members))}")
+    print(f"Restored {restored} files into '{dest_dir}'.")
+    return restored
+
+def run_backup(full: bool, target_name: str, upload_workers: int,
+               codec: str, level: Optional[int], compress_workers: int) -> None:
+    """Writes and uploads an archive as one pipeline, then records its manifest as the next baseline."""
+    target = make_target(target_name)
+    archive_name, previous = next_archive(full)
+    print("Starting backup process...")
+    try:
+        # Step 1: Compress into the uploader; full parts go up while later files are still packed
+        uploader = PartUploader(target, archive_name, workers=upload_workers)
+        try:
+            manifest = write_backup_archive(uploader, archive_name, previous, codec, level, compress_workers)
+        except BaseException:
+            uploader.abort()
+            raise
+        finally:
+            # Step 2: Send the last part and publish the archive
+            uploader.close()
+        print(f"Backup stored at {uploader.location} ({uploader.bytes_written} bytes).")
+
+        # Step 3: Later incrementals build on this archive only once it is stored safely
+        save_manifest(manifest)
+
+        # Step 4: A local directory has no lifecycle rules of its own
+        if isinstance(target, LocalDirectoryTarget):
+            prune_local_archives(target.directory, BACKUP_LOCAL_KEEP_FULL)
 
     except Exception as e:
         # Catch any unexpected exceptions during the process
         print(f"\n--- An unexpected error occurred during the backup process: {e} ---")
-    finally:
-        # Step 3: Clean up the local archive file
-        if archive_path and os.path.exists(archive_path):
-            print(f"Cleaning up local archive: {os.path.basename(archive_path)}")
-            os.remove(archive_path)
+        sys.exit(1)
+
+def main() -> None:
+    """
+    Command line entry point.
 
+    `python backup.py` takes an incremental backup (a full one the first time)
+    and uploads it to BACKUP_TARGET; `--full` forces a full backup, `--target`
+    picks another target and `--no-upload` is short for `--target local`. `python backup.py restore ARCHIVE_DIR
+    SNAPSHOT DEST` rebuilds a point-in-time copy from downloaded archives.
+    """
+    parser = argparse.ArgumentParser(description="QuickPad backups")
+    subparsers = parser.add_subparsers(dest='command')
+    parser.add_argument('--full', action='store_true', help="Pack every file instead of only changes")
+    parser.add_argument('--target', choices=['s3', 'local', 'drime'], default=BACKUP_TARGET,
+                        help="Where to upload the archive (default: %(default)s)")
+    parser.add_argument('--no-upload', action='store_true', help="Keep the archive in BACKUP_LOCAL_DIR")
+    parser.add_argument('--upload-workers', type=int, default=BACKUP_UPLOAD_WORKERS,
+                        help="Parts uploaded in parallel (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=BACKUP_COMPRESS_WORKERS,
+                        help="Processes compressing files (default: %(default)s)")
+    parser.add_argument('--codec', choices=available_codecs(), default=BACKUP_CODEC,
+                        help="Compression for files that are not already compressed (default: %(default)s)")
+    parser.add_argument('--level', type=int, default=BACKUP_LEVEL, help="Compression level (default: codec's own)")
+    restore_parser = subparsers.add_parser('restore', help="Rebuild a snapshot from a base archive plus deltas")
+    restore_parser.add_argument('archive_dir', help="Directory holding the downloaded archives")
+    restore_parser.add_argument('snapshot', help="File name of the archive to restore to")
+    restore_parser.add_argument('dest', help="Directory to restore into")
+    args = parser.parse_args()
+
+    if args.command == 'restore':
+        try:
+            restore_snapshot(args.archive_dir, args.snapshot, args.dest)
+        except (OSError, ValueError, KeyError, tarfile.TarError) as e:
+            print(f"ERROR: Restore failed: {e}")
+            sys.exit(1)
+        return
+
+    print(f"\n--- Starting QuickPad Backup on {datetime.datetime.now()} ---")
+    run_backup(full=args.full, target_name='local' if args.no_upload else args.target,
+               upload_workers=args.upload_workers, codec=args.codec, level=args.level,
+               compress_workers=args.workers)
     print(f"--- Backup process finished at {datetime.datetime.now()} ---")
 
 if __name__ == "__main__":
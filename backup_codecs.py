@@ -0,0 +1,174 @@
+"""
+Per-file compression for backup archives, spread over a process pool.
+
+Each packed file becomes one tar member compressed on its own with the
+archive's codec: 'zstd' (needs the zstandard package), 'deflate' (gzip) or
+'store'. Files are cut into fixed-size blocks that worker processes compress
+independently; the results are concatenated in order, which is still one
+valid stream because both zstd and gzip allow several frames/members back
+to back. A single large upload therefore uses every core, not just one.
+
+Formats that are already compressed (photos, PDFs, archives, office files)
+are stored as they are without a round trip through the pool.
+"""
+import os
+import zlib
+import shutil
+import tarfile
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; deflate is always available
+    zstandard = None
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_LEVELS = {'zstd': 3, 'deflate': 6, 'store': 0}
+# Compressing these again costs CPU and saves next to nothing
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.mp4', '.m4a', '.mov', '.webm', '.ogg',
+    '.pdf', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub',
+}
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def available_codecs():
+    return ['zstd', 'deflate', 'store'] if zstandard is not None else ['deflate', 'store']
+
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'deflate'
+
+
+def compress_block(codec, level, data):
+    """Compresses one block into a self-contained zstd frame or gzip member (runs in a worker process)."""
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == 'deflate':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        return compressor.compress(data) + compressor.flush()
+    return data
+
+
+def copy_decompressed(codec, source, out):
+    """Streams a member written by ParallelCompressor from `source` into `out`, decompressing it."""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("This archive was compressed with zstd; install the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True)
+        shutil.copyfileobj(reader, out, COPY_BUFFER_SIZE)
+    elif codec == 'deflate':
+        decompressor = zlib.decompressobj(31)
+        while True:
+            data = source.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            while data:
+                out.write(decompressor.decompress(data))
+                # Each block is its own gzip member; start over on the next one
+                data = decompressor.unused_data if decompressor.eof else b''
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(31)
+    else:
+        shutil.copyfileobj(source, out, COPY_BUFFER_SIZE)
+
+
+class ParallelCompressor:
+    """
+    Adds files to a stream-mode tar, compressing their blocks on a process pool.
+
+    add() reads a file's blocks and queues them; at most `2 * workers` blocks
+    are in flight, and whenever the window is full the oldest block is
+    collected. A file's compressed blocks are gathered in a spooled temp file
+    and written as a tar member once its last block is in, so members keep
+    the order they were added in. Each entry dict passed to add() gets its
+    'codec' filled in. Call finish() before closing the tar.
+    """
+
+    def __init__(self, tar, codec, level=None, workers=None, block_size=DEFAULT_BLOCK_SIZE,
+                 spool_dir=None, spool_bytes=32 * 1024 * 1024):
+        if codec not in available_codecs():
+            raise ValueError(f"Unsupported codec '{codec}'; available: {', '.join(available_codecs())}")
+        self.tar = tar
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.spool_dir = spool_dir
+        self.spool_bytes = spool_bytes
+        # One worker compresses in this process; spawning a pool would only add copying
+        self._pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 and codec != 'store' else None
+        self._window = deque()  # (pending member, future or bytes, is last block)
+        self._pending = None
+        self.raw_bytes = 0
+        self.packed_bytes = 0
+
+    def add(self, entry, member_name, f, size, mtime):
+        """Packs the first `size` bytes of open file `f` as `member_name`."""
+        extension = os.path.splitext(member_name)[1].lower()
+        self.raw_bytes += size
+        if self.codec == 'store' or extension in STORED_EXTENSIONS:
+            self._drain()
+            entry['codec'] = 'store'
+            self._write_member(member_name, f, size, mtime)
+            return
+
+        member = {"entry": entry, "name": member_name, "mtime": mtime,
+                  "spool": tempfile.SpooledTemporaryFile(max_size=self.spool_bytes, dir=self.spool_dir)}
+        remaining = size
+        while True:
+            data = f.read(min(self.block_size, remaining))
+            remaining -= len(data)
+            last = remaining <= 0 or not data
+            if self._pool is not None:
+                result = self._pool.submit(compress_block, self.codec, self.level, data)
+            else:
+                result = compress_block(self.codec, self.level, data)
+            self._window.append((member, result, last))
+            while len(self._window) > 2 * self.workers:
+                self._collect()
+            if last:
+                break
+
+    def _collect(self):
+        member, result, last = self._window.popleft()
+        data = result if isinstance(result, bytes) else result.result()
+        member['spool'].write(data)
+        if last:
+            spool = member['spool']
+            size = spool.tell()
+            spool.seek(0)
+            member['entry']['codec'] = self.codec
+            self._write_member(member['name'], spool, size, member['mtime'])
+            spool.close()
+
+    def _drain(self):
+        while self._window:
+            self._collect()
+
+    def _write_member(self, member_name, f, size, mtime):
+        info = tarfile.TarInfo(member_name)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        self.tar.addfile(info, f)
+        self.packed_bytes += size
+
+    def finish(self):
+        """Writes every queued file and stops the pool."""
+        try:
+            self._drain()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        for member, _, _ in self._window:
+            member['spool'].close()
+        self._window.clear()
@@ -0,0 +1,346 @@
+"""
+Destinations for backup archives, fed part by part while the archive is still being written.
+
+backup.py streams the archive into a PartUploader, which cuts the byte stream
+into fixed-size parts and hands each to a thread pool as soon as it is full,
+so parts upload in parallel while later ones are still being compressed.
+Every part is retried with exponential backoff before the run gives up, and
+a bounded number of parts in flight keeps memory flat when the network is
+slower than compression.
+
+A target implements begin / upload_part / complete / abort:
+
+- S3Target uses S3 multipart uploads (boto3).
+- LocalDirectoryTarget assembles parts in a directory; it needs no network
+  and is what `--no-upload` and tests use.
+- DrimeTarget has no multipart API to talk to, so parts are spooled to a
+  local file and sent in one streamed request (retried as a whole) through
+  a pooled, reused session. Only S3Target gets parallel part uploads over
+  the network, which is why backup.py defaults to S3 once a bucket is
+  configured (and otherwise stays on Drime).
+"""
+import os
+import io
+import ssl
+import mimetypes
+import time
+import uuid
+import random
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.poolmanager import PoolManager
+
+DEFAULT_PART_SIZE = 16 * 1024 * 1024  # S3 requires at least 5 MiB for all but the last part
+
+
+def with_retries(action, description, attempts=5, base_delay=1.0):
+    """Calls `action()` until it succeeds, sleeping base_delay * 2^n (plus jitter) between tries."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return action()
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = base_delay * 2 ** (attempt - 1) * (1 + random.random() / 2)
+            print(f"  - WARNING: {description} failed ({e}); retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 1}/{attempts}).")
+            time.sleep(delay)
+
+
+# --- Custom Adapter to handle SSL/TLS incompatibility ---
+class TlsAdapter(HTTPAdapter):
+    """A custom requests adapter to handle servers with older SSL/TLS protocols."""
+    def init_poolmanager(self, connections, maxsize, block=False):
+        """Create a pool manager with a custom, more compatible SSL context."""
+        ctx = ssl.create_default_context()
+        ctx.set_ciphers('DEFAULT@SECLEVEL=1') # Use a more compatible security level
+        self.poolmanager = PoolManager(
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            ssl_context=ctx
+        )
+
+
+class BackupTarget:
+    """A place archives can be uploaded to in parts."""
+
+    part_size = DEFAULT_PART_SIZE
+
+    def begin(self, name):
+        """Starts uploading archive `name`; returns an opaque upload handle."""
+        raise NotImplementedError
+
+    def upload_part(self, upload, number, data):
+        """Stores part `number` (1-based); returns a receipt passed back to complete()."""
+        raise NotImplementedError
+
+    def complete(self, upload, receipts):
+        """Publishes the archive from its parts; `receipts` are ordered by part number."""
+        raise NotImplementedError
+
+    def abort(self, upload):
+        """Discards a failed upload's parts."""
+        raise NotImplementedError
+
+
+class LocalDirectoryTarget(BackupTarget):
+    """Writes archives into a local directory; parts are staged next to it and joined at the end."""
+
+    def __init__(self, directory, part_size=DEFAULT_PART_SIZE):
+        self.directory = directory
+        self.part_size = part_size
+        os.makedirs(directory, exist_ok=True)
+
+    def begin(self, name):
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=f".{name}.parts-")
+        return {"name": name, "staging": staging}
+
+    def upload_part(self, upload, number, data):
+        with open(os.path.join(upload['staging'], f"{number:06d}"), 'wb') as f:
+            f.write(data)
+        return number
+
+    def complete(self, upload, receipts):
+        final_path = os.path.join(self.directory, upload['name'])
+        tmp_path = os.path.join(upload['staging'], 'assembled')
+        with open(tmp_path, 'wb') as out:
+            for number in receipts:
+                with open(os.path.join(upload['staging'], f"{number:06d}"), 'rb') as part:
+                    shutil.copyfileobj(part, out)
+        os.replace(tmp_path, final_path)
+        shutil.rmtree(upload['staging'], ignore_errors=True)
+        return final_path
+
+    def abort(self, upload):
+        shutil.rmtree(upload['staging'], ignore_errors=True)
+
+
+class S3Target(BackupTarget):
+    """Uploads archives to s3://bucket/prefix with S3 multipart uploads."""
+
+    def __init__(self, bucket, prefix='', part_size=DEFAULT_PART_SIZE, client=None):
+        import boto3  # only needed when this target is used
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.client = client or boto3.client('s3')
+
+    def begin(self, name):
+        key = f"{self.prefix}{name}"
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)
+        return {"key": key, "upload_id": response['UploadId']}
+
+    def upload_part(self, upload, number, data):
+        response = self.client.upload_part(Bucket=self.bucket, Key=upload['key'], UploadId=upload['upload_id'],
+                                           PartNumber=number, Body=data)
+        return {"PartNumber": number, "ETag": response['ETag']}
+
+    def complete(self, upload, receipts):
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=upload['key'], UploadId=upload['upload_id'],
+                                              MultipartUpload={"Parts": receipts})
+        return f"s3://{self.bucket}/{upload['key']}"
+
+    def abort(self, upload):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=upload['key'], UploadId=upload['upload_id'])
+
+
+class _MultipartFile(io.RawIOBase):
+    """A multipart/form-data body read lazily from a file, so large uploads are never held in memory."""
+
+    def __init__(self, field, filename, content_type, path):
+        self.boundary = uuid.uuid4().hex
+        self._head = (f"--{self.boundary}\r\n"
+                      f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                      f"Content-Type: {content_type}\r\n\r\n").encode()
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._file = open(path, 'rb')
+        self.len = len(self._head) + os.path.getsize(path) + len(self._tail)
+        self._pieces = [io.BytesIO(self._head), self._file, io.BytesIO(self._tail)]
+        self._position = 0
+
+    def __len__(self):
+        return self.len
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        # requests sizes the body as len() - tell() to send a Content-Length instead of chunks
+        return self._position
+
+    def read(self, size=-1):
+        chunks = []
+        while self._pieces and (size < 0 or size > 0):
+            data = self._pieces[0].read(size)
+            if not data:
+                self._pieces.pop(0)
+                continue
+            chunks.append(data)
+            self._position += len(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(chunks)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class DrimeTarget(BackupTarget):
+    """
+    Uploads archives to the Drime.Cloud root directory.
+
+    The Drime API takes a file in one request, so parts are written into a
+    local spool at their offsets and complete() streams the spool up in a
+    single POST, retried as a whole.
+    """
+
+    def __init__(self, api_url, token, work_dir, part_size=DEFAULT_PART_SIZE, attempts=5):
+        self.api_url = api_url
+        self.token = token
+        self.work_dir = work_dir
+        self.part_size = part_size
+        self.attempts = attempts
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """One session per target, so the TLS connection is reused across calls."""
+        with self._session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+                self._session.mount('https://', TlsAdapter())
+                self._session.headers['Authorization'] = f"Bearer {self.token}"
+            return self._session
+
+    def begin(self, name):
+        fd, spool_path = tempfile.mkstemp(dir=self.work_dir, prefix=f".{name}.spool-")
+        return {"name": name, "fd": fd, "spool": spool_path}
+
+    def upload_part(self, upload, number, data):
+        os.pwrite(upload['fd'], data, (number - 1) * self.part_size)
+        return number
+
+    def complete(self, upload, receipts):
+        os.close(upload['fd'])
+
+        def post():
+            content_type = mimetypes.guess_type(upload['name'])[0] or 'application/octet-stream'
+            body = _MultipartFile('file', upload['name'], content_type, upload['spool'])
+            try:
+                response = self.session.post(f"{self.api_url}/uploads", data=body, timeout=(30, 600),
+                                             headers={"Content-Type": f"multipart/form-data; boundary={body.boundary}"})
+                if response.status_code >= 500:
+                    response.raise_for_status()  # server-side failures are worth retrying
+            finally:
+                body.close()
+            return response
+
+        try:
+            print(f"Uploading '{upload['name']}' to Drime.Cloud root directory...")
+            response = with_retries(post, "Drime.Cloud upload", self.attempts)
+            if response.status_code >= 400:
+                print(f"Server response: {response.text}")
+            response.raise_for_status()  # Raises an HTTPError for bad responses (4xx or 5xx)
+            print(f"Upload successful with status code: {response.status_code}")
+        finally:
+            os.remove(upload['spool'])
+        return f"drime:{upload['name']}"
+
+    def abort(self, upload):
+        try:
+            os.close(upload['fd'])
+        except OSError:
+            pass
+        try:
+            os.remove(upload['spool'])
+        except FileNotFoundError:
+            pass
+
+
+class PartUploader(io.RawIOBase):
+    """
+    A write-only stream that uploads itself to a target in parallel parts.
+
+    Writes are buffered into `target.part_size` parts; each full part is sent
+    on a thread pool (with retries) while the writer carries on. At most
+    2 * workers parts are buffered or in flight, so a slow network makes the
+    writer wait instead of growing memory. close() uploads the last part,
+    waits for all of them and completes the upload (or aborts it on failure).
+    """
+
+    def __init__(self, target, name, workers=4, attempts=5):
+        self.target = target
+        self.name = name
+        self.attempts = attempts
+        self.location = None
+        self.bytes_written = 0
+        self._upload = target.begin(name)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup-upload')
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._buffer = bytearray()
+        self._futures = []
+        self._failed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.target.part_size:
+            self._submit(bytes(self._buffer[:self.target.part_size]))
+            del self._buffer[:self.target.part_size]
+        return len(data)
+
+    def _submit(self, data):
+        self._raise_if_failed()
+        self._slots.acquire()
+        number = len(self._futures) + 1
+        future = self._executor.submit(with_retries, lambda: self.target.upload_part(self._upload, number, data),
+                                       f"Upload of part {number} of {self.name}", self.attempts)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _raise_if_failed(self):
+        """Stops producing more parts as soon as one has failed for good."""
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._failed:
+                if self._buffer or not self._futures:
+                    self._submit(bytes(self._buffer))
+                    self._buffer.clear()
+                receipts = [future.result() for future in self._futures]
+                self.location = self.target.complete(self._upload, receipts)
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+
+    def abort(self):
+        """Cancels outstanding parts and discards what was uploaded."""
+        if self._failed:
+            return
+        self._failed = True
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        try:
+            self.target.abort(self._upload)
+        except Exception as e:
+            print(f"  - WARNING: Could not abort the upload of {self.name}: {e}")
@@ -0,0 +1,335 @@
+"""
+How many polling tabs and live streams one gunicorn worker holds, per SERVER_MODE.
+
+Starts gunicorn with gunicorn.conf.py (one worker by default) for each
+`--mode`, logs in once, then opens connections from a single asyncio client:
+
+- `--polling` keep-alive connections, each asking /get_notes?since= every
+  `--poll-interval` seconds with If-None-Match, like an open tab (a poll
+  not answered within `--timeout` seconds counts as failed);
+- `--streams` connections holding /stream_notes open;
+- one writer adding a note every `--write-interval` seconds, so polls and
+  streams have changes to pick up.
+
+Connections are opened at `--ramp` per second and then kept for
+`--seconds`. The report counts connections that were opened or refused,
+polls answered, their latency percentiles and errors, streams that got
+their first byte, and how many of the writes each stream saw. With
+`--output`, the numbers are also written as JSON. Exits non-zero if more
+than `--max-errors` of the polls failed (or none succeeded) in any mode.
+
+Usage:
+    python benchmarks/connections.py [--mode threads,gevent] [--polling 2000] [--streams 200]
+                                     [--workers 1] [--seconds 30] [--output connections.json]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import shutil
+from urllib.parse import urlencode
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+
+
+class Connection:
+    """One keep-alive HTTP/1.1 connection speaking just enough of the protocol for these requests."""
+
+    def __init__(self, port, cookie):
+        self.port = port
+        self.cookie = cookie
+        self.reader = self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    async def send(self, method, path, body=b'', headers=None):
+        lines = [f"{method} {path} HTTP/1.1", "Host: 127.0.0.1", f"Content-Length: {len(body)}"]
+        if self.cookie:
+            lines.append(f"Cookie: {self.cookie}")
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+
+    async def read_head(self):
+        """Reads the status line and headers; returns (status, {lowercase name: value})."""
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        headers = {}
+        while (line := await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return int(status_line.split()[1]), headers
+
+    async def request(self, method, path, body=b'', headers=None):
+        """Sends a request and reads a Content-Length response; returns (status, headers, body)."""
+        await self.send(method, path, body, headers)
+        status, response_headers = await self.read_head()
+        length = int(response_headers.get('content-length', 0))
+        return status, response_headers, await self.reader.readexactly(length) if length else b''
+
+
+def _percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else None
+
+
+class LoadRun:
+    """The client side of one run: tabs, streams and the writer, and what they observed."""
+
+    def __init__(self, port, cookie, args):
+        self.port = port
+        self.cookie = cookie
+        self.args = args
+        self.stop = asyncio.Event()
+        self.opened = self.refused = 0
+        self.poll_latencies = []
+        self.poll_errors = 0
+        self.streams_started = 0
+        self.stream_events = []
+        self.writes = 0
+
+    async def _connect(self):
+        connection = Connection(self.port, self.cookie)
+        try:
+            await asyncio.wait_for(connection.open(), 10)
+        except (OSError, asyncio.TimeoutError):
+            self.refused += 1
+            return None
+        self.opened += 1
+        return connection
+
+    async def _poll(self, connection, cursor, etag):
+        """One poll; a kept-alive connection the server has closed meanwhile is reopened once."""
+        while True:
+            fresh = connection.writer is None
+            if fresh:
+                await connection.open()
+            try:
+                return await connection.request('GET', f"/get_notes?since={cursor}",
+                                                headers={"If-None-Match": etag} if etag else None)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                connection.writer = None
+                if fresh:
+                    raise
+
+    async def tab(self, delay):
+        await asyncio.sleep(delay)
+        connection = await self._connect()
+        if connection is None:
+            return
+        cursor, etag = 0, None
+        try:
+            while not self.stop.is_set():
+                started = time.perf_counter()
+                try:
+                    status, headers, body = await asyncio.wait_for(self._poll(connection, cursor, etag),
+                                                                   self.args.timeout)
+                    if status == 200:
+                        cursor = json.loads(body)['revision']
+                        etag = headers.get('etag')
+                    elif status != 304:
+                        raise ConnectionError(f"status {status}")
+                    self.poll_latencies.append(time.perf_counter() - started)
+                    if headers.get('connection', '').lower() == 'close':
+                        connection.close()
+                        connection.writer = None
+                except (OSError, ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    self.poll_errors += 1
+                    connection.close()
+                    connection.writer = None
+                except asyncio.CancelledError:
+                    self.poll_errors += 1  # still unanswered when the run ended
+                    raise
+                try:
+                    await asyncio.wait_for(self.stop.wait(), self.args.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            connection.close()
+
+    async def stream(self, delay):
+        await asyncio.sleep(delay)
+        connection = await self._connect()
+        if connection is None:
+            return
+        events = 0
+        try:
+            await connection.send('GET', '/stream_notes?since=0')
+            status, _ = await asyncio.wait_for(connection.read_head(), self.args.seconds)
+            if status != 200:
+                return
+            self.streams_started += 1
+            while not self.stop.is_set():
+                line = await connection.reader.readline()
+                if not line:
+                    break
+                if line.startswith(b'event: changes'):
+                    events += 1
+        except (OSError, ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.stream_events.append(events)
+            connection.close()
+
+    async def writer(self):
+        connection = await self._connect()
+        if connection is None:
+            return
+        try:
+            while not self.stop.is_set():
+                body = json.dumps({"note": f"connections benchmark {self.writes}"}).encode()
+                status, _, _ = await connection.request('POST', '/add_note', body,
+                                                        headers={"Content-Type": "application/json"})
+                if status == 200:
+                    self.writes += 1
+                try:
+                    await asyncio.wait_for(self.stop.wait(), self.args.write_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            connection.close()
+
+    async def run(self):
+        args = self.args
+        ramp = (args.polling + args.streams) / args.ramp
+        tasks = [asyncio.create_task(self.stream(i / args.ramp)) for i in range(args.streams)]
+        tasks += [asyncio.create_task(self.tab(args.streams / args.ramp + i / args.ramp))
+                  for i in range(args.polling)]
+        tasks.append(asyncio.create_task(self.writer()))
+        await asyncio.sleep(ramp + args.seconds)
+        self.stop.set()
+        # Streams sit in a read until the next heartbeat; they are done observing
+        await asyncio.wait(tasks, timeout=5)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def summary(self):
+        ordered = sorted(self.poll_latencies)
+        polls = len(ordered)
+        ms = (lambda v: round(v * 1000, 2) if v is not None else None)
+        return {
+            "connections_opened": self.opened, "connections_refused": self.refused,
+            "polls": polls, "poll_errors": self.poll_errors,
+            "poll_error_rate": round(self.poll_errors / (polls + self.poll_errors), 4) if polls + self.poll_errors else 0,
+            "poll_p50_ms": ms(_percentile(ordered, 0.5)), "poll_p99_ms": ms(_percentile(ordered, 0.99)),
+            "poll_max_ms": ms(ordered[-1] if ordered else None),
+            "streams_started": self.streams_started,
+            "stream_events_min": min(self.stream_events) if self.stream_events else None,
+            "writes": self.writes,
+        }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _login(port):
+    """Logs in (registering the user) and returns the session cookie."""
+    async def login():
+        connection = Connection(port, None)
+        await connection.open()
+        try:
+            body = urlencode({"username": USERNAME, "password": PASSWORD}).encode()
+            status, headers, _ = await connection.request(
+                'POST', '/login', body, headers={"Content-Type": "application/x-www-form-urlencoded"})
+        finally:
+            connection.close()
+        if status != 302 or 'set-cookie' not in headers:
+            raise RuntimeError(f"Login failed with status {status}")
+        return headers['set-cookie'].split(';', 1)[0]
+    return asyncio.run(login())
+
+
+def run_mode(mode, args):
+    data_dir = tempfile.mkdtemp(prefix=f'quickpad-connections-{mode}-')
+    port = _free_port()
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), WEB_CONCURRENCY=str(args.workers),
+               RENDER_DATA_DIR=data_dir, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+    if args.threads:
+        env['THREADS'] = str(args.threads)
+    log = open(os.path.join(data_dir, 'gunicorn.log'), 'wb')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+                               '--bind', f'127.0.0.1:{port}', 'app:app'],
+                              cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                cookie = _login(port)
+                break
+            except (OSError, RuntimeError):
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"gunicorn did not start in {mode} mode; see {log.name}")
+                time.sleep(0.2)
+        run = LoadRun(port, cookie, args)
+        asyncio.run(run.run())
+        return dict(run.summary(), mode=mode, workers=args.workers, polling=args.polling, streams=args.streams)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+        if args.keep:
+            print(f"  data and server log kept in {data_dir}")
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Hold many polling and streaming connections against gunicorn.")
+    parser.add_argument('--mode', default='threads,gevent', help="SERVER_MODEs to try (default: %(default)s)")
+    parser.add_argument('--polling', type=int, default=2000, help="Polling tabs (default: %(default)s)")
+    parser.add_argument('--streams', type=int, default=200, help="Open /stream_notes streams (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=1, help="gunicorn workers (default: %(default)s)")
+    parser.add_argument('--threads', type=int, help="THREADS for the server (default: gunicorn.conf.py's)")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--write-interval', type=float, default=1.0)
+    parser.add_argument('--ramp', type=float, default=500, help="Connections opened per second (default: %(default)s)")
+    parser.add_argument('--seconds', type=float, default=30, help="Time all connections are held (default: %(default)s)")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="Seconds after which a poll counts as failed (default: %(default)s)")
+    parser.add_argument('--max-errors', type=float, default=0.01,
+                        help="Largest share of failed polls that passes (default: %(default)s)")
+    parser.add_argument('--output', help="Also write the results as JSON here")
+    parser.add_argument('--keep', action='store_true', help="Keep each run's data directory and server log")
+    args = parser.parse_args()
+
+    results = []
+    for mode in (m.strip() for m in args.mode.split(',')):
+        print(f"{mode}: {args.polling} polling tabs, {args.streams} streams, {args.workers} worker(s)", flush=True)
+        result = run_mode(mode, args)
+        results.append(result)
+        print(f"  connections: {result['connections_opened']} opened, {result['connections_refused']} refused")
+        print(f"  polls:       {result['polls']} answered, {result['poll_errors']} failed "
+              f"(p50 {result['poll_p50_ms']} ms, p99 {result['poll_p99_ms']} ms, max {result['poll_max_ms']} ms)")
+        print(f"  streams:     {result['streams_started']} of {args.streams} started; "
+              f"fewest events seen by one: {result['stream_events_min']} (of {result['writes']} writes)", flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), "results": results}, f, indent=1)
+    if any(not result['polls'] or result['poll_error_rate'] > args.max_errors for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Synthetic note datasets for the benchmarks.
+
+Writes a data directory laid out like the app's (RENDER_DATA_DIR): a user
+with `--notes` notes in `user_notes/<user>.jsonl` (or the SQLite backend),
+a matching `<user>.rev.json`, and a few attachment blobs shared by about
+`--attachments` of the notes. A share of the notes (`--edits`) is edited
+once more, so reads have to fold edit records like a real log. Texts,
+timestamps and attachments are derived from `--seed`, so the same arguments
+give the same notes (only the random part of their ids differs).
+
+Usage:
+    python benchmarks/dataset.py DATA_DIR [--notes 100000] [--backend jsonl|sqlite]
+                                          [--user bench] [--edits 0.1] [--attachments 0.05]
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from note_ids import new_note_id
+from notes_store import SqliteNoteStore
+
+WORDS = ("meeting notes todo call buy milk review draft idea project deadline budget invoice "
+         "travel flight hotel book recipe garden fix bug deploy server backup password remind "
+         "tomorrow monday friday weekend link https://example.com/page photo scan receipt").split()
+BLOBS = [("report.pdf", 256 * 1024), ("scan.png", 96 * 1024), ("notes.txt", 4 * 1024), ("archive.zip", 512 * 1024)]
+WRITE_BATCH = 5000
+END = datetime(2025, 1, 1)  # fixed, so timestamps do not depend on when the dataset was built
+
+
+def _text(rng):
+    # Mostly short notes with a long tail, like a chat-style notepad
+    length = min(int(rng.expovariate(1 / 12)) + 1, 400)
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+
+def _write_blobs(uploads_dir, rng):
+    """Creates the shared attachment blobs; returns their attachment dicts."""
+    os.makedirs(uploads_dir, exist_ok=True)
+    attachments = []
+    for i, (name, size) in enumerate(BLOBS):
+        stored_name = f"{i:064x}{os.path.splitext(name)[1]}"
+        with open(os.path.join(uploads_dir, stored_name), 'wb') as f:
+            f.write(rng.randbytes(size))
+        attachments.append({"original_name": name, "stored_name": stored_name, "size": size})
+    return attachments
+
+
+def generate_notes(count, rng, attachment_share, blobs, end=END):
+    """Yields `count` notes about five minutes apart, oldest first, ending at `end`."""
+    moment = end - timedelta(minutes=5 * count)
+    for rev in range(1, count + 1):
+        moment += timedelta(minutes=5, microseconds=rng.randrange(1000000))
+        timestamp = moment.isoformat() + "Z"
+        attachment = rng.choice(blobs) if rng.random() < attachment_share else None
+        yield {"id": new_note_id(timestamp), "text": '' if attachment and rng.random() < 0.5 else _text(rng),
+               "timestamp": timestamp, "attachment": attachment, "rev": rev}
+
+
+def build(data_dir, notes, backend='jsonl', user='bench', edits=0.1, attachments=0.05, seed=1):
+    """Writes the dataset into `data_dir`; returns a summary dict."""
+    rng = random.Random(seed)
+    notes_dir = os.path.join(data_dir, "user_notes")
+    os.makedirs(notes_dir, exist_ok=True)
+    blobs = _write_blobs(os.path.join(data_dir, "user_uploads", user), rng)
+    refs = {}
+    edited = []
+    revision = notes
+
+    if backend == 'jsonl':
+        with open(os.path.join(notes_dir, f"{user}.jsonl"), 'w') as f:
+            for note in generate_notes(notes, rng, attachments, blobs):
+                f.write(json.dumps(note) + '\n')
+                if note['attachment']:
+                    refs[note['attachment']['stored_name']] = refs.get(note['attachment']['stored_name'], 0) + 1
+                if rng.random() < edits:
+                    edited.append(note)
+            for note in edited:
+                revision += 1
+                f.write(json.dumps({"op": "edit", "note": dict(note, text=note['text'] + ' (edited)',
+                                                                rev=revision)}) + '\n')
+    elif backend == 'sqlite':
+        store = SqliteNoteStore(os.path.join(notes_dir, "notes.sqlite3"))
+        batch = []
+        for note in generate_notes(notes, rng, attachments, blobs):
+            if note['attachment']:
+                refs[note['attachment']['stored_name']] = refs.get(note['attachment']['stored_name'], 0) + 1
+            if rng.random() < edits:
+                revision += 1
+                note = dict(note, text=note['text'] + ' (edited)', rev=revision)
+                edited.append(note)
+            batch.append(note)
+            if len(batch) >= WRITE_BATCH:
+                store.add_notes(user, batch)
+                batch = []
+        if batch:
+            store.add_notes(user, batch)
+    else:
+        raise ValueError(f"Unknown backend: {backend!r}")
+
+    with open(os.path.join(data_dir, "user_uploads", user, '.refs.json'), 'w') as f:
+        json.dump(refs, f)
+    with open(os.path.join(notes_dir, f"{user}.rev.json"), 'w') as f:
+        json.dump({"revision": revision, "reset": 0, "history_start": 0, "deleted": []}, f)
+    return {"user": user, "notes": notes, "edited": len(edited), "revision": revision, "backend": backend}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate a synthetic notes dataset for benchmarking.")
+    parser.add_argument('data_dir', help="Directory to use as RENDER_DATA_DIR")
+    parser.add_argument('--notes', type=int, default=100000, help="Notes to generate (default: %(default)s)")
+    parser.add_argument('--backend', choices=['jsonl', 'sqlite'], default='jsonl')
+    parser.add_argument('--user', default='bench', help="Username owning the notes (default: %(default)s)")
+    parser.add_argument('--edits', type=float, default=0.1, help="Share of notes edited once (default: %(default)s)")
+    parser.add_argument('--attachments', type=float, default=0.05,
+                        help="Share of notes with an attachment (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    summary = build(args.data_dir, args.notes, args.backend, args.user, args.edits, args.attachments, args.seed)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""
+Latency and throughput of the note and attachment hot paths as datasets grow.
+
+For every size in `--sizes` a fresh synthetic dataset (see dataset.py) is
+generated and the app is driven in each `--mode`:
+
+- client: a fresh Python process calls the app through the Flask test
+  client, one request at a time, so the numbers are the app's own cost
+  without HTTP or gunicorn in the way.
+- gunicorn: a local gunicorn started like the Procfile (gunicorn.conf.py,
+  in `--server-mode`) is loaded with `--tabs` simulated browser tabs, each polling
+  /get_notes?since= every `--poll-interval` seconds, while one more client
+  calls every endpoint over HTTP. The tabs' own polls are reported as the
+  'tab_poll' endpoint.
+
+Every endpoint is called until it has `--requests` samples or `--seconds`
+have passed (but at least 3 times); reads run before writes so they see the
+generated dataset. Each result row has the sample count, errors, the first
+(cold) request, mean, p50/p90/p99/max latency in milliseconds, requests per
+second and mean response size. All rows, with the machine and commit they
+were measured on, are written as JSON to `--output`. `--compare OLD.json`
+prints the change against an earlier run and exits non-zero when any p50
+got slower by more than `--threshold`, so regressions show up between
+releases. Everything runs offline on localhost.
+
+Usage:
+    python benchmarks/hot_paths.py [--sizes 1000,10000,100000] [--mode client,gunicorn]
+                                   [--backend jsonl|sqlite] [--tabs 50] [--endpoints all]
+                                   [--output bench-results.json] [--compare baseline.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import dataset
+
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+UPLOAD_SIZE = 1024 * 1024
+BATCH_OPS = 50
+SAMPLE_NOTES = 500  # newest notes whose ids the edit, delete and paging scenarios pick from
+
+
+# --- Scenarios ---
+# Each takes (driver, context) and makes one request through driver.request(method, path, **kwargs).
+
+def _index(driver, context):
+    return driver.request('GET', '/')
+
+
+def _get_notes(driver, context):
+    return driver.request('GET', '/get_notes')
+
+
+def _get_notes_page(driver, context):
+    before_id = context['rng'].choice(context['notes'])['id']
+    return driver.request('GET', f'/get_notes?limit=50&before_id={before_id}')
+
+
+def _poll(driver, context):
+    return driver.request('GET', f"/get_notes?since={context['revision']}")
+
+
+def _search(driver, context):
+    return driver.request('GET', f"/search?q={context['rng'].choice(dataset.WORDS).split(':')[0]}")
+
+
+def _export(filetype):
+    return lambda driver, context: driver.request('GET', f'/export/{filetype}')
+
+
+def _add_note(driver, context):
+    return driver.request('POST', '/add_note', json={"note": dataset._text(context['rng'])})
+
+
+def _batch_add(driver, context):
+    ops = [{"op": "add", "note": dataset._text(context['rng'])} for _ in range(BATCH_OPS)]
+    return driver.request('POST', '/notes/batch', json={"ops": ops})
+
+
+def _edit_note(driver, context):
+    note = context['rng'].choice(context['notes'])
+    return driver.request('POST', '/edit_note', json={"id": note['id'], "new_text": dataset._text(context['rng'])})
+
+
+def _delete_note(driver, context):
+    if not context['deletable']:
+        return None
+    return driver.request('POST', '/delete_note', json={"id": context['deletable'].pop()['id']})
+
+
+def _upload_file(driver, context):
+    # Fresh bytes every time, so content addressing cannot skip the write
+    data = context['rng'].randbytes(UPLOAD_SIZE)
+    return driver.request('POST', '/upload_file', files={'file': ('bench.bin', data)})
+
+
+SCENARIOS = {
+    'index': _index,
+    'get_notes': _get_notes,
+    'get_notes_page': _get_notes_page,
+    'poll': _poll,
+    'search': _search,
+    'export_txt': _export('txt'),
+    'export_csv': _export('csv'),
+    'export_jsonl': _export('jsonl'),
+    'export_ndjson.gz': _export('ndjson.gz'),
+    'export_xlsx': _export('xlsx'),
+    'add_note': _add_note,
+    'batch_add': _batch_add,
+    'edit_note': _edit_note,
+    'delete_note': _delete_note,
+    'upload_file': _upload_file,
+}
+# xlsx is built cell by cell and takes minutes at the larger sizes; ask for it with --endpoints
+DEFAULT_ENDPOINTS = [name for name in SCENARIOS if name != 'export_xlsx']
+
+
+# --- Drivers ---
+
+class TestClientDriver:
+    """Calls the app in-process through the Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['username'] = USERNAME
+
+    def request(self, method, path, json=None, files=None):
+        data = None
+        if files:
+            data = {field: (io.BytesIO(content), name) for field, (name, content) in files.items()}
+        response = self.client.open(path, method=method, json=json, data=data,
+                                    content_type='multipart/form-data' if files else None)
+        body = response.get_data()
+        return response.status_code, len(body), body
+
+
+class HttpDriver:
+    """Calls a running server over HTTP with one keep-alive session."""
+
+    def __init__(self, base_url, cookies=None):
+        import requests  # only needed for the gunicorn mode
+        self.base_url = base_url
+        self.session = requests.Session()
+        if cookies is not None:
+            self.session.cookies.update(cookies)
+
+    def login(self):
+        response = self.session.post(f"{self.base_url}/login", data={"username": USERNAME, "password": PASSWORD},
+                                     allow_redirects=False)
+        if response.status_code != 302:
+            raise RuntimeError(f"Login failed with status {response.status_code}")
+
+    def request(self, method, path, json=None, files=None, headers=None):
+        response = self.session.request(method, f"{self.base_url}{path}", json=json, files=files,
+                                        headers=headers, stream=True, timeout=600)
+        body = b''.join(response.iter_content(64 * 1024))
+        return response.status_code, len(body), body
+
+
+# --- Measuring ---
+
+def _percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def summarize(endpoint, samples, errors, elapsed, sizes):
+    """Turns latency samples (seconds) into a result row (milliseconds)."""
+    ordered = sorted(samples)
+    row = {"endpoint": endpoint, "count": len(samples), "errors": errors}
+    if ordered:
+        row.update({
+            "first_ms": round(samples[0] * 1000, 3),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+            "p50_ms": round(_percentile(ordered, 0.50) * 1000, 3),
+            "p90_ms": round(_percentile(ordered, 0.90) * 1000, 3),
+            "p99_ms": round(_percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3),
+            "rps": round(len(samples) / elapsed, 2) if elapsed else None,
+            "mean_bytes": int(sum(sizes) / len(sizes)),
+        })
+    return row
+
+
+def run_scenarios(driver, endpoints, requests_per_endpoint, seconds, seed):
+    """Runs each endpoint's scenario in turn; returns the result rows."""
+    status, _, body = driver.request('GET', f'/get_notes?limit={SAMPLE_NOTES}')
+    if status != 200:
+        raise RuntimeError(f"Could not read the dataset back (status {status})")
+    page = json.loads(body)
+    rng = random.Random(seed)
+    context = {"rng": rng, "notes": page['notes'], "revision": page['revision'],
+               "deletable": rng.sample(page['notes'], len(page['notes']))}
+    rows = []
+    for endpoint in endpoints:
+        scenario = SCENARIOS[endpoint]
+        samples, sizes, errors = [], [], 0
+        started = time.perf_counter()
+        while len(samples) + errors < requests_per_endpoint:
+            if len(samples) + errors >= 3 and time.perf_counter() - started > seconds:
+                break
+            request_started = time.perf_counter()
+            outcome = scenario(driver, context)
+            if outcome is None:
+                break
+            status, size, _ = outcome
+            if status >= 400:
+                errors += 1
+                continue
+            samples.append(time.perf_counter() - request_started)
+            sizes.append(size)
+        rows.append(summarize(endpoint, samples, errors, time.perf_counter() - started, sizes))
+        print(_format_row(rows[-1]), flush=True)
+    return rows
+
+
+def _format_row(row):
+    if not row['count']:
+        return f"    {row['endpoint']:<16} no successful requests ({row['errors']} errors)"
+    return (f"    {row['endpoint']:<16} n={row['count']:<5} p50={row['p50_ms']:>9.2f}ms p90={row['p90_ms']:>9.2f}ms "
+            f"p99={row['p99_ms']:>9.2f}ms max={row['max_ms']:>9.2f}ms {row['rps']:>9.1f} req/s"
+            + (f" errors={row['errors']}" if row['errors'] else ''))
+
+
+def _client_suite(data_dir, backend, endpoints, requests_per_endpoint, seconds, seed):
+    """Runs in a fresh process: imports the app against `data_dir` and measures it through the test client."""
+    os.environ['RENDER_DATA_DIR'] = data_dir
+    os.environ['NOTES_BACKEND'] = backend
+    sys.path.insert(0, ROOT_DIR)
+    import app as quickpad
+    return run_scenarios(TestClientDriver(quickpad.app), endpoints, requests_per_endpoint, seconds, seed)
+
+
+class PollingTabs:
+    """Simulated browser tabs polling /get_notes?since= over HTTP, each on its own thread and connection."""
+
+    def __init__(self, base_url, cookies, count, interval):
+        self.drivers = [HttpDriver(base_url, cookies) for _ in range(count)]
+        self.interval = interval
+        self.samples = []
+        self.sizes = []
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._poll, args=(driver, i), daemon=True)
+                         for i, driver in enumerate(self.drivers)]
+
+    def _poll(self, driver, number):
+        rng = random.Random(number)
+        cursor, etag = 0, None
+        # Spread the tabs over the interval like independently opened pages
+        self._stop.wait(rng.random() * self.interval)
+        while not self._stop.is_set():
+            started = time.perf_counter()
+            try:
+                response = driver.session.get(f"{driver.base_url}/get_notes?since={cursor}", timeout=60,
+                                              headers={"If-None-Match": etag} if etag else None)
+                elapsed = time.perf_counter() - started
+                if response.status_code == 200:
+                    cursor = response.json()['revision']
+                    etag = response.headers.get('ETag')
+                ok = response.status_code in (200, 304)
+            except Exception:
+                ok, elapsed = False, time.perf_counter() - started
+            with self._lock:
+                if ok:
+                    self.samples.append(elapsed)
+                    self.sizes.append(len(response.content))
+                else:
+                    self.errors += 1
+            self._stop.wait(max(0.0, self.interval - elapsed))
+
+    def start(self):
+        self.started = time.perf_counter()
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        return summarize('tab_poll', self.samples, self.errors, time.perf_counter() - self.started, self.sizes)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _gunicorn_suite(data_dir, backend, args, endpoints):
+    """Starts gunicorn on `data_dir`, loads it with polling tabs and measures every endpoint over HTTP."""
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, RENDER_DATA_DIR=data_dir, NOTES_BACKEND=backend, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+               SERVER_MODE=args.server_mode, WEB_CONCURRENCY=str(args.workers), THREADS=str(args.threads))
+    log = open(os.path.join(data_dir, 'gunicorn.log'), 'wb')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+                               '--bind', f'127.0.0.1:{port}', 'app:app'],
+                              cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        driver = HttpDriver(base_url)
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                driver.login()
+                break
+            except Exception:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"gunicorn did not start; see {log.name}")
+                time.sleep(0.2)
+        tabs = PollingTabs(base_url, driver.session.cookies, args.tabs, args.poll_interval)
+        tabs.start()
+        rows = run_scenarios(driver, endpoints, args.requests, args.seconds, args.seed)
+        rows.append(tabs.stop())
+        print(_format_row(rows[-1]), flush=True)
+        return rows
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log.close()
+
+
+# --- Results ---
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, results, threshold):
+    """Prints p50 changes against an earlier results file; returns the regressions."""
+    with open(old_path) as f:
+        old = json.load(f)
+
+    def key(row):
+        return row['mode'], row.get('server_mode'), row['backend'], row['notes'], row['endpoint']
+
+    baseline = {key(row): row for row in old['results'] if row.get('count')}
+    regressions = []
+    print(f"\nCompared with {old_path} (commit {old['meta'].get('commit')}):")
+    for row in results:
+        before = baseline.get(key(row))
+        if before is None or not row.get('count'):
+            continue
+        change = row['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+        # Sub-millisecond differences are noise, whatever their ratio
+        regressed = change > threshold and row['p50_ms'] - before['p50_ms'] > 1.0
+        print(f"  {'REGRESSED' if regressed else 'ok':<9} {row['mode']:<8} {row['notes']:>8} notes "
+              f"{row['endpoint']:<16} p50 {before['p50_ms']:.2f} -> {row['p50_ms']:.2f}ms ({change:+.0%})")
+        if regressed:
+            regressions.append(row)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the note and attachment endpoints at several dataset sizes.")
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="Comma-separated notes per user; up to 1000000 (default: %(default)s)")
+    parser.add_argument('--mode', default='client,gunicorn', help="client, gunicorn or both (default: %(default)s)")
+    parser.add_argument('--backend', choices=['jsonl', 'sqlite'], default='jsonl')
+    parser.add_argument('--endpoints', default=','.join(DEFAULT_ENDPOINTS),
+                        help=f"Comma-separated subset of {', '.join(SCENARIOS)}, or 'all' (default: all but export_xlsx)")
+    parser.add_argument('--requests', type=int, default=200, help="Samples per endpoint (default: %(default)s)")
+    parser.add_argument('--seconds', type=float, default=5, help="Time budget per endpoint (default: %(default)s)")
+    parser.add_argument('--tabs', type=int, default=50, help="Polling tabs in gunicorn mode (default: %(default)s)")
+    parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds between a tab's polls")
+    parser.add_argument('--server-mode', choices=['threads', 'gevent'], default='gevent',
+                        help="SERVER_MODE of gunicorn.conf.py (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=32, help="Threads per gunicorn worker (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench-results.json', help="Results file (default: %(default)s)")
+    parser.add_argument('--compare', metavar='OLD_RESULTS', help="Earlier results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="p50 slowdown counted as a regression by --compare (default: %(default)s)")
+    parser.add_argument('--keep', action='store_true', help="Keep the generated datasets")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    modes = [mode.strip() for mode in args.mode.split(',')]
+    endpoints = list(SCENARIOS) if args.endpoints == 'all' else [e.strip() for e in args.endpoints.split(',')]
+    unknown = [name for name in endpoints if name not in SCENARIOS] + [m for m in modes if m not in ('client', 'gunicorn')]
+    if unknown:
+        parser.error(f"Unknown endpoint or mode: {', '.join(unknown)}")
+
+    results = []
+    # Client runs get a fresh process each, so no cache or import state carries over between sizes
+    spawn = multiprocessing.get_context('spawn')
+    for size in sizes:
+        for mode in modes:
+            data_dir = tempfile.mkdtemp(prefix=f'quickpad-bench-{size}-')
+            try:
+                started = time.perf_counter()
+                dataset.build(data_dir, size, args.backend, USERNAME, seed=args.seed)
+                print(f"{mode} / {args.backend} / {size} notes (dataset built in {time.perf_counter() - started:.1f}s)",
+                      flush=True)
+                if mode == 'client':
+                    with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                        rows = pool.submit(_client_suite, data_dir, args.backend, endpoints, args.requests,
+                                           args.seconds, args.seed).result()
+                else:
+                    rows = _gunicorn_suite(data_dir, args.backend, args, endpoints)
+            finally:
+                if args.keep:
+                    print(f"  data kept in {data_dir}")
+                else:
+                    shutil.rmtree(data_dir, ignore_errors=True)
+            for row in rows:
+                row.update(mode=mode, backend=args.backend, notes=size)
+                if mode == 'gunicorn':
+                    row.update(tabs=args.tabs, workers=args.workers, threads=args.threads,
+                               server_mode=args.server_mode)
+            results.extend(rows)
+
+    meta = {"created": datetime.utcnow().isoformat() + "Z", "commit": _git_commit(),
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "args": vars(args)}
+    with open(args.output, 'w') as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare and compare(args.compare, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Stress test for the per-user write path: many workers, one user, no lost writes.
+
+Starts `--processes` separate Python processes (like gunicorn workers), each
+importing the app against a scratch data directory and running `--threads`
+client threads that all write to the same user: every thread adds notes and
+edits and deletes some of its own. Afterwards the notes are read back and
+checked against what every thread expects, and the revision must equal the
+number of writes acknowledged.
+
+Usage:
+    python benchmarks/write_stress.py [--processes 4] [--threads 8] [--ops 200]
+                                      [--backend jsonl|sqlite] [--batch-limit 64] [--fsync]
+
+Run once with `--batch-limit 1` to compare against committing every write
+on its own. Exits non-zero if any check fails.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = 'stress'
+
+
+def _worker(worker_id, args, start_event, results):
+    """One 'gunicorn worker': imports the app and runs client threads against it."""
+    sys.path.insert(0, ROOT_DIR)
+    import app as quickpad
+
+    expected = {}  # text key -> final text, or None if deleted
+    acknowledged = [0]
+    errors = []
+    lock = threading.Lock()
+
+    def client(thread_id):
+        rng = random.Random(f"{worker_id}-{thread_id}")
+        client = quickpad.app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = USERNAME
+        mine = []  # (key, note id) of live notes this thread added
+        local = {}
+        done = 0
+        for i in range(args.ops):
+            action = rng.random()
+            if mine and action < 0.15:
+                key, note_id = mine.pop(rng.randrange(len(mine)))
+                response = client.post('/delete_note', json={"id": note_id})
+                local[key] = None
+            elif mine and action < 0.35:
+                key, note_id = rng.choice(mine)
+                new_text = f"{key} edit {i}"
+                response = client.post('/edit_note', json={"id": note_id, "new_text": new_text})
+                local[key] = new_text
+            else:
+                key = f"w{worker_id}-t{thread_id}-n{i}"
+                response = client.post('/add_note', json={"note": key})
+                if response.status_code == 200:
+                    mine.append((key, response.get_json()['note']['id']))
+                local[key] = key
+            if response.status_code != 200:
+                errors.append(f"{response.status_code} {response.get_data(as_text=True)[:200]}")
+            else:
+                done += 1
+        with lock:
+            expected.update(local)
+            acknowledged[0] += done
+
+    threads = [threading.Thread(target=client, args=(t,)) for t in range(args.threads)]
+    start_event.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put({"worker": worker_id, "expected": expected, "acknowledged": acknowledged[0],
+                 "errors": errors, "seconds": time.perf_counter() - started,
+                 "batches": quickpad.writes.batches, "writes": quickpad.writes.writes})
+
+
+def _verify(data_dir, backend, expected, acknowledged):
+    """Returns a list of problems found in the stored notes."""
+    sys.path.insert(0, ROOT_DIR)
+    from notes_store import create_note_store
+
+    notes_dir = os.path.join(data_dir, "user_notes")
+    store = create_note_store(backend, notes_dir, os.path.join(notes_dir, "notes.sqlite3"))
+    problems = []
+
+    if backend == 'jsonl':
+        with open(os.path.join(notes_dir, f"{USERNAME}.jsonl"), 'rb') as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    json.loads(line)
+                except ValueError:
+                    problems.append(f"line {number} of the log is not valid JSON: {line[:80]!r}")
+
+    stored = {}
+    for note in store.list_notes(USERNAME):
+        key = note['text'].split(' edit ')[0]
+        if key in stored:
+            problems.append(f"note {key} is stored twice")
+        stored[key] = note['text']
+
+    for key, text in expected.items():
+        if text is None and key in stored:
+            problems.append(f"deleted note {key} is still present")
+        elif text is not None and stored.get(key) != text:
+            problems.append(f"note {key}: expected {text!r}, found {stored.get(key)!r}")
+    for key in stored.keys() - expected.keys():
+        problems.append(f"unexpected note {key}")
+
+    with open(os.path.join(notes_dir, f"{USERNAME}.rev.json")) as f:
+        revision = json.load(f)['revision']
+    if revision != acknowledged:
+        problems.append(f"revision is {revision} but {acknowledged} writes were acknowledged")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent multi-process write stress test for one user.")
+    parser.add_argument('--processes', type=int, default=4, help="Worker processes (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=8, help="Client threads per process (default: %(default)s)")
+    parser.add_argument('--ops', type=int, default=200, help="Writes per thread (default: %(default)s)")
+    parser.add_argument('--backend', choices=['jsonl', 'sqlite'], default='jsonl')
+    parser.add_argument('--batch-limit', type=int, default=64,
+                        help="WRITE_BATCH_LIMIT; 1 commits every write on its own (default: %(default)s)")
+    parser.add_argument('--fsync', action='store_true', help="Set NOTES_FSYNC=1")
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch data directory")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='quickpad-stress-')
+    os.environ['RENDER_DATA_DIR'] = data_dir
+    os.environ['NOTES_BACKEND'] = args.backend
+    os.environ['WRITE_BATCH_LIMIT'] = str(args.batch_limit)
+    os.environ['NOTES_FSYNC'] = '1' if args.fsync else ''
+
+    # Spawned processes import the app fresh, each with its own caches and locks, like gunicorn workers
+    context = multiprocessing.get_context('spawn')
+    start_event = context.Event()
+    results = context.Queue()
+    workers = [context.Process(target=_worker, args=(w, args, start_event, results)) for w in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    time.sleep(1)  # let every worker finish importing
+    started = time.perf_counter()
+    start_event.set()
+    outcomes = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+
+    expected = {}
+    acknowledged = 0
+    errors = []
+    batches = writes = 0
+    for outcome in outcomes:
+        expected.update(outcome['expected'])
+        acknowledged += outcome['acknowledged']
+        errors.extend(outcome['errors'])
+        batches += outcome['batches']
+        writes += outcome['writes']
+
+    problems = _verify(data_dir, args.backend, expected, acknowledged)
+    print(f"backend={args.backend} processes={args.processes} threads={args.threads} ops/thread={args.ops} "
+          f"batch_limit={args.batch_limit} fsync={args.fsync}")
+    print(f"  {acknowledged} writes in {elapsed:.2f}s = {acknowledged / elapsed:.0f} writes/s "
+          f"({writes / max(batches, 1):.1f} writes per batch)")
+    print(f"  {len(errors)} failed requests, {len(problems)} consistency problems")
+    for line in (errors + problems)[:20]:
+        print(f"    {line}")
+
+    if args.keep:
+        print(f"  data kept in {data_dir}")
+    else:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    sys.exit(1 if errors or problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Keeps blocking work off the event loop when serving with gevent workers.
+
+With SERVER_MODE=gevent (see gunicorn.conf.py) every connection is a
+greenlet and one event loop per worker runs them all. Sockets are
+cooperative, but disk I/O, fsync, SQLite and fcntl lock waits are not: while
+one greenlet is inside them, every other connection of the worker stalls.
+offload() runs such a call on the gevent hub's pool of native threads and
+parks only the calling greenlet until it returns; offload_iter() does the
+same for each step of a generator, for streamed responses. Under any other
+server (the threaded workers, the Flask test client) both simply run the
+work in the calling thread.
+
+Offloaded calls run without Flask's request context, and must not be made
+while holding a user lock taken on the event loop. A call made from a
+native thread, such as one already offloaded, is off the event loop and
+simply runs where it is.
+"""
+import sys
+
+_DONE = object()
+
+
+def is_patched():
+    """True if gevent has monkey-patched this process, as in a gevent worker."""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def _hub():
+    """The main thread's gevent hub if gevent has monkey-patched this process and this is that thread, else None."""
+    if not is_patched():
+        return None
+    # Unlike get_hub(), this does not create a hub for a native thread that has none
+    from gevent._hub_local import get_hub_if_exists
+    hub = get_hub_if_exists()
+    return hub if hub is not None and hub.main_hub else None
+
+
+def offload(func, *args, **kwargs):
+    """Returns func(*args, **kwargs), computed on a native thread when running under gevent."""
+    hub = _hub()
+    if hub is None:
+        return func(*args, **kwargs)
+    return hub.threadpool.apply(func, args, kwargs)
+
+
+def offload_iter(iterable):
+    """Yields the items of `iterable`, each produced on a native thread when running under gevent."""
+    hub = _hub()
+    if hub is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while (item := hub.threadpool.apply(next, (iterator, _DONE))) is not _DONE:
+        yield item
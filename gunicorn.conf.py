@@ -0,0 +1,58 @@
+"""
+gunicorn settings; the Procfile runs `gunicorn --config gunicorn.conf.py app:app`.
+
+SERVER_MODE picks how each worker holds its connections:
+
+    gevent (default) - every connection is a greenlet, so one worker holds up
+        to WORKER_CONNECTIONS open connections, /stream_notes streams and slow
+        clients included. Blocking file I/O, SQLite, image and lock waits in
+        the write, upload, thumbnail, export and search paths run on a pool of
+        THREADS native threads (see cooperative.py). The slow-request profiler
+        only samples native threads, so SLOW_REQUEST_PROFILE_MS is ignored
+        (with a warning at startup) in this mode.
+    threads - gthread workers. Idle keep-alive connections, such as tabs
+        between two polls, wait in the worker's event loop without a thread;
+        THREADS threads run the requests themselves. A /stream_notes stream,
+        slow upload or large download keeps its thread while it lasts, so a
+        few dozen open tabs per worker can take every thread.
+
+Both keep connections alive for KEEPALIVE seconds, longer than the
+front-end's 1 second poll, so polling tabs reuse their connection.
+benchmarks/connections.py checks how many polling and streaming connections
+a worker holds in either mode.
+
+A legacy plaintext users.txt is imported into the user store once, by the
+master before it starts any worker (see migrate_users.py), so hashing a
+large file never counts against a worker's boot timeout.
+"""
+import os
+
+mode = os.environ.get('SERVER_MODE', 'gevent')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+threads = int(os.environ.get('THREADS', 32))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+
+if mode == 'threads':
+    worker_class = 'gthread'
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 4000))
+elif mode == 'gevent':
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 10000))
+else:
+    raise ValueError(f"Unknown SERVER_MODE: {mode!r} (use 'threads' or 'gevent')")
+
+
+def on_starting(server):
+    from migrate_users import import_legacy_users
+    added = import_legacy_users()
+    if added:
+        server.log.info("Imported %d accounts from users.txt", added)
+
+
+def post_worker_init(worker):
+    if mode == 'gevent':
+        from gevent import get_hub
+        # The pool cooperative.offload() runs blocking work on
+        get_hub().threadpool.maxsize = threads
@@ -0,0 +1,311 @@
+"""
+Request timing and hot-path counters, aggregated across gunicorn workers.
+
+Each worker keeps its counters and latency histograms in memory and, at most
+once per `flush_interval` after something changed, writes them to
+`<metrics_dir>/<pid>.json`. render() merges the files of the running workers
+and formats them in the Prometheus text exposition format. The snapshot of a
+worker that has exited is folded into `retired.json`, counters and
+histograms only, and removed, so totals do not drop when a worker is
+recycled while its gauges stop counting. A worker that serves no requests
+writes nothing and runs nothing.
+
+Counters that other objects already keep (the notes store, the write
+coordinator, the attachment store) are read through collectors registered
+with add_collector() whenever a snapshot is written, so their hot paths only
+bump a plain attribute.
+
+SlowRequestProfiler is an opt-in sampling profiler: while requests run, one
+thread samples their stacks every few milliseconds and reports the folded
+stacks of those that turn out slower than a threshold.
+"""
+import os
+import sys
+import json
+import fcntl
+import bisect
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from storage_utils import atomic_write
+
+# Request latency buckets in seconds, from a cached poll to a large export
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def default_metrics_dir():
+    """A directory private to this gunicorn master (the workers' parent), so a restart starts from zero."""
+    return os.path.join(tempfile.gettempdir(), f"quickpad-metrics-{os.getppid()}")
+
+
+def _label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(pairs):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add_counters(total, counters):
+    for name, series in counters.items():
+        merged = total.setdefault(name, {})
+        for key, value in series.items():
+            merged[key] = merged.get(key, 0) + value
+
+
+def _add_histograms(total, histograms):
+    for name, series in histograms.items():
+        merged = total.setdefault(name, {})
+        for key, counts in series.items():
+            summed = merged.setdefault(key, [0] * len(counts))
+            for i, count in enumerate(counts):
+                summed[i] += count
+
+
+class Metrics:
+    """Counters, gauges and histograms of one worker, merged with the other workers' on render."""
+
+    def __init__(self, metrics_dir, prefix='quickpad', flush_interval=1.0, buckets=DEFAULT_BUCKETS):
+        self.metrics_dir = metrics_dir
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._described = {}  # name -> (kind, help)
+        self._counters = {}  # name -> {label key: value}
+        self._histograms = {}  # name -> {label key: [count per bucket..., +Inf count, sum]}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flushed_at = 0.0
+        self._timer = None
+
+    def describe(self, name, kind, help_text):
+        """Declares a metric; `kind` is 'counter', 'gauge' or 'histogram'."""
+        self._described[name] = (kind, help_text)
+
+    def add_collector(self, collect):
+        """Registers `collect()`, returning (name, labels dict, value) triples, read whenever a snapshot is taken."""
+        self._collectors.append(collect)
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+            self._dirty = True
+
+    # --- Snapshots ---
+
+    def _snapshot(self):
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: list(counts) for key, counts in series.items()}
+                          for name, series in self._histograms.items()}
+        for collect in self._collectors:
+            for name, labels, value in collect():
+                counters.setdefault(name, {})[_label_key(labels)] = value
+        return {"pid": os.getpid(), "buckets": self.buckets, "counters": counters, "histograms": histograms}
+
+    def flush(self, force=False):
+        """Writes this worker's snapshot if it changed, at most once per flush_interval unless `force`d."""
+        with self._lock:
+            if not (self._dirty or force):
+                return
+            wait = self._flushed_at + self.flush_interval - time.monotonic()
+            if wait > 0 and not force:
+                # Written later, so the last requests before the worker goes idle are not lost
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._flush_later)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._flushed_at = time.monotonic()
+            self._dirty = False
+        self._write(self._snapshot())
+
+    def _flush_later(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def _write(self, snapshot):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        with atomic_write(os.path.join(self.metrics_dir, f"{snapshot['pid']}.json"), prefix='.snapshot-') as f:
+            json.dump(snapshot, f)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.metrics_dir, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None  # removed or being replaced meanwhile
+
+    def _retire(self, names):
+        """Folds the counters and histograms of exited workers' snapshots into retired.json and removes them."""
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        with open(os.path.join(self.metrics_dir, '.retire.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            retired = self._read('retired.json') or {"counters": {}, "histograms": {}}
+            for name in names:
+                snapshot = self._read(name)
+                if snapshot is None:
+                    continue  # retired by another worker meanwhile
+                counters = {metric: series for metric, series in snapshot['counters'].items()
+                            if self._described.get(metric, ('counter',))[0] != 'gauge'}
+                _add_counters(retired['counters'], counters)
+                if tuple(snapshot['buckets']) == self.buckets:
+                    _add_histograms(retired['histograms'], snapshot['histograms'])
+            retired['pid'], retired['buckets'] = 'retired', self.buckets
+            self._write(retired)
+            for name in names:
+                try:
+                    os.remove(os.path.join(self.metrics_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def collect(self):
+        """Merges the running workers' latest snapshots (this worker's taken now) and the retired totals."""
+        own = self._snapshot()
+        snapshots = [own]
+        try:
+            names = os.listdir(self.metrics_dir)
+        except FileNotFoundError:
+            names = []
+        exited = []
+        for name in names:
+            stem, extension = os.path.splitext(name)
+            if extension != '.json' or stem == str(own['pid']):
+                continue
+            if stem.isdigit() and not _pid_running(int(stem)):
+                exited.append(name)
+                continue
+            snapshot = self._read(name)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        if exited:
+            self._retire(exited)
+            retired = self._read('retired.json')
+            snapshots = [s for s in snapshots if s['pid'] != 'retired'] + ([retired] if retired else [])
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            _add_counters(counters, snapshot['counters'])
+            if tuple(snapshot['buckets']) != self.buckets:
+                continue  # written with other buckets by an older version
+            _add_histograms(histograms, snapshot['histograms'])
+        return counters, histograms
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format (version 0.0.4)."""
+        counters, histograms = self.collect()
+        lines = []
+        for name in sorted(set(counters) | set(histograms)):
+            kind, help_text = self._described.get(name, ('histogram' if name in histograms else 'untyped', ''))
+            full_name = f"{self.prefix}_{name}"
+            if help_text:
+                lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for key, value in sorted(counters.get(name, {}).items()):
+                lines.append(f"{full_name}{_format_labels(json.loads(key))} {_format_value(value)}")
+            for key, counts in sorted(histograms.get(name, {}).items()):
+                pairs = json.loads(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_format_labels(pairs + [['le', bound]])} {cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(pairs)} {_format_value(counts[-1])}")
+                lines.append(f"{full_name}_count{_format_labels(pairs)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+class SlowRequestProfiler:
+    """
+    Samples the stacks of running requests and reports the slow ones.
+
+    begin() registers the calling thread; end(duration, *args) unregisters
+    it and, if `duration` reached `threshold` seconds, calls
+    report(duration, samples, *args) with a Counter of folded stacks
+    ('file:function;...' from the outermost frame, as flame graph tools read
+    them), one count per `interval`. The sampling thread sleeps while no
+    request is registered.
+    """
+
+    def __init__(self, threshold, report, interval=0.005, max_depth=64):
+        self.threshold = threshold
+        self.report = report
+        self.interval = interval
+        self.max_depth = max_depth
+        self._samples = {}  # thread id -> Counter of folded stacks
+        self._wake = threading.Condition()
+        self._thread = None
+
+    def begin(self):
+        with self._wake:
+            self._samples[threading.get_ident()] = Counter()
+            if self._thread is None:
+                # Started lazily, so it runs in each gunicorn worker rather than in the master
+                self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+                self._thread.start()
+            self._wake.notify()
+
+    def end(self, duration, *report_args):
+        with self._wake:
+            samples = self._samples.pop(threading.get_ident(), None)
+        if samples and duration >= self.threshold:
+            self.report(duration, samples, *report_args)
+
+    def _fold(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._samples:
+                    self._wake.wait()
+                threads = list(self._samples)
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = self._fold(frame)
+                    with self._wake:
+                        samples = self._samples.get(ident)
+                        if samples is not None:
+                            samples[stack] += 1
+            del frames
+            time.sleep(self.interval)
@@ -0,0 +1,102 @@
+"""
+Backfills stable ids into notes stored before notes had them.
+
+Usage:
+    python migrate_note_ids.py [--backend jsonl|sqlite] [--dry-run]
+
+The app already gives such notes an id derived from their timestamp whenever
+it reads them, so this is not required before upgrading; it writes those ids
+into the stored notes once, so they no longer depend on the derivation. Each
+jsonl log that still has notes without an id is rewritten with only its live
+notes (like a compaction), and the delete history in `<username>.rev.json`
+is switched from timestamps to ids. The SQLite backend fills its id column
+when the database is opened. Every user is migrated under their write lock,
+so this can run while the app is serving.
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+
+from note_ids import note_id_for
+from notes_store import JsonlNoteStore, SqliteNoteStore
+from storage_utils import atomic_write
+from write_coordinator import WriteCoordinator
+
+DATA_DIR = os.environ.get('RENDER_DATA_DIR', '.')
+NOTES_DIR = os.path.join(DATA_DIR, "user_notes")
+NOTES_DB = os.path.join(NOTES_DIR, "notes.sqlite3")
+NOTES_BACKEND = os.environ.get('NOTES_BACKEND', 'jsonl')
+
+
+def log_needs_ids(path):
+    """True if any note or edit in a jsonl log was written without an id."""
+    with open(path, 'rb') as f:
+        for _, record in JsonlNoteStore._read_records(f):
+            if record is None or record.get('op') == 'delete':
+                continue
+            note = record['note'] if record.get('op') == 'edit' else record
+            if 'id' not in note:
+                return True
+    return False
+
+
+def migrate_revision_state(path):
+    """Rewrites timestamp delete events as ids; returns how many were converted."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    deleted = [[rev, note_id_for(key)] for rev, key in state.get('deleted', [])]
+    converted = sum(1 for old, new in zip(state.get('deleted', []), deleted) if old[1] != new[1])
+    if converted:
+        state['deleted'] = deleted
+        with atomic_write(path) as f:
+            json.dump(state, f)
+    return converted
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Write stable ids into notes stored without them.")
+    parser.add_argument('--backend', choices=['jsonl', 'sqlite'], default=NOTES_BACKEND,
+                        help="Notes backend to migrate (default: %(default)s)")
+    parser.add_argument('--db', default=NOTES_DB, help="SQLite notes database (default: %(default)s)")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would change")
+    args = parser.parse_args()
+
+    if args.backend == 'sqlite':
+        if args.dry_run:
+            print("The SQLite backend fills missing ids when opened; nothing to report in a dry run.")
+        else:
+            SqliteNoteStore(args.db)
+            print(f"Ids backfilled in {args.db}")
+
+    store = JsonlNoteStore(NOTES_DIR)
+    locks = WriteCoordinator(NOTES_DIR, open_batch=None)
+    usernames = set()
+    for suffix in ('.jsonl', '.rev.json'):
+        usernames.update(os.path.basename(p)[:-len(suffix)] for p in glob.glob(os.path.join(NOTES_DIR, '*' + suffix)))
+    usernames = sorted(usernames)
+    if not usernames:
+        print(f"No users found in '{NOTES_DIR}'.")
+        sys.exit(0)
+
+    for username in usernames:
+        notes_file = store.path_for(username)
+        with locks.lock(username, exclusive=True):
+            rewrite = args.backend == 'jsonl' and os.path.exists(notes_file) and log_needs_ids(notes_file)
+            if rewrite and not args.dry_run:
+                store.write_all(username, store.list_notes(username))
+            converted = 0
+            if not args.dry_run:
+                converted = migrate_revision_state(os.path.join(NOTES_DIR, f"{username}.rev.json"))
+        action = "would rewrite" if args.dry_run else "rewrote"
+        print(f"  - '{username}': {action + ' notes log' if rewrite else 'notes log already has ids'}"
+              f", {converted} delete events converted.")
+    print("Note id backfill finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Imports existing `user_notes/*.jsonl` files into the SQLite notes backend.
+
+Usage:
+    python migrate_notes.py [--replace]
+
+Afterwards start the app with NOTES_BACKEND=sqlite. The .jsonl files are left
+untouched, so switching back only needs the environment variable reverted.
+"""
+import os
+import sys
+import glob
+import argparse
+
+from notes_store import JsonlNoteStore, SqliteNoteStore
+
+DATA_DIR = os.environ.get('RENDER_DATA_DIR', '.')
+NOTES_DIR = os.path.join(DATA_DIR, "user_notes")
+NOTES_DB = os.path.join(NOTES_DIR, "notes.sqlite3")
+
+BATCH_SIZE = 5000
+
+
+def read_jsonl_notes(path):
+    """Returns the live notes of a .jsonl log, with edits and tombstones folded in."""
+    with open(path, 'rb') as f:
+        live, _, _ = JsonlNoteStore._fold(f, {}, 0)
+    return [live[key] for key in sorted(live)]
+
+
+def migrate_user(store, username, path, replace):
+    """Imports one user's notes file; returns the number of notes imported."""
+    if store.has_user(username):
+        if not replace:
+            print(f"  - '{username}' already has notes in the database, skipping (use --replace).")
+            return 0
+        store.clear(username)
+
+    imported = 0
+    batch = []
+    for note in read_jsonl_notes(path):
+        batch.append(note)
+        if len(batch) >= BATCH_SIZE:
+            store.add_notes(username, batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        store.add_notes(username, batch)
+        imported += len(batch)
+    return imported
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import user_notes/*.jsonl into the SQLite notes backend.")
+    parser.add_argument('--db', default=NOTES_DB, help="Target database (default: %(default)s)")
+    parser.add_argument('--replace', action='store_true',
+                        help="Re-import users that already have notes in the database")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(NOTES_DIR, '*.jsonl')))
+    if not paths:
+        print(f"No .jsonl files found in '{NOTES_DIR}'.")
+        sys.exit(0)
+
+    store = SqliteNoteStore(args.db)
+    total = 0
+    for path in paths:
+        username = os.path.basename(path)[:-len('.jsonl')]
+        count = migrate_user(store, username, path, args.replace)
+        print(f"  - Imported {count} notes for '{username}'.")
+        total += count
+    print(f"Migration finished: {total} notes imported into {args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Imports the legacy plaintext `users.txt` into the SQLite user store.
+
+Usage:
+    python migrate_users.py [--workers N] [--delete-source]
+
+gunicorn runs the same import from its on_starting hook (see
+gunicorn.conf.py), in the master before any worker boots, so a large file
+cannot outlast the workers' boot timeout; run this by hand when serving
+another way. Password hashing is spread over all CPUs. Accounts already in
+the database are kept as they are. Once imported, users.txt is left out of
+backups; --delete-source removes it.
+"""
+import os
+import sys
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+from user_store import UserStore
+
+DATA_DIR = os.environ.get('RENDER_DATA_DIR', '.')
+USERS_FILE = os.path.join(DATA_DIR, "users.txt")
+USERS_DB = os.path.join(DATA_DIR, "users.sqlite3")
+PASSWORD_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+
+
+def _hash_account(method, account):
+    username, password = account
+    return username, generate_password_hash(password, method)
+
+
+def import_legacy_users(source=USERS_FILE, db=USERS_DB, method=PASSWORD_METHOD, workers=None):
+    """Imports `source` into the user store unless it is missing or was imported already; returns the accounts added."""
+    if not os.path.exists(source):
+        return 0
+    store = UserStore(db, method)
+    if store.imported_from(source):
+        return 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        hasher = lambda accounts: pool.map(partial(_hash_account, method), accounts, chunksize=64)
+        return store.import_users_file(source, hasher)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import users.txt into the SQLite user store.")
+    parser.add_argument('--source', default=USERS_FILE, help="Legacy users file (default: %(default)s)")
+    parser.add_argument('--db', default=USERS_DB, help="Target database (default: %(default)s)")
+    parser.add_argument('--method', default=PASSWORD_METHOD,
+                        help="werkzeug password hash method (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="Processes hashing passwords (default: %(default)s)")
+    parser.add_argument('--delete-source', action='store_true',
+                        help="Remove the plaintext users file after a successful import")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f"No users file found at '{args.source}'.")
+        sys.exit(0)
+
+    if UserStore(args.db, args.method).imported_from(args.source):
+        print(f"'{args.source}' was already imported into {args.db}.")
+    else:
+        added = import_legacy_users(args.source, args.db, args.method, args.workers)
+        print(f"Import finished: {added} accounts added to {args.db}")
+
+    if args.delete_source:
+        os.remove(args.source)
+        print(f"Removed '{args.source}'.")
+
+
+if __name__ == "__main__":
+    main()
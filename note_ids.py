@@ -0,0 +1,97 @@
+"""
+Compact, sortable, unique note ids.
+
+An id is 26 Crockford base32 characters (like a ULID) encoding 130 bits: the
+note's timestamp in microseconds since the epoch (52 bits) followed by 78
+random bits. Ids therefore sort in timestamp order, so they double as the
+sort key of a user's notes, and two notes saved in the same microsecond by
+different workers still get different ids. Within one process, ids minted
+for the same microsecond increment the random part instead of drawing a new
+one, so they keep their creation order too.
+
+Notes written before ids existed get `legacy_note_id(timestamp)`: the same
+time prefix with the random part taken from a hash of the timestamp, so every
+worker derives the same id for them without any coordination.
+"""
+import hashlib
+import secrets
+import threading
+from datetime import datetime, timedelta, timezone
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+LENGTH = 26
+TIME_BITS = 52
+RANDOM_BITS = 78
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_CHARS = frozenset(ALPHABET)
+
+_lock = threading.Lock()
+_last = (-1, 0)  # (micros, random part) of the last id minted by this process
+
+
+def _encode(value):
+    chars = []
+    for _ in range(LENGTH):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def timestamp_micros(timestamp):
+    """Microseconds since the epoch of an ISO timestamp ('Z' or naive means UTC); 0 if it cannot be parsed."""
+    try:
+        dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return 0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    micros = (dt - _EPOCH) // timedelta(microseconds=1)
+    return min(max(micros, 0), (1 << TIME_BITS) - 1)
+
+
+def new_note_id(timestamp):
+    """Mints the id of a note created at ISO `timestamp`."""
+    global _last
+    micros = timestamp_micros(timestamp)
+    with _lock:
+        last_micros, last_random = _last
+        if micros == last_micros and last_random + 1 < 1 << RANDOM_BITS:
+            random_part = last_random + 1
+        else:
+            random_part = secrets.randbits(RANDOM_BITS)
+        _last = (micros, random_part)
+    return _encode(micros << RANDOM_BITS | random_part)
+
+
+def legacy_note_id(key):
+    """
+    The id of a note stored without one, derived from its timestamp.
+
+    `key` is the note's timestamp, or 'timestamp#n' for the n-th later note
+    that shares it.
+    """
+    timestamp = key.split('#', 1)[0]
+    digest = int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:10], 'big')
+    return _encode(timestamp_micros(timestamp) << RANDOM_BITS | digest >> (80 - RANDOM_BITS))
+
+
+def note_id_floor(timestamp):
+    """The smallest id a note with ISO `timestamp` can have, for paging by a timestamp cursor."""
+    return _encode(timestamp_micros(timestamp) << RANDOM_BITS)
+
+
+def note_id_micros(note_id):
+    """The timestamp, in microseconds since the epoch, encoded in an id."""
+    value = 0
+    for char in note_id:
+        value = value << 5 | ALPHABET.index(char)
+    return value >> RANDOM_BITS
+
+
+def is_note_id(value):
+    return isinstance(value, str) and len(value) == LENGTH and _CHARS.issuperset(value)
+
+
+def note_id_for(key):
+    """Returns `key` if it is an id; otherwise treats it as the timestamp of a note stored without one."""
+    return key if is_note_id(key) else legacy_note_id(key)
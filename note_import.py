@@ -0,0 +1,162 @@
+"""
+Reads notes back from the files /export produces, one note at a time.
+
+read_notes() turns an open binary stream in one of the export formats into
+a stream of note dicts ({"text", "timestamp"} plus "id" and "attachment"
+for jsonl), so an import of any size is parsed with constant memory:
+
+- jsonl / ndjson.gz: one JSON note per line, as exported.
+- txt / csv / xlsx: "YYYY-MM-DD HH:MM:SS - text" entries; txt separates
+  them with a blank line, csv and xlsx put one per row under a 'Note' header.
+  Entries without that prefix are imported as they are, stamped with the
+  time of the import.
+
+Lines or rows that cannot be read are counted in `stats['skipped']`.
+"""
+import io
+import os
+import re
+import csv
+import gzip
+import json
+import shutil
+import tempfile
+from datetime import datetime
+
+from note_ids import is_note_id, note_id_micros, timestamp_micros
+
+FORMATS = ('jsonl', 'ndjson.gz', 'csv', 'txt', 'xlsx')
+EXPORT_PREFIX = re.compile(r'(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2}) - (.*)', re.DOTALL)
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class ImportFormatError(ValueError):
+    """The uploaded file is not in a format read_notes() understands."""
+
+
+def format_for(filename):
+    """Guesses the import format from a file name, or returns None."""
+    name = (filename or '').lower()
+    for fmt in sorted(FORMATS, key=len, reverse=True):
+        if name.endswith('.' + fmt):
+            return fmt
+    return {'.ndjson': 'jsonl', '.json': 'jsonl', '.gz': 'ndjson.gz'}.get(os.path.splitext(name)[1])
+
+
+def _now():
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def _from_export_line(entry):
+    """Splits an exported 'YYYY-MM-DD HH:MM:SS - text' entry into a note."""
+    match = EXPORT_PREFIX.fullmatch(entry)
+    if match:
+        return {"text": match.group(3), "timestamp": f"{match.group(1)}T{match.group(2)}Z"}
+    return {"text": entry, "timestamp": _now()}
+
+
+def _from_json_line(line):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict) or not isinstance(record.get('text', ''), str):
+        return None
+    timestamp = record.get('timestamp')
+    if not isinstance(timestamp, str) or not timestamp_micros(timestamp):
+        timestamp = _now()
+    note = {"text": record.get('text') or '', "timestamp": timestamp}
+    # An id is only kept if it still sorts where its timestamp says
+    if is_note_id(record.get('id')) and note_id_micros(record['id']) == timestamp_micros(timestamp):
+        note['id'] = record['id']
+    if isinstance(record.get('attachment'), dict):
+        note['attachment'] = record['attachment']
+    if not note['text'] and 'attachment' not in note:
+        return None
+    return note
+
+
+def _read_jsonl(stream, stats):
+    for line in stream:
+        if not line.strip():
+            continue
+        note = _from_json_line(line)
+        if note is None:
+            stats['skipped'] += 1
+        else:
+            yield note
+
+
+def _read_txt(stream):
+    """
+    Yields the blank-line separated entries of a txt export.
+
+    An exported note may itself contain blank lines, so a new entry only
+    starts after a blank line when the next line carries the export prefix
+    (or when the file has no prefixes at all).
+    """
+    lines = []
+    blanks = 0
+    for line in io.TextIOWrapper(stream, encoding='utf-8', errors='replace'):
+        line = line.rstrip('\r\n')
+        if not line:
+            blanks += 1
+            continue
+        if lines and blanks:
+            if EXPORT_PREFIX.match(line) or not EXPORT_PREFIX.match(lines[0]):
+                yield _from_export_line('\n'.join(lines))
+                lines = []
+            else:
+                lines.extend([''] * blanks)
+        lines.append(line)
+        blanks = 0
+    if lines:
+        yield _from_export_line('\n'.join(lines))
+
+
+def _read_rows(rows, stats):
+    for number, row in enumerate(rows):
+        value = row[0] if row else None
+        if number == 0 and value == 'Note':
+            continue
+        if not isinstance(value, str) or not value.strip():
+            stats['skipped'] += 1
+            continue
+        yield _from_export_line(value)
+
+
+def _read_xlsx(stream, stats, spool_dir):
+    from openpyxl import load_workbook  # only needed for spreadsheets
+
+    # The zip directory sits at the end of the file, so it has to be spooled to be seekable
+    with tempfile.TemporaryFile(dir=spool_dir) as spool:
+        shutil.copyfileobj(stream, spool, COPY_BUFFER_SIZE)
+        spool.seek(0)
+        try:
+            workbook = load_workbook(spool, read_only=True)
+        except Exception as e:
+            raise ImportFormatError(f"Not a readable xlsx file: {e}") from e
+        try:
+            yield from _read_rows(workbook.worksheets[0].iter_rows(values_only=True), stats)
+        finally:
+            workbook.close()
+
+
+def read_notes(fmt, stream, stats, spool_dir=None):
+    """Yields the notes in binary `stream`, read as `fmt` (one of FORMATS)."""
+    if fmt == 'jsonl':
+        yield from _read_jsonl(stream, stats)
+    elif fmt == 'ndjson.gz':
+        try:
+            yield from _read_jsonl(gzip.GzipFile(fileobj=stream, mode='rb'), stats)
+        except (OSError, EOFError) as e:
+            raise ImportFormatError(f"Not a readable gzip file: {e}") from e
+    elif fmt == 'txt':
+        yield from _read_txt(stream)
+    elif fmt == 'csv':
+        yield from _read_rows(csv.reader(io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline='')),
+                              stats)
+    elif fmt == 'xlsx':
+        yield from _read_xlsx(stream, stats, spool_dir)
+    else:
+        raise ImportFormatError(f"Unsupported import format '{fmt}'; use one of: {', '.join(FORMATS)}")
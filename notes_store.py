@@ -0,0 +1,966 @@
+"""
+Storage backends for user notes.
+
+Each backend keeps notes as plain dicts ({"id", "text", "timestamp",
+"attachment", "rev"}) and is addressed by username. Notes are identified by
+their `id` (see note_ids), which also orders them; notes stored before ids
+existed are given their derived legacy id when read. Callers in app.py hold
+the per-user write lock around every mutating call, so backends only need to
+be safe against readers, not against concurrent writers.
+
+Backends:
+    jsonl  - one append-only `<username>.jsonl` log per user (the original format)
+    sqlite - a single SQLite database with indexed per-user rows
+"""
+import os
+import json
+import bisect
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+from note_ids import legacy_note_id, new_note_id, note_id_floor
+from storage_utils import ThreadConnections, atomic_write
+
+
+class NoteStore:
+    """Interface every notes backend implements. Notes are keyed by id."""
+
+    def list_notes(self, username):
+        """Returns all of a user's notes sorted by id (and so by timestamp)."""
+        raise NotImplementedError
+
+    def changed_since(self, username, revision):
+        """Returns the notes added or edited after `revision`, sorted by timestamp."""
+        return [n for n in self.list_notes(username) if n.get('rev', 0) > revision]
+
+    def add_note(self, username, note):
+        """Appends a new note."""
+        raise NotImplementedError
+
+    def add_notes(self, username, notes):
+        """Appends several new notes; backends override it to store them in one go."""
+        for note in notes:
+            self.add_note(username, note)
+
+    def update_note(self, username, note_id, fields):
+        """Merges `fields` into the note with `note_id`; returns it, or None if missing."""
+        raise NotImplementedError
+
+    def delete_note(self, username, note_id):
+        """Removes the note with `note_id`; returns it, or None if missing."""
+        raise NotImplementedError
+
+    def find_id(self, username, timestamp):
+        """Returns the id of the first note saved at `timestamp`, or None (for clients that still send timestamps)."""
+        notes = self.list_notes(username)
+        i = bisect.bisect_left(notes, note_id_floor(timestamp), key=lambda n: n['id'])
+        return notes[i]['id'] if i < len(notes) and notes[i]['timestamp'] == timestamp else None
+
+    def existing_ids(self, username, note_ids):
+        """Returns the subset of `note_ids` the user already has notes for."""
+        wanted = set(note_ids)
+        return {n['id'] for n in self.list_notes(username) if n['id'] in wanted} if wanted else set()
+
+    def clear(self, username):
+        """Removes every note of a user."""
+        raise NotImplementedError
+
+    def page(self, username, limit, before_id=None):
+        """
+        Returns (notes, has_more): the newest `limit` notes with ids below
+        `before_id` (or overall), oldest first, and whether older notes remain.
+        """
+        return _slice_page(self.list_notes(username), limit, before_id)
+
+    def iter_notes(self, username):
+        """Yields a user's notes in timestamp order; backends override it to stream with constant memory."""
+        yield from self.list_notes(username)
+
+    def group(self, username):
+        """
+        Context manager around a batch of writes for one user (see write_coordinator).
+
+        Backends may defer and coalesce the batch's writes until it exits and
+        make them durable once for the whole batch; reads made by the batch's
+        own thread still see them.
+        """
+        return nullcontext()
+
+    def cache_stats(self):
+        """Returns this process's read-cache counters, if the backend has a cache."""
+        return {}
+
+    def io_stats(self):
+        """Returns this process's counters of notes parsed, bytes read and written, and full rewrites."""
+        return {"notes_parsed": self.notes_parsed, "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written, "rewrites": self.rewrites}
+
+
+def _slice_page(notes, limit, before_id):
+    """Pages an id-sorted list the way NoteStore.page describes."""
+    end = bisect.bisect_left(notes, before_id, key=lambda n: n['id']) if before_id else len(notes)
+    start = max(0, end - limit)
+    return notes[start:end], start > 0
+
+
+class NotesCache:
+    """
+    Per-process LRU cache of folded jsonl logs, keyed by file path.
+
+    Entries are validated against os.stat on every lookup. A log that only
+    grew (same inode, same first bytes) is extended in place by folding just
+    the appended lines, so an append costs as much as the records it adds. A
+    replaced or shrunk log is re-read in full. `max_bytes` budgets the memory
+    held across entries, estimated as MEMORY_PER_LOG_BYTE times each entry's
+    log size; least recently used entries are evicted beyond it. Cached notes
+    are shared between requests and must be treated as read-only.
+    """
+
+    HEAD_BYTES = 64
+    # Folded dicts plus the sorted list take about 3.5 bytes of memory per log byte (CPython 3.11)
+    MEMORY_PER_LOG_BYTE = 3.5
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> _CacheEntry
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.extends = self.evictions = 0
+
+    def load(self, path, fold, cached_only=False):
+        """
+        Returns the cache entry for `path`, (re)folding it with `fold` as needed, or None if missing.
+
+        With `cached_only`, a path that would need a full read returns None instead.
+        """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            self.discard(path)
+            return None
+        with f:
+            st = os.fstat(f.fileno())
+            head = os.pread(f.fileno(), self.HEAD_BYTES, 0)
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None:
+                    self._entries.move_to_end(path)
+            if entry is not None and entry.ino == st.st_ino and entry.head == head[:len(entry.head)]:
+                if entry.size == st.st_size and entry.mtime_ns == st.st_mtime_ns:
+                    self.hits += 1
+                    return entry
+                if st.st_size >= entry.size:
+                    with entry.lock:
+                        # Another request may have extended it meanwhile, past this stat even
+                        if entry.size > st.st_size:
+                            return entry
+                        accounted = entry.size
+                        self.extends += 1
+                        try:
+                            entry.extend(f, st, head, fold)
+                        except BaseException:
+                            # Possibly half-folded, so it is re-read in full next time
+                            self.discard(path)
+                            raise
+                    return self._store(path, entry, accounted)
+            if cached_only:
+                return None
+            self.misses += 1
+            live, records, consumed = fold(f, {}, 0)
+            return self._store(path, _CacheEntry(st, head, consumed, live, records))
+
+    def _store(self, path, entry, accounted=None):
+        """Caches `entry`; `accounted` is its size when last stored, if it was extended in place since."""
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= self._cost(accounted if old is entry and accounted is not None else old.size)
+            if self._cost(entry.size) <= self.max_bytes:
+                self._entries[path] = entry
+                self._bytes += self._cost(entry.size)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._cost(evicted.size)
+                self.evictions += 1
+        return entry
+
+    def discard(self, path):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= self._cost(old.size)
+
+    def _cost(self, size):
+        """Estimated memory taken by the folded notes of `size` log bytes."""
+        return int(size * self.MEMORY_PER_LOG_BYTE)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "extends": self.extends,
+                "evictions": self.evictions, "entries": len(self._entries),
+                "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+def _note_id(note):
+    return note['id']
+
+
+class _CacheEntry:
+    """
+    A folded log as of `size` bytes; the id-sorted list of its notes is built on first use.
+
+    extend() updates the entry in place, so readers get copies or slices of
+    the sorted list (taken under `lock`) rather than the list itself.
+    """
+
+    def __init__(self, st, head, size, live, records):
+        self.ino = st.st_ino
+        self.mtime_ns = st.st_mtime_ns
+        self.head = head
+        # Only whole lines are folded; a half-written last line is picked up by the next extend
+        self.size = size
+        self.live = live
+        self.records = records
+        self.lock = threading.Lock()
+        self._sorted = None
+
+    def _sorted_list(self):
+        if self._sorted is None:
+            self._sorted = [self.live[key] for key in sorted(self.live)]
+        return self._sorted
+
+    @property
+    def sorted_notes(self):
+        """A copy of the notes sorted by id."""
+        with self.lock:
+            return list(self._sorted_list())
+
+    def page(self, limit, before_id=None):
+        with self.lock:
+            return _slice_page(self._sorted_list(), limit, before_id)
+
+    def extend(self, f, st, head, fold):
+        """Folds the lines appended to `f` since `size`, patching the sorted list by the ids they touched."""
+        f.seek(self.size)
+        changed = set()
+        self.live, self.records, consumed = fold(f, self.live, self.records, changed)
+        self.size += consumed
+        self.ino, self.mtime_ns, self.head = st.st_ino, st.st_mtime_ns, head
+        notes = self._sorted
+        if notes is None:
+            return
+        if len(changed) > len(notes) // 2:
+            # Mostly new notes (an import, say): sorting them once beats shifting the list per note
+            self._sorted = None
+            return
+        for key in sorted(changed):
+            i = bisect.bisect_left(notes, key, key=_note_id)
+            present = i < len(notes) and notes[i]['id'] == key
+            note = self.live.get(key)
+            if note is None:
+                if present:
+                    del notes[i]
+            elif present:
+                notes[i] = note
+            else:
+                notes.insert(i, note)
+
+
+class OffsetIndex:
+    """
+    On-disk index of a jsonl log's live notes, kept next to it as `<username>.idx`.
+
+    A JSON header line records which log it describes (format version, inode,
+    first bytes, bytes covered, record count). Fixed-width (note id, offset,
+    length) entries sorted by id follow it, so a note or a page of notes is
+    found by binary search and read with one pread per note. Any process may
+    rebuild or extend the index; replacements are atomic and a stale index is
+    simply extended.
+    """
+
+    ENTRY = struct.Struct('>32sQI')
+    VERSION = 2  # version 1 indexes were keyed by timestamp
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        """Returns (header, file) for the index, or (None, None) if it is missing or unreadable."""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None, None
+        try:
+            header = json.loads(f.readline())
+            header['entries_at'] = f.tell()
+            return header, f
+        except ValueError:
+            f.close()
+            return None, None
+
+    def write(self, st, head, size, records, live):
+        """
+        Atomically writes the index for `live`; False if a key is too long.
+
+        `live` is {key: (offset, length)}, or an _IndexEntries of the previous index with changes.
+        """
+        if isinstance(live, _IndexEntries):
+            data = live.pack()
+        else:
+            packed = []
+            for key in sorted(live):
+                raw = key.encode('utf-8')
+                if len(raw) > 32:
+                    return False
+                packed.append(self.ENTRY.pack(raw, *live[key]))
+            data = b''.join(packed)
+        if data is None:
+            return False
+        header = {"version": self.VERSION, "ino": st.st_ino, "head": head.hex(), "size": size, "records": records,
+                  "count": len(data) // self.ENTRY.size}
+        with atomic_write(self.path, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(data)
+        return True
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def read_entries(cls, f, header, start=0, stop=None):
+        """Returns entries [start, stop) as (key, offset, length) tuples."""
+        stop = header['count'] if stop is None else stop
+        f.seek(header['entries_at'] + start * cls.ENTRY.size)
+        data = f.read((stop - start) * cls.ENTRY.size)
+        return [(key.rstrip(b'\0').decode('utf-8'), offset, length)
+                for key, offset, length in cls.ENTRY.iter_unpack(data)]
+
+    @classmethod
+    def bisect(cls, f, header, key):
+        """Returns the position of the first entry whose key is >= `key`."""
+        target = key.encode('utf-8')
+        lo, hi = 0, header['count']
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(header['entries_at'] + mid * cls.ENTRY.size)
+            if cls.ENTRY.unpack(f.read(cls.ENTRY.size))[0].rstrip(b'\0') < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class _IndexEntries:
+    """
+    An OffsetIndex's packed entries as the {key: (offset, length)} mapping _apply folds into.
+
+    Changes are kept aside and spliced into the sorted bytes by pack(), so
+    extending a large index by a few records costs a few binary searches and
+    one copy of the bytes rather than unpacking and repacking every entry.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.changes = {}  # key -> (offset, length), or None once removed
+
+    def _find(self, key):
+        """Returns (position of the first entry whose key is >= `key`, whether that entry is `key`)."""
+        size = OffsetIndex.ENTRY.size
+        target = key.encode('utf-8').ljust(32, b'\0')  # keys are NUL-padded, which sorts like the bare key
+        lo, hi = 0, len(self.data) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.data[mid * size:mid * size + 32] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo, self.data[lo * size:lo * size + 32] == target
+
+    def __contains__(self, key):
+        if key in self.changes:
+            return self.changes[key] is not None
+        return self._find(key)[1]
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def pop(self, key, default=None):
+        self.changes[key] = None
+        return default
+
+    def pack(self):
+        """The entries with the changes applied, or None if a key is too long to index."""
+        size = OffsetIndex.ENTRY.size
+        pieces = []
+        copied = 0  # entries of `data` already copied or replaced
+        for key in sorted(self.changes):
+            raw = key.encode('utf-8')
+            if len(raw) > 32:
+                return None
+            at, present = self._find(key)
+            pieces.append(self.data[copied * size:at * size])
+            if self.changes[key] is not None:
+                pieces.append(OffsetIndex.ENTRY.pack(raw, *self.changes[key]))
+            copied = at + 1 if present else at
+        pieces.append(self.data[copied * size:])
+        return b''.join(pieces)
+
+
+class JsonlNoteStore(NoteStore):
+    """
+    Stores each user's notes as an append-only JSON-lines log in `<notes_dir>/<username>.jsonl`.
+
+    A plain note line adds a note (the original format, so old files load as-is).
+    Edits append {"op": "edit", "note": {...}} carrying the full updated note and
+    deletes append a {"op": "delete", "id": ..., "timestamp": ...} tombstone;
+    reads fold them in order, by note id. Once dead records make up `compact_ratio` of a log with at
+    least `compact_min_records` lines, the file is rewritten with only the live
+    notes through a temp file and an atomic rename. Folded logs are kept in a
+    NotesCache so repeated reads skip parsing; workers without a cached copy
+    serve pages through the log's OffsetIndex instead of reading it all.
+    """
+
+    ITER_BATCH = 1024  # index entries read at a time by iter_notes
+
+    def __init__(self, notes_dir, compact_ratio=0.5, compact_min_records=64, cache_bytes=256 * 1024 * 1024,
+                 fsync=False):
+        self.notes_dir = notes_dir
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.cache = NotesCache(cache_bytes)
+        self.fsync = fsync
+        self._groups = {}  # username -> _AppendGroup of the batch writing to it
+        self.notes_parsed = self.bytes_read = self.bytes_written = self.rewrites = 0
+
+    def path_for(self, username):
+        return os.path.join(self.notes_dir, f"{username}.jsonl")
+
+    def _index_for(self, username):
+        return OffsetIndex(os.path.join(self.notes_dir, f"{username}.idx"))
+
+    @staticmethod
+    def _read_records(f):
+        """
+        Yields (line length, record) for each complete line of binary file `f`.
+
+        Corrupted lines yield a None record. A trailing line without a newline
+        ends the iteration, since a writer may still be appending it.
+        """
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                yield len(line), json.loads(line)
+            except json.JSONDecodeError:
+                # Silently skip corrupted lines to prevent app crashes
+                yield len(line), None
+
+    @staticmethod
+    def _apply(live, record, value):
+        """Applies one log record to `live` ({note id: value}, in log order); returns the note id."""
+        op = record.get('op')
+        if op is None:
+            key = record.get('id')
+            if key is None:
+                # Notes from before ids existed; later notes sharing a timestamp get their own ids too
+                key = legacy_note_id(record['timestamp'])
+                duplicate = 1
+                while key in live:
+                    key = legacy_note_id(f"{record['timestamp']}#{duplicate}")
+                    duplicate += 1
+            live[key] = value
+        elif op == 'edit':
+            key = record['note'].get('id') or legacy_note_id(record['note']['timestamp'])
+            if key in live:
+                live[key] = value
+        else:
+            key = record.get('id') or legacy_note_id(record['timestamp'])
+            live.pop(key, None)
+        return key
+
+    @classmethod
+    def _fold(cls, f, live, records, changed=None):
+        """
+        Folds `f` into `live` ({note id: note}); returns (live, record count, bytes consumed).
+
+        The ids of the notes the records added, edited or deleted are added to `changed`, if given.
+        """
+        consumed = 0
+        for length, record in cls._read_records(f):
+            consumed += length
+            if record is not None:
+                records += 1
+                note = record['note'] if record.get('op') == 'edit' else record
+                key = cls._apply(live, record, note)
+                note.setdefault('id', key)
+                if changed is not None:
+                    changed.add(key)
+        return live, records, consumed
+
+    @classmethod
+    def _fold_offsets(cls, f, offset, live, records):
+        """Like _fold, but folds the (offset, length) of each note's latest record, starting at `offset`."""
+        start = offset
+        for length, record in cls._read_records(f):
+            if record is not None:
+                records += 1
+                cls._apply(live, record, (offset, length))
+            offset += length
+        return live, records, offset - start
+
+    def _counted_fold(self, f, live, records, changed=None):
+        """_fold, counting what it parsed in io_stats."""
+        live, total, consumed = self._fold(f, live, records, changed)
+        self.notes_parsed += total - records
+        self.bytes_read += consumed
+        return live, total, consumed
+
+    def _load(self, username):
+        """Returns the cached folded log of a user, or None if they have no notes file."""
+        self._flush_group(username)
+        return self.cache.load(self.path_for(username), self._counted_fold)
+
+    def list_notes(self, username):
+        """Returns the user's notes sorted by id; the notes are shared and must not be modified."""
+        entry = self._load(username)
+        return entry.sorted_notes if entry is not None else []
+
+    def page(self, username, limit, before_id=None):
+        notes_file = self.path_for(username)
+        entry = self.cache.load(notes_file, self._counted_fold, cached_only=True)
+        if entry is not None:
+            return entry.page(limit, before_id)
+        try:
+            log = open(notes_file, 'rb')
+        except FileNotFoundError:
+            return [], False
+        with log:
+            header, index = self._fresh_index(username, log)
+            if header is None:
+                return _slice_page(self.list_notes(username), limit, before_id)
+            with index:
+                end = OffsetIndex.bisect(index, header, before_id) if before_id else header['count']
+                start = max(0, end - limit)
+                entries = OffsetIndex.read_entries(index, header, start, end)
+            notes = [self._read_note(log, *entry) for entry in entries]
+        return notes, start > 0
+
+    def iter_notes(self, username):
+        """Streams notes through the offset index, so only the index is held in memory."""
+        notes_file = self.path_for(username)
+        entry = self.cache.load(notes_file, self._counted_fold, cached_only=True)
+        if entry is not None:
+            yield from entry.sorted_notes
+            return
+        try:
+            log = open(notes_file, 'rb')
+        except FileNotFoundError:
+            return
+        # The open log keeps this snapshot readable even if it is compacted meanwhile
+        with log:
+            header, index = self._fresh_index(username, log)
+            if header is None:
+                yield from self.list_notes(username)
+                return
+            with index:
+                for start in range(0, header['count'], self.ITER_BATCH):
+                    stop = min(start + self.ITER_BATCH, header['count'])
+                    for entry in OffsetIndex.read_entries(index, header, start, stop):
+                        yield self._read_note(log, *entry)
+
+    def _read_note(self, log, note_id, offset, length):
+        record = json.loads(os.pread(log.fileno(), length, offset))
+        self.notes_parsed += 1
+        self.bytes_read += length
+        note = record['note'] if record.get('op') == 'edit' else record
+        note.setdefault('id', note_id)
+        return note
+
+    def _fresh_index(self, username, log):
+        """
+        Returns (header, open index file) describing the open `log`, or (None, None).
+
+        An index of the same log that covers fewer bytes is extended by folding
+        only the appended lines; a missing or foreign index is rebuilt.
+        """
+        st = os.fstat(log.fileno())
+        head = os.pread(log.fileno(), NotesCache.HEAD_BYTES, 0)
+        index = self._index_for(username)
+        header, f = index.open()
+        if header is not None:
+            with f:
+                indexed_head = bytes.fromhex(header['head'])
+                if (header.get('version') == OffsetIndex.VERSION and header['ino'] == st.st_ino
+                        and head[:len(indexed_head)] == indexed_head and header['size'] <= st.st_size):
+                    if header['size'] == st.st_size:
+                        return index.open()
+                    f.seek(header['entries_at'])
+                    live = _IndexEntries(f.read(header['count'] * OffsetIndex.ENTRY.size))
+                    start, records = header['size'], header['records']
+                else:
+                    header = None
+        if header is None:
+            live, start, records = {}, 0, 0
+        log.seek(start)
+        parsed = records
+        live, records, consumed = self._fold_offsets(log, start, live, records)
+        self.notes_parsed += records - parsed
+        self.bytes_read += consumed
+        if not index.write(st, head, start + consumed, records, live):
+            return None, None
+        return index.open()
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def _append(self, username, *records):
+        lines = [json.dumps(record) + '\n' for record in records]
+        group = self._owned_group(username)
+        if group is not None:
+            group.lines.extend(lines)
+        else:
+            self._write_lines(username, lines)
+
+    def _write_lines(self, username, lines, sync=True):
+        # One write() on an O_APPEND file, so records never interleave
+        data = ''.join(lines)
+        with open(self.path_for(username), 'a') as f:
+            f.write(data)
+            self.bytes_written += len(data)
+            if sync and self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _owned_group(self, username):
+        """The open batch for `username` if the calling thread owns it, else None."""
+        group = self._groups.get(username)
+        return group if group is not None and group.owner == threading.get_ident() else None
+
+    @contextmanager
+    def group(self, username):
+        """Buffers the calling thread's appends for `username` and writes them with one write() (and fsync)."""
+        self._groups[username] = _AppendGroup()
+        try:
+            yield
+        finally:
+            try:
+                self._flush_group(username, final=True)
+            finally:
+                del self._groups[username]
+
+    def _flush_group(self, username, final=False):
+        """
+        Writes out the batch's buffered lines; only the thread that owns the batch may.
+
+        A read in the middle of a batch flushes without an fsync: the batch
+        syncs everything it wrote once, when it ends.
+        """
+        group = self._owned_group(username)
+        if group is not None and (group.lines or (final and group.unsynced)):
+            lines = group.lines[:]
+            group.lines.clear()
+            self._write_lines(username, lines, sync=final)
+            group.unsynced = not final
+
+    def _maybe_compact(self, username, live_count, records):
+        dead = records - live_count
+        if records >= self.compact_min_records and dead >= records * self.compact_ratio:
+            self.compact(username)
+
+    def write_all(self, username, notes):
+        """Atomically replaces a user's log with exactly `notes`."""
+        notes_file = self.path_for(username)
+        with atomic_write(notes_file) as f:
+            for note in notes:
+                f.write(json.dumps(note) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            written = f.tell()
+        self.rewrites += 1
+        self.bytes_written += written
+
+    def compact(self, username):
+        """Rewrites a user's log with only the live notes, regardless of the dead ratio."""
+        entry = self._load(username)
+        if entry is not None and entry.records > len(entry.live):
+            self.write_all(username, entry.sorted_notes)
+
+    def add_note(self, username, note):
+        self._append(username, note)
+
+    def add_notes(self, username, notes):
+        self._append(username, *notes)
+
+    def _lookup(self, username, note_ids, read=True):
+        """
+        Finds notes by id without folding a log that is not cached.
+
+        Returns ({note id: note, or None unless `read`} for the ids the user
+        has, live notes, log records). A cached log answers from memory;
+        otherwise each id is a bisect of the OffsetIndex plus, with `read`,
+        one pread of its record.
+        """
+        self._flush_group(username)
+        notes_file = self.path_for(username)
+        entry = self.cache.load(notes_file, self._counted_fold, cached_only=True)
+        if entry is None:
+            try:
+                log = open(notes_file, 'rb')
+            except FileNotFoundError:
+                return {}, 0, 0
+            with log:
+                header, index = self._fresh_index(username, log)
+                if header is not None:
+                    found = {}
+                    with index:
+                        for note_id in note_ids:
+                            at = OffsetIndex.bisect(index, header, note_id)
+                            if at == header['count']:
+                                continue
+                            key, offset, length = OffsetIndex.read_entries(index, header, at, at + 1)[0]
+                            if key == note_id:
+                                found[note_id] = self._read_note(log, key, offset, length) if read else None
+                    return found, header['count'], header['records']
+            entry = self._load(username)
+            if entry is None:
+                return {}, 0, 0
+        found = {note_id: entry.live[note_id] for note_id in note_ids if note_id in entry.live}
+        return found, len(entry.live), entry.records
+
+    def existing_ids(self, username, note_ids):
+        return set(self._lookup(username, note_ids, read=False)[0])
+
+    def update_note(self, username, note_id, fields):
+        found, live, records = self._lookup(username, [note_id])
+        if note_id not in found:
+            return None
+        # Cached notes are shared, so the edit works on a copy
+        note = dict(found[note_id], **fields)
+        self._append(username, {"op": "edit", "note": note})
+        self._maybe_compact(username, live, records + 1)
+        return note
+
+    def delete_note(self, username, note_id):
+        found, live, records = self._lookup(username, [note_id])
+        if note_id not in found:
+            return None
+        note = found[note_id]
+        # The timestamp keeps tombstones readable by versions that predate ids
+        self._append(username, {"op": "delete", "id": note_id, "timestamp": note['timestamp']})
+        self._maybe_compact(username, live - 1, records + 1)
+        return note
+
+    def clear(self, username):
+        self._flush_group(username)
+        group = self._owned_group(username)
+        if group is not None:
+            group.unsynced = False  # nothing left to sync, and syncing would recreate the log
+        notes_file = self.path_for(username)
+        self.cache.discard(notes_file)
+        self._index_for(username).remove()
+        if os.path.exists(notes_file):
+            os.remove(notes_file)
+
+
+class _AppendGroup:
+    """A write batch's pending appends to one user's log."""
+
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.lines = []
+        self.unsynced = False  # lines were written mid-batch and still need the batch's fsync
+
+
+class SqliteNoteStore(NoteStore):
+    """
+    Stores all users' notes in one SQLite database.
+
+    Rows are indexed by (username, id), (username, timestamp) and
+    (username, rev), so edits, deletes and delta queries touch only the
+    affected rows. The full note is kept as JSON in `body` so attachment dicts
+    round-trip unchanged. Databases created before notes had ids get the
+    column added and filled with legacy ids when first opened. The writes of
+    a group() share one transaction, so a batch commits once.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notes (
+            username  TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            rev       INTEGER NOT NULL DEFAULT 0,
+            body      TEXT NOT NULL,
+            id        TEXT
+        );
+        CREATE INDEX IF NOT EXISTS notes_by_timestamp ON notes (username, timestamp);
+        CREATE INDEX IF NOT EXISTS notes_by_rev ON notes (username, rev);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._connections = ThreadConnections(db_path)
+        self._local = threading.local()  # per-thread group() state
+        self.notes_parsed = self.bytes_read = self.bytes_written = self.rewrites = 0
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+        self._backfill_ids()
+
+    def _backfill_ids(self):
+        """Adds the id column to an older database and gives rows without an id their legacy id."""
+        conn = self._connect()
+        # IMMEDIATE: workers starting together must not both migrate from the same snapshot
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if 'id' not in {row[1] for row in conn.execute('PRAGMA table_info(notes)')}:
+                conn.execute('ALTER TABLE notes ADD COLUMN id TEXT')
+            rows = conn.execute('SELECT rowid, username, timestamp, body FROM notes WHERE id IS NULL '
+                                'ORDER BY username, timestamp, rowid').fetchall()
+            seen = set()
+            for rowid, username, timestamp, body in rows:
+                key = timestamp
+                duplicate = 1
+                while (username, key) in seen:
+                    key = f"{timestamp}#{duplicate}"
+                    duplicate += 1
+                seen.add((username, key))
+                note = json.loads(body)
+                note['id'] = legacy_note_id(key)
+                conn.execute('UPDATE notes SET id = ?, body = ? WHERE rowid = ?', (note['id'], json.dumps(note), rowid))
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS notes_by_id ON notes (username, id)')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _connect(self):
+        return self._connections.get()
+
+    @contextmanager
+    def _transaction(self):
+        """This thread's connection, committed on exit unless a group() commits it later."""
+        conn = self._connect()
+        if getattr(self._local, 'grouped', False):
+            yield conn
+        else:
+            with conn:
+                yield conn
+
+    @contextmanager
+    def group(self, username):
+        conn = self._connect()
+        self._local.grouped = True
+        try:
+            with conn:
+                yield
+        finally:
+            self._local.grouped = False
+
+    def _decode(self, body):
+        self.notes_parsed += 1
+        self.bytes_read += len(body)
+        return json.loads(body)
+
+    def _encode(self, note):
+        body = json.dumps(note)
+        self.bytes_written += len(body)
+        return body
+
+    def list_notes(self, username):
+        rows = self._connect().execute(
+            'SELECT body FROM notes WHERE username = ? ORDER BY id', (username,))
+        return [self._decode(body) for (body,) in rows]
+
+    def changed_since(self, username, revision):
+        rows = self._connect().execute(
+            'SELECT body FROM notes WHERE username = ? AND rev > ? ORDER BY id',
+            (username, revision))
+        return [self._decode(body) for (body,) in rows]
+
+    def add_note(self, username, note):
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO notes (username, id, timestamp, rev, body) VALUES (?, ?, ?, ?, ?)',
+                         (username, note['id'], note['timestamp'], note.get('rev', 0), self._encode(note)))
+
+    def iter_notes(self, username):
+        rows = self._connect().execute(
+            'SELECT body FROM notes WHERE username = ? ORDER BY id', (username,))
+        for (body,) in rows:
+            yield self._decode(body)
+
+    def add_notes(self, username, notes):
+        """Bulk-inserts notes in one transaction (used by the migration tool); notes without an id get one."""
+        notes = [n if 'id' in n else dict(n, id=new_note_id(n['timestamp'])) for n in notes]
+        with self._transaction() as conn:
+            conn.executemany('INSERT INTO notes (username, id, timestamp, rev, body) VALUES (?, ?, ?, ?, ?)',
+                             ((username, n['id'], n['timestamp'], n.get('rev', 0), self._encode(n)) for n in notes))
+
+    def existing_ids(self, username, note_ids):
+        note_ids = list(note_ids)
+        found = set()
+        conn = self._connect()
+        for start in range(0, len(note_ids), 500):
+            chunk = note_ids[start:start + 500]
+            rows = conn.execute(f"SELECT id FROM notes WHERE username = ? AND id IN ({', '.join('?' * len(chunk))})",
+                                [username, *chunk])
+            found.update(note_id for (note_id,) in rows)
+        return found
+
+    def find_id(self, username, timestamp):
+        row = self._connect().execute(
+            'SELECT id FROM notes WHERE username = ? AND timestamp = ? ORDER BY id LIMIT 1',
+            (username, timestamp)).fetchone()
+        return row[0] if row else None
+
+    def _find(self, conn, username, note_id):
+        return conn.execute('SELECT rowid, body FROM notes WHERE username = ? AND id = ?',
+                            (username, note_id)).fetchone()
+
+    def update_note(self, username, note_id, fields):
+        with self._transaction() as conn:
+            row = self._find(conn, username, note_id)
+            if row is None:
+                return None
+            note = self._decode(row[1])
+            note.update(fields)
+            conn.execute('UPDATE notes SET rev = ?, body = ? WHERE rowid = ?',
+                         (note.get('rev', 0), self._encode(note), row[0]))
+            return note
+
+    def delete_note(self, username, note_id):
+        with self._transaction() as conn:
+            row = self._find(conn, username, note_id)
+            if row is None:
+                return None
+            conn.execute('DELETE FROM notes WHERE rowid = ?', (row[0],))
+            return self._decode(row[1])
+
+    def clear(self, username):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM notes WHERE username = ?', (username,))
+
+    def page(self, username, limit, before_id=None):
+        query = 'SELECT body FROM notes WHERE username = ?'
+        params = [username]
+        if before_id:
+            query += ' AND id < ?'
+            params.append(before_id)
+        query += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit + 1)
+        rows = self._connect().execute(query, params).fetchall()
+        return [self._decode(body) for (body,) in reversed(rows[:limit])], len(rows) > limit
+
+    def has_user(self, username):
+        return self._connect().execute(
+            'SELECT 1 FROM notes WHERE username = ? LIMIT 1', (username,)).fetchone() is not None
+
+
+def create_note_store(backend, notes_dir, db_path, compact_ratio=0.5, cache_bytes=256 * 1024 * 1024, fsync=False):
+    """Builds the configured notes backend ('jsonl' or 'sqlite')."""
+    if backend == 'jsonl':
+        return JsonlNoteStore(notes_dir, compact_ratio=compact_ratio, cache_bytes=cache_bytes, fsync=fsync)
+    if backend == 'sqlite':
+        return SqliteNoteStore(db_path)
+    raise ValueError(f"Unknown NOTES_BACKEND: {backend!r}")
@@ -0,0 +1,224 @@
+"""
+Per-user full-text search over notes, backed by SQLite FTS5.
+
+Each user gets `<notes_dir>/<username>.search.sqlite3` indexing the note text
+and attachment `original_name`. The FTS table holds only the indexed text;
+a plain `notes` table maps each note id to the FTS rowid and keeps the note
+body, so replacing or removing a note is a lookup by key rather than a scan
+of the FTS table. app.py keeps an existing index current from
+add/edit/delete while holding the user's write lock. An index that is
+missing, or that lags the user's revision (e.g. a crash between the note
+write and the index write), is rebuilt from the notes store on the next search,
+as is one built by an older version of this module.
+"""
+import os
+import re
+import json
+import sqlite3
+import itertools
+
+
+class SearchIndex:
+    """Creates, updates and queries the per-user FTS5 search databases."""
+
+    SCHEMA = """
+        CREATE TABLE notes (rowid INTEGER PRIMARY KEY, note_id TEXT NOT NULL UNIQUE, body TEXT NOT NULL);
+        CREATE VIRTUAL TABLE notes_fts USING fts5(
+            text, attachment_name,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        );
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """
+    # bm25 column weights: text, attachment_name
+    RANK = 'bm25(notes_fts, 1.0, 0.5)'
+    # version 1 indexes identified notes by timestamp; version 2 kept the marker characters;
+    # version 3 kept ids and bodies in the FTS table
+    VERSION = 4
+    # Only the newest matches are ranked, so a common word costs the same as a rare one
+    RANK_CANDIDATES = 2000
+    REBUILD_BATCH = 1000
+    # Snippets wrap matches in these control characters; they are removed from indexed text, so only matches carry them
+    MARK_START, MARK_END = '\x02', '\x03'
+
+    def __init__(self, notes_dir):
+        self.notes_dir = notes_dir
+
+    def path_for(self, username):
+        return os.path.join(self.notes_dir, f"{username}.search.sqlite3")
+
+    def _connect(self, path):
+        return sqlite3.connect(path, timeout=30)
+
+    @classmethod
+    def _row(cls, note):
+        """The indexed (text, attachment_name) of a note."""
+        attachment = note.get('attachment') or {}
+        unmark = str.maketrans('', '', cls.MARK_START + cls.MARK_END)
+        return (note.get('text') or '').translate(unmark), (attachment.get('original_name') or '').translate(unmark)
+
+    @classmethod
+    def _insert(cls, conn, note):
+        rowid = conn.execute('INSERT INTO notes (note_id, body) VALUES (?, ?)',
+                             (note['id'], json.dumps(note))).lastrowid
+        conn.execute('INSERT INTO notes_fts (rowid, text, attachment_name) VALUES (?, ?, ?)',
+                     (rowid, *cls._row(note)))
+
+    @classmethod
+    def _replace(cls, conn, note):
+        row = conn.execute('SELECT rowid FROM notes WHERE note_id = ?', (note['id'],)).fetchone()
+        if row is None:
+            cls._insert(conn, note)
+            return
+        conn.execute('UPDATE notes SET body = ? WHERE rowid = ?', (json.dumps(note), row[0]))
+        conn.execute('UPDATE notes_fts SET text = ?, attachment_name = ? WHERE rowid = ?', (*cls._row(note), row[0]))
+
+    @staticmethod
+    def _remove(conn, note_id):
+        row = conn.execute('SELECT rowid FROM notes WHERE note_id = ?', (note_id,)).fetchone()
+        if row is not None:
+            conn.execute('DELETE FROM notes WHERE rowid = ?', row)
+            conn.execute('DELETE FROM notes_fts WHERE rowid = ?', row)
+
+    @staticmethod
+    def _set_revision(conn, revision):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('revision', ?)", (revision,))
+
+    @staticmethod
+    def _version(conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 1
+
+    def _update(self, username, revision, apply):
+        """Runs `apply(conn)` against an existing index; writes never create one."""
+        path = self.path_for(username)
+        if not os.path.exists(path):
+            return
+        conn = self._connect(path)
+        try:
+            if self._version(conn) != self.VERSION:
+                conn.close()
+                self.drop(username)  # rebuilt in the current format by the next search
+                return
+            with conn:
+                apply(conn)
+                self._set_revision(conn, revision)
+        finally:
+            conn.close()
+
+    def update_notes(self, username, revision, added=(), changed=(), removed=()):
+        """
+        Applies a batch of note changes in one transaction.
+
+        `added` notes are new and simply inserted; `changed` notes replace
+        their indexed copy (in order); `removed` ids are deleted last.
+        """
+        def apply(conn):
+            for note in added:
+                self._insert(conn, note)
+            for note in changed:
+                self._replace(conn, note)
+            for note_id in removed:
+                self._remove(conn, note_id)
+        self._update(username, revision, apply)
+
+    def index_note(self, username, note, revision):
+        """Adds or replaces a note in the user's index."""
+        self.update_notes(username, revision, changed=[note])
+
+    def remove_note(self, username, note_id, revision):
+        self.update_notes(username, revision, removed=[note_id])
+
+    def drop(self, username):
+        """Deletes a user's index; the next search rebuilds it."""
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            try:
+                os.remove(self.path_for(username) + suffix)
+            except FileNotFoundError:
+                pass
+
+    def indexed_revision(self, username):
+        """Returns the revision the user's index is current to, or None if there is no usable index."""
+        path = self.path_for(username)
+        if not os.path.exists(path):
+            return None
+        conn = self._connect(path)
+        try:
+            if self._version(conn) != self.VERSION:
+                return None
+            row = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def rebuild(self, username, notes, revision):
+        """Builds a fresh index from `notes` (any iterable) and swaps it in atomically."""
+        notes = iter(notes)
+        path = self.path_for(username)
+        tmp_path = f"{path}.rebuild-{os.getpid()}"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = self._connect(tmp_path)
+        try:
+            with conn:
+                conn.executescript(self.SCHEMA)
+                rowids = itertools.count(1)
+                for chunk in iter(lambda: list(itertools.islice(notes, self.REBUILD_BATCH)), []):
+                    chunk = [(next(rowids), note) for note in chunk]
+                    conn.executemany('INSERT INTO notes (rowid, note_id, body) VALUES (?, ?, ?)',
+                                     ((rowid, note['id'], json.dumps(note)) for rowid, note in chunk))
+                    conn.executemany('INSERT INTO notes_fts (rowid, text, attachment_name) VALUES (?, ?, ?)',
+                                     ((rowid, *self._row(note)) for rowid, note in chunk))
+                conn.execute("INSERT INTO meta (key, value) VALUES ('version', ?)", (self.VERSION,))
+                self._set_revision(conn, revision)
+            conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')")
+            conn.commit()
+        except BaseException:
+            conn.close()
+            os.remove(tmp_path)
+            raise
+        conn.close()
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def to_match_query(text):
+        """
+        Turns free text into an FTS5 query: every word must match and the last
+        one may be a prefix. Returns None if the text has no searchable words.
+        """
+        words = re.findall(r'\w+', text)
+        if not words:
+            return None
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search(self, username, text, limit, offset):
+        """
+        Returns (results, has_more) ranked by bm25; each result has the note and a snippet.
+
+        Only the newest RANK_CANDIDATES matches are ranked, so results page
+        through those. Matches in the snippet are wrapped in MARK_START and
+        MARK_END.
+        """
+        match = self.to_match_query(text)
+        if match is None or offset >= self.RANK_CANDIDATES:
+            return [], False
+        limit = min(limit, self.RANK_CANDIDATES - offset)
+        conn = self._connect(self.path_for(username))
+        try:
+            # Counting back through the doclist by rowid is cheap; scoring every match is not
+            oldest = conn.execute('SELECT rowid FROM notes_fts WHERE notes_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?',
+                                  (match, self.RANK_CANDIDATES - 1)).fetchone()
+            rows = conn.execute(
+                f"SELECT rowid, snippet(notes_fts, -1, ?, ?, '…', 12), {self.RANK} AS score FROM notes_fts "
+                "WHERE notes_fts MATCH ? AND rowid >= ? ORDER BY score LIMIT ? OFFSET ?",
+                (self.MARK_START, self.MARK_END, match, oldest[0] if oldest else 0, limit + 1, offset)).fetchall()
+            bodies = dict(conn.execute(
+                f"SELECT rowid, body FROM notes WHERE rowid IN ({', '.join('?' * len(rows))})",
+                [rowid for rowid, _, _ in rows]))
+        finally:
+            conn.close()
+        results = [{"note": json.loads(bodies[rowid]), "snippet": snippet} for rowid, snippet, _ in rows[:limit]]
+        return results, len(rows) > limit
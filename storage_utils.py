@@ -0,0 +1,53 @@
+"""
+Helpers shared by the modules that keep state in files and SQLite databases.
+
+atomic_write() replaces a file through a temp file in the same directory and
+os.replace, so readers see either the old or the new contents, never a
+partial write. ThreadConnections hands each thread its own SQLite
+connection, since sqlite3 connections must not be shared across threads or
+carried over a fork.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='w', prefix=None):
+    """
+    Yields a temp file opened with `mode` that replaces `path` when the block exits cleanly.
+
+    The temp file is named `prefix` (default '.<file name>.') plus a random
+    part, and is removed if the block or the replace fails.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=prefix or f".{name}.")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ThreadConnections:
+    """Opens one WAL-mode connection to `db_path` per thread, and again in a forked child."""
+
+    def __init__(self, db_path, timeout=30):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self):
+        """Returns this thread's connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -0,0 +1,155 @@
+"""
+Resized previews of image attachments, generated once and cached on disk.
+
+Derivatives live in `<thumbs_dir>/<username>/<stem>_w<width>.<ext>`. They are
+rendered on a small thread pool (Pillow releases the GIL while decoding and
+resizing) and written atomically. Each cache hit refreshes the file's mtime,
+and once the cache outgrows `max_bytes` the least recently used files are
+evicted. Pillow is optional: without it every request falls back to the
+original file.
+
+`offload(func, *args)`, if given, runs each render; app.py passes
+cooperative.offload so that under gevent, where the pool's threads are
+greenlets, decoding and resizing happen on a native thread while the
+requests waiting for the preview wait cooperatively.
+"""
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from storage_utils import atomic_write
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow not installed: previews are disabled
+    Image = None
+
+THUMBNAIL_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+
+
+def is_thumbnailable(filename):
+    """True for raster image names Pillow can preview (SVGs are served as they are)."""
+    return Image is not None and os.path.splitext(filename)[1].lower() in THUMBNAIL_EXTENSIONS
+
+
+def probe_image(path):
+    """Returns (width, height) of an image, reading only its header, or None if it is not one."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            # Phones store portrait photos rotated plus an EXIF orientation tag
+            if img.getexif().get(0x0112) in (5, 6, 7, 8):
+                width, height = height, width
+            return width, height
+    except Exception:
+        return None
+
+
+class ThumbnailCache:
+    """Generates, caches and evicts per-user image derivatives."""
+
+    def __init__(self, thumbs_dir, max_bytes, widths, image_format='WEBP', workers=2, offload=None):
+        self.thumbs_dir = thumbs_dir
+        self.max_bytes = max_bytes
+        self.widths = sorted(widths)
+        self.image_format = image_format
+        self.extension = '.webp' if image_format == 'WEBP' else '.jpg'
+        self.offload = offload or (lambda func, *args: func(*args))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self._pending = {}  # thumb path -> Future, so concurrent requests share one render
+        self._lock = threading.Lock()
+        self._approx_bytes = None
+
+    def snap_width(self, requested):
+        """Rounds a requested width up to a supported one so the cache holds few variants."""
+        for width in self.widths:
+            if requested <= width:
+                return width
+        return self.widths[-1]
+
+    def path_for(self, username, stored_name, width):
+        stem = os.path.splitext(stored_name)[0]
+        return os.path.join(self.thumbs_dir, username, f"{stem}_w{width}{self.extension}")
+
+    def get(self, username, source_path, stored_name, width, timeout):
+        """Returns the path of a cached derivative, rendering it if needed; None if it cannot be had in time."""
+        thumb_path = self.path_for(username, stored_name, width)
+        try:
+            os.utime(thumb_path)  # marks it recently used for eviction
+            return thumb_path
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            future = self._pending.get(thumb_path)
+            if future is None:
+                future = self._executor.submit(self.offload, self._render, source_path, thumb_path, width)
+                self._pending[thumb_path] = future
+                future.add_done_callback(lambda _: self._forget(thumb_path))
+        try:
+            return thumb_path if future.result(timeout=timeout) else None
+        except Exception:
+            return None
+
+    def _forget(self, thumb_path):
+        with self._lock:
+            self._pending.pop(thumb_path, None)
+
+    def _render(self, source_path, thumb_path, width):
+        try:
+            with Image.open(source_path) as img:
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((width, width * 4))
+                if self.image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+                with atomic_write(thumb_path, 'wb', prefix='.thumb-') as f:
+                    img.save(f, self.image_format, quality=80)
+        except Exception as e:
+            print(f"Error creating thumbnail for {source_path}: {e}")
+            return False
+        self._account(os.path.getsize(thumb_path))
+        return True
+
+    def _account(self, added):
+        """Tracks the cache size and evicts least recently used derivatives past the budget."""
+        with self._lock:
+            if self._approx_bytes is not None:
+                self._approx_bytes += added
+                if self._approx_bytes <= self.max_bytes:
+                    return
+        # Other workers write here too, so eviction always starts from a fresh scan
+        files = []
+        for root, _, names in os.walk(self.thumbs_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._approx_bytes = total
+
+    def discard(self, username, stored_name):
+        """Removes every derivative of a blob (after the blob itself is deleted)."""
+        for width in self.widths:
+            try:
+                os.remove(self.path_for(username, stored_name, width))
+            except FileNotFoundError:
+                pass
+
+    def clear(self, username):
+        shutil.rmtree(os.path.join(self.thumbs_dir, username), ignore_errors=True)
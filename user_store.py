@@ -0,0 +1,158 @@
+"""
+Accounts and password hashes, kept in one SQLite database.
+
+Usernames are the primary key, so a login is a single indexed lookup no
+matter how many accounts exist, and sign-ups from several workers at once
+are serialized by SQLite instead of interleaving appends. Passwords are
+stored as werkzeug hashes (`scrypt` by default; any `generate_password_hash`
+method string such as `pbkdf2:sha256:1000000` sets the cost). Hashes made
+with an older method are upgraded the next time their user logs in.
+
+Accounts from the old plaintext `users.txt` are brought over by
+import_users_file(), which migrate_users.py runs, by hand or from gunicorn's
+on_starting hook. A store given the file as `legacy_file` also imports it
+before its first login_or_register(), so when neither ran, a legacy
+username still cannot be registered by someone else first.
+"""
+import os
+import fcntl
+from datetime import datetime
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from storage_utils import ThreadConnections
+
+
+def read_users_file(path):
+    """Returns {username: plaintext password} from a legacy users.txt (later lines win)."""
+    creds = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if ':' in line:
+                user, pwd = line.strip().split(':', 1)
+                creds[user] = pwd
+    return creds
+
+
+class UserStore:
+    """Looks up, creates and verifies accounts."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username      TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL,
+            created_at    TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    """
+
+    def __init__(self, db_path, password_method='scrypt', legacy_file=None):
+        self.db_path = db_path
+        self.password_method = password_method
+        self.legacy_file = legacy_file
+        self._legacy_checked = legacy_file is None
+        # Hashes carry their method and cost before the first '$'; anything else needs an upgrade
+        self._hash_prefix = generate_password_hash('', password_method).split('$', 1)[0]
+        self._connections = ThreadConnections(db_path)
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return self._connections.get()
+
+    def hash_password(self, password):
+        return generate_password_hash(password, self.password_method)
+
+    def exists(self, username):
+        row = self._connect().execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone()
+        return row is not None
+
+    def create(self, username, password_hash):
+        """Adds an account; returns False if the username was taken (possibly a moment ago by another worker)."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)',
+                (username, password_hash, datetime.utcnow().isoformat() + "Z"))
+        return cursor.rowcount == 1
+
+    def verify(self, username, password):
+        """
+        Checks a password. Returns True or False for an existing account, None if there is none.
+
+        A correct password stored under an older hash method is rehashed with the current one.
+        """
+        row = self._connect().execute(
+            'SELECT password_hash FROM users WHERE username = ?', (username,)).fetchone()
+        if row is None:
+            return None
+        stored_hash = row[0]
+        if not check_password_hash(stored_hash, password):
+            return False
+        if stored_hash.split('$', 1)[0] != self._hash_prefix:
+            with self._connect() as conn:
+                conn.execute('UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?',
+                             (self.hash_password(password), username, stored_hash))
+        return True
+
+    def login_or_register(self, username, password):
+        """
+        The login form's rule: an unknown username is registered with the given password.
+
+        Returns True if the user may log in.
+        """
+        if not self._legacy_checked:
+            # Until the legacy file is in, its names would look unknown and be up for grabs
+            self.import_users_file(self.legacy_file)
+            self._legacy_checked = True
+        result = self.verify(username, password)
+        if result is not None:
+            return result
+        if self.create(username, self.hash_password(password)):
+            return True
+        # Lost a race with a concurrent sign-up of the same name
+        return bool(self.verify(username, password))
+
+    # --- Legacy users.txt import ---
+
+    def imported_from(self, path):
+        row = self._connect().execute(
+            'SELECT value FROM meta WHERE key = ?', (f"imported:{os.path.abspath(path)}",)).fetchone()
+        return row is not None
+
+    def add_hashed(self, accounts):
+        """Bulk-inserts (username, password_hash) pairs, keeping accounts that already exist; returns the number added."""
+        created_at = datetime.utcnow().isoformat() + "Z"
+        with self._connect() as conn:
+            cursor = conn.executemany(
+                'INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)',
+                ((username, password_hash, created_at) for username, password_hash in accounts))
+        return cursor.rowcount
+
+    def mark_imported(self, path):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         (f"imported:{os.path.abspath(path)}", datetime.utcnow().isoformat() + "Z"))
+
+    def import_users_file(self, path, hasher=None):
+        """
+        Imports a legacy users.txt once; later calls are no-ops.
+
+        `hasher` maps an iterable of (username, password) to (username, hash)
+        pairs, so callers can spread the hashing over processes. An exclusive
+        lock next to the database keeps several processes from importing at
+        the same time. Returns the number of accounts added.
+        """
+        if not os.path.exists(path) or self.imported_from(path):
+            return 0
+        with open(f"{self.db_path}.import.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.imported_from(path):
+                return 0
+            creds = read_users_file(path)
+            if hasher is None:
+                hashed = ((user, self.hash_password(pwd)) for user, pwd in creds.items())
+            else:
+                hashed = hasher(creds.items())
+            added = self.add_hashed(hashed)
+            self.mark_imported(path)
+        return added
@@ -0,0 +1,134 @@
+"""
+Per-user write coordination across threads and gunicorn workers.
+
+Every change to a user's notes runs while holding an exclusive advisory
+`fcntl` lock on `<lock_dir>/<username>.lock`, so writers in different
+workers never interleave; readers take the same lock shared.
+
+Inside one worker, writes for the same user are group-committed: a thread
+that finds no batch in progress becomes the leader, takes the file lock
+once and runs every write queued for that user meanwhile (up to
+`batch_limit`, its own first) inside a single batch opened by
+`open_batch(username)`. app.py uses the batch to write the revision record
+once and to flush all appended log lines with one write(), instead of once
+per note. Writes that queued up while the batch ran wait for the next one,
+led by the oldest of them, so no thread does other threads' work for more
+than one batch. With a batch limit of 1 every write locks and commits on
+its own.
+
+`offload(func, *args)`, if given, runs each batch and each wait for a
+contended file lock; app.py passes cooperative.offload so that under gevent
+they run on a native thread while queued writes and readers wait
+cooperatively on the event loop.
+"""
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+
+
+class _PendingWrite:
+    """One queued write and, once it ran, its result or exception."""
+
+    def __init__(self, op):
+        self.op = op
+        self.wake = threading.Event()  # set when the write ran, or when it must lead the next batch
+        self.promoted = False
+        self.result = None
+        self.error = None
+
+    def run(self, batch):
+        try:
+            self.result = self.op(batch)
+        except Exception as e:
+            self.error = e
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class WriteCoordinator:
+    """Serializes and batches writes to each user's notes."""
+
+    def __init__(self, lock_dir, open_batch, batch_limit=64, offload=None):
+        self.lock_dir = lock_dir
+        self.open_batch = open_batch
+        self.batch_limit = batch_limit
+        self.offload = offload or (lambda func, *args: func(*args))
+        self._mutex = threading.Lock()
+        self._queues = {}  # username -> [_PendingWrite] waiting for the next batch
+        self._leading = set()  # usernames with a leader thread in this process
+        self.batches = 0
+        self.writes = 0
+
+    def lock_path(self, username):
+        return os.path.join(self.lock_dir, f"{username}.lock")
+
+    @contextmanager
+    def lock(self, username, exclusive):
+        """Holds an advisory lock on a user's notes across all gunicorn workers."""
+        with open(self.lock_path(username), 'a') as lock_file:
+            mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.offload(fcntl.flock, lock_file, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def submit(self, username, op):
+        """
+        Runs `op(batch)` under the user's exclusive lock and returns its result.
+
+        Exceptions raised by `op` are re-raised here, in the submitting thread;
+        they do not affect the other writes of the batch.
+        """
+        pending = _PendingWrite(op)
+        with self._mutex:
+            self._queues.setdefault(username, []).append(pending)
+            if username in self._leading:
+                leader = False
+            else:
+                self._leading.add(username)
+                leader = True
+        if not leader:
+            pending.wake.wait()
+        if leader or pending.promoted:
+            self._lead(username)
+        return pending.outcome()
+
+    def _run_batch(self, username, batch_writes):
+        with self.lock(username, exclusive=True), self.open_batch(username) as batch:
+            for pending in batch_writes:
+                pending.run(batch)
+
+    def _lead(self, username):
+        """Runs one batch of a user's queued writes, then passes leadership to the oldest write left."""
+        with self._mutex:
+            queue = self._queues[username]
+            batch_writes = queue[:self.batch_limit]
+            del queue[:self.batch_limit]
+        try:
+            self.offload(self._run_batch, username, batch_writes)
+        except Exception as e:
+            # The batch could not be opened or committed; none of its writes are known to be durable
+            for pending in batch_writes:
+                if pending.error is None:
+                    pending.error = e
+        finally:
+            with self._mutex:
+                self.batches += 1
+                self.writes += len(batch_writes)
+                queue = self._queues[username]
+                if queue:
+                    queue[0].promoted = True
+                    queue[0].wake.set()
+                else:
+                    del self._queues[username]
+                    self._leading.discard(username)
+            for pending in batch_writes:
+                pending.wake.set()